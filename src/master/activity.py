@@ -20,21 +20,132 @@
 import logging
 import database
 import threading
+import time
+import collections
+import client_cache
+import timers
+from master_config import get, getint
 
 logger = logging.getLogger(name='activity')
 
-__queue = []
+__queue = collections.deque()
 # To be initialized on the first use
 __condition = None
 __thread = None
+__stopping = False
+# The activity rows are stored in batches. Up to this many rows per insert.
+__batch_size = getint('activity_batch_size', 1000)
+# Wait at most this long (in seconds) for the batch to fill up.
+__max_latency = float(get('activity_max_latency', '1'))
+# Don't store the same activity of the same client more than once in this many seconds (0 turns it off).
+__dedup_window = float(get('activity_dedup_window', '0'))
+# Maximum number of items in the queue (0 for unlimited) and what to do when it is full:
+# - block: wait until the activity thread makes some space. The activities
+#   are logged from the reactor thread, so this stalls the whole master
+#   while the DB is slow. Use it only to never lose an activity.
+# - drop_oldest: throw away the oldest item in the queue
+# - drop_low: throw away low priority activities (eg. 'flow', but not 'login' or 'logout')
+__capacity = getint('activity_queue_size', 0)
+__policy = get('activity_queue_policy', 'drop_low')
+if __policy not in ('block', 'drop_oldest', 'drop_low'):
+	raise Exception('Unknown activity queue policy ' + __policy)
+__high_priority = frozenset(['login', 'logout'])
+# Statistics
+__queued = 0
+__dropped = 0
+__flushed = 0
+__high_water = 0
+# Only the activity thread touches these.
+__activity_types = {}
+__recent = {}
+
+def __activity_type(transaction, name):
+	global __activity_types
+	if name not in __activity_types:
+		transaction.execute("SELECT name, id FROM activity_types")
+		__activity_types = dict(transaction.fetchall())
+	return __activity_types.get(name)
+
+def __duplicate(client, activity, queued):
+	"""
+	Check if the same activity of the client was already stored in the
+	last dedup window. Remember it as stored if not.
+	"""
+	global __recent
+	if not __dedup_window:
+		return False
+	key = (client, activity)
+	if __recent.get(key, queued - __dedup_window) > queued - __dedup_window:
+		return True
+	if len(__recent) > 100000:
+		# Drop the ones too old to matter
+		__recent = dict(filter(lambda (k, t): t > queued - __dedup_window, __recent.items()))
+	__recent[key] = queued
+	return False
+
+def __store_activities(transaction, activities):
+	"""
+	Store the (client, activity, time queued) triplets, with a single multi-row
+	insert for each batch. Return how many were stored.
+	"""
+	if not activities:
+		return 0
+	rows = []
+	for (client, activity, queued) in activities:
+		if __duplicate(client, activity, queued):
+			continue
+		client_id = client_cache.get(transaction, client)
+		activity_id = __activity_type(transaction, activity)
+		if client_id is None or activity_id is None:
+			logger.warn("Can't store activity %s of %s", activity, client)
+			continue
+		rows.append(transaction.mogrify("(%s, CURRENT_TIMESTAMP AT TIME ZONE 'UTC', %s)", (client_id, activity_id)))
+	for i in range(0, len(rows), __batch_size):
+		transaction.execute("INSERT INTO activities (client, timestamp, activity) VALUES " + ', '.join(rows[i:i + __batch_size]))
+	logger.debug("Stored %s activities", len(rows))
+	return len(rows)
+
+def __low_priority(action):
+	return isinstance(action, tuple) and action[1] not in __high_priority
+
+def __make_space(action):
+	"""
+	Called with the condition held when the queue is full. Make some space
+	in the queue according to the policy. Return if the action should be
+	queued.
+	"""
+	global __dropped
+	if __policy == 'block':
+		while len(__queue) >= __capacity:
+			__condition.wait()
+		return True
+	elif __policy == 'drop_oldest':
+		__queue.popleft()
+		__dropped += 1
+		return True
+	else:
+		if __low_priority(action):
+			__dropped += 1
+			return False
+		for (i, queued) in enumerate(__queue):
+			if __low_priority(queued):
+				del __queue[i]
+				__dropped += 1
+				break
+		# If there's nothing to drop, let the queue grow. There are not many important items.
+		return True
 
 def __keep_storing():
 	"""
 	Run in separate thread. It keeps getting stuff from the queue and pushing it to the database.
 	This effectively makes waiting for the databes commit asynchronous.
+
+	After waking up, it waits a little bit more (up to the max latency) for
+	more items to come, so they can be stored together.
 	"""
 	global __condition
 	global __queue
+	global __flushed
 	logger.info('Activity thread started')
 	run = True
 	while run:
@@ -42,26 +153,49 @@ def __keep_storing():
 		with __condition:
 			while not __queue:
 				__condition.wait()
+			deadline = time.time() + __max_latency
+			while len(__queue) < __batch_size and not __stopping:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					break
+				__condition.wait(remaining)
 			actions = __queue
-			__queue = []
+			__queue = collections.deque()
+			# Wake anyone blocked on full queue
+			__condition.notify_all()
 
 		try:
+			stored = 0
 			with database.transaction() as t:
+				activities = []
 				for action in actions:
-					if not action(t):
-						run = False
+					if isinstance(action, tuple):
+						activities.append(action)
+					else:
+						# Keep the order, store the activities queued before the function first
+						stored += __store_activities(t, activities)
+						activities = []
+						if not action(t):
+							run = False
+				stored += __store_activities(t, activities)
+			__flushed += stored
 		except Exception as e:
 			logger.error("Unexpected exception in activity thread, ignoring: %s", e)
 	logger.info('Activity thread terminated')
 
-def push(action):
+def push(action, force=False):
 	"""
 	Push a function action into the queue to log some activity
 	or similar. They are executed in order.
+
+	If the queue is full, the configured policy is applied, unless
+	force is set.
 	"""
 	global __queue
 	global __condition
 	global __thread
+	global __queued
+	global __high_water
 	if not __condition:
 		logger.info('Starting the activity thread')
 		# Initialize the thread machinery
@@ -70,8 +204,13 @@ def push(action):
 		__thread.start()
 	# Postpone it to separate thread
 	with __condition:
+		if __capacity and len(__queue) >= __capacity and not force:
+			if not __make_space(action):
+				return
 		__queue.append(action)
-		__condition.notify()
+		__queued += 1
+		__high_water = max(__high_water, len(__queue))
+		__condition.notify_all()
 
 def log_activity(client, activity):
 	"""
@@ -79,11 +218,24 @@ def log_activity(client, activity):
 	of the activity (eg. "login").
 	"""
 	logger.debug("Logging %s activity of %s", activity, client)
-	def log(transaction):
-		logger.debug("Pushing %s of %s", activity, client)
-		transaction.execute("INSERT INTO activities (client, timestamp, activity) SELECT clients.id, CURRENT_TIMESTAMP AT TIME ZONE 'UTC', activity_types.id FROM clients CROSS JOIN activity_types WHERE clients.name = %s AND activity_types.name = %s", (client, activity))
-		return True
-	push(log)
+	# Not a function, it is stored together with other activities in a batch.
+	push((client, activity, time.time()))
 
 def shutdown():
-	push(lambda transaction: False)
+	global __stopping
+	__stopping = True
+	push(lambda transaction: False, True)
+
+def stats():
+	"""
+	Return statistics of the activity queue, as (queued, dropped, flushed,
+	current depth, high-water mark of the depth). The flushed ones are
+	the activity rows actually inserted (not the duplicates or the
+	function actions).
+	"""
+	return (__queued, __dropped, __flushed, len(__queue), __high_water)
+
+def __log_stats():
+	logger.info("Activity queue: %s queued, %s dropped, %s flushed, depth %s, max depth %s", *stats())
+
+stats_logger = timers.timer(__log_stats, 300, False)
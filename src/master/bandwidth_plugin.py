@@ -20,11 +20,13 @@
 from twisted.internet import reactor
 import struct
 import plugin
+from array import array
 import time
 import logging
 import database
 import activity
 import timers
+import client_cache
 
 logger = logging.getLogger(name='bandwidth')
 
@@ -76,104 +78,120 @@ BUCKET_MAP = {
 	1000000: 39
 }
 
-class Window:
+# Items in the histogram row of one client: in_time, in_bytes, out_time, out_bytes for each bucket
+BUCKET_ROW = 4 * BUCKETS_CNT
+# The numbers are 64bit and python 2 has no such array type ('L' may be just 32bit).
+# A double holds them exactly up to 2^53, that's plenty for bytes and microseconds.
+NUMBER_TYPE = 'd'
+EMPTY_ROW = array(NUMBER_TYPE, [0]) * BUCKET_ROW
+
+class Snapshot:
 	"""
-	Class desigened to store data of one clients window.
+	Data of all the clients for one snapshot. To avoid allocating objects
+	for every number, the data are kept in few flat arrays. Each client
+	gets a slot, indexing its row in the histograms (BUCKET_ROW items).
+	The windows are kept as triplets (length, in_max, out_max), with the
+	slot of the owner in a separate array.
 	"""
-	def __init__(self, window_length, in_max, out_max):
-		self.length = window_length
-		self.in_max = in_max
-		self.out_max = out_max
+	def __init__(self):
+		self.clients = []
+		self.slots = {}
+		self.windows = array(NUMBER_TYPE)
+		self.window_slots = array('I')
+		self.buckets = array(NUMBER_TYPE)
+		self.has_buckets = bytearray()
 
-class Bucket:
-	def __init__(self, bucket, in_time, in_bytes, out_time, out_bytes):
-		self.bucket = bucket
-		self.in_time = in_time
-		self.in_bytes = in_bytes
-		self.out_time = out_time
-		self.out_bytes = out_bytes
+	def __len__(self):
+		return len(self.clients)
 
-class ClientData:
-	"""
-	Class that stores all windows of client
-	"""
-	def __init__(self, version):
-		self.version = version
-		self.cnt = 0
-		self.windows = {}
-		self.buckets = {}
-		self.timestamp_dbg = None
+	def slot(self, client):
+		"""
+		Get the slot of the client, allocate it if the client is new.
+		"""
+		slot = self.slots.get(client)
+		if slot is None:
+			slot = len(self.clients)
+			self.slots[client] = slot
+			self.clients.append(client)
+			self.buckets.extend(EMPTY_ROW)
+			self.has_buckets.append(0)
+		return slot
 
-	def add_window(self, window_length, in_max, out_max):
-		self.cnt += 1
-		self.windows[window_length] = Window(window_length, in_max, out_max)
+	def add_window(self, slot, length, in_max, out_max):
+		self.windows.extend((length, in_max, out_max))
+		self.window_slots.append(slot)
 
-	def add_bucket(self, bucket, in_time, in_bytes, out_time, out_bytes):
-		self.cnt += 1
-		self.buckets[bucket] = Bucket(bucket, in_time, in_bytes, out_time, out_bytes)
+	def window(self, index):
+		"""
+		The (length, in_max, out_max) of the index-th window.
+		"""
+		return tuple(map(int, self.windows[3 * index:3 * index + 3]))
 
-def store_bandwidth(data, now):
-	logger.info('Storing bandwidth snapshot')
+	def set_buckets(self, slot, data, offset, count):
+		"""
+		Set the buckets of the client from the data (PROTO_ITEMS_PER_BUCKET
+		items for each bucket), starting at the offset. Return False if
+		there's an unknown bucket (nothing is set then).
+		"""
+		end = offset + count * PROTO_ITEMS_PER_BUCKET
+		positions = map(BUCKET_MAP.get, data[offset:end:PROTO_ITEMS_PER_BUCKET])
+		if None in positions:
+			return False
+		buckets = self.buckets
+		base = slot * BUCKET_ROW
+		for (pos, i) in zip(positions, xrange(offset, end, PROTO_ITEMS_PER_BUCKET)):
+			item = base + pos
+			buckets[item] = data[i + 1]
+			buckets[item + BUCKETS_CNT] = data[i + 2]
+			buckets[item + 2 * BUCKETS_CNT] = data[i + 3]
+			buckets[item + 3 * BUCKETS_CNT] = data[i + 4]
+		self.has_buckets[slot] = 1
+		return True
 
-	with database.transaction() as t:
-		for client, cldata in data.items():
-			for window in cldata.windows.itervalues():
-				t.execute("""INSERT INTO bandwidth (client, timestamp, win_len, in_max, out_max)
-				SELECT clients.id AS client, %s, %s, %s, %s
-				FROM clients
-				WHERE name = %s
-				""", (now, window.length, window.in_max, window.out_max, client))
+	def histograms(self, slot):
+		"""
+		The four arrays (in_time, in_bytes, out_time, out_bytes) of the client,
+		as stored in the DB.
+		"""
+		base = slot * BUCKET_ROW
+		return tuple(map(lambda i: map(int, self.buckets[base + i * BUCKETS_CNT:base + (i + 1) * BUCKETS_CNT]), range(0, 4)))
 
-		for client, cldata in data.items():
-			if not cldata.buckets:
-				continue
+# How many rows to put into a single INSERT statement
+STORE_BATCH = 1000
 
-			try:
-				t.execute("""SELECT client, timestamp, in_time, in_bytes, out_time, out_bytes
-				FROM bandwidth_stats
-				JOIN clients ON bandwidth_stats.client = clients.id
-				WHERE name = %s AND timestamp = date_trunc('hour', %s)
-				""", (client, now))
-				result = t.fetchone()
-				# Use the current data or provide a blank new set.
-				if result:
-					in_time = result[2]
-					in_bytes = result[3]
-					out_time = result[4]
-					out_bytes = result[5]
-				else:
-					in_time = [0] * BUCKETS_CNT
-					in_bytes = [0] * BUCKETS_CNT
-					out_time = [0] * BUCKETS_CNT
-					out_bytes = [0] * BUCKETS_CNT
+def __array_add(column):
+	"""
+	Add the new histogram to the one already in the table, element by element.
+	"""
+	return column + " = ARRAY(SELECT old + new FROM unnest(bandwidth_stats." + column + ", EXCLUDED." + column + ") WITH ORDINALITY AS items(old, new, position) ORDER BY position)"
 
-				# Update it with the data we just received
-				for bucket in cldata.buckets.itervalues():
-					pos = BUCKET_MAP[bucket.bucket]
-					in_time[pos] += bucket.in_time
-					in_bytes[pos] += bucket.in_bytes
-					out_time[pos] += bucket.out_time
-					out_bytes[pos] += bucket.out_bytes
+STATS_INSERT = "INSERT INTO bandwidth_stats (client, timestamp, in_time, in_bytes, out_time, out_bytes) VALUES "
+STATS_CONFLICT = " ON CONFLICT (timestamp, client) DO UPDATE SET " + ', '.join(map(__array_add, ['in_time', 'in_bytes', 'out_time', 'out_bytes']))
 
-				# Store it (depending on if we had a previous value, insert or update)
-				if result:
-					client_id = result[0]
-					timestamp = result[1]
+def store_bandwidth(snapshot, now):
+	logger.info('Storing bandwidth snapshot')
+	hour = now.replace(minute=0, second=0, microsecond=0)
 
-					t.execute("""UPDATE bandwidth_stats
-					SET in_time = %s, in_bytes = %s, out_time = %s, out_bytes = %s
-					WHERE client = %s AND timestamp = %s
-					""", (in_time, in_bytes, out_time, out_bytes, client_id, timestamp))
-				else:
-					t.execute("""INSERT INTO bandwidth_stats (client, timestamp, in_time, in_bytes, out_time, out_bytes)
-					SELECT clients.id AS client, date_trunc('hour', %s) as timestamp, %s, %s, %s, %s
-					FROM clients
-					WHERE name = %s
-					""", (now, in_time, in_bytes, out_time, out_bytes, client))
+	with database.transaction() as t:
+		client_ids = map(lambda client: client_cache.get(t, client), snapshot.clients)
+		# A client may send the same window twice, the last one wins
+		windows = {}
+		for (i, slot) in enumerate(snapshot.window_slots):
+			if client_ids[slot] is not None:
+				(length, in_max, out_max) = snapshot.window(i)
+				windows[(slot, length)] = t.mogrify("(%s, %s, %s, %s, %s)", (client_ids[slot], now, length, in_max, out_max))
+		windows = windows.values()
+		stats = []
+		for (slot, client_id) in enumerate(client_ids):
+			if client_id is not None and snapshot.has_buckets[slot]:
+				stats.append(t.mogrify("(%s, %s, %s, %s, %s, %s)", (client_id, hour) + snapshot.histograms(slot)))
 
-			except KeyError:
-				# Some clients send invalid data (bucket with index 0). While we need to solve that, we at least don't want to kill data for all the clients in such a case.
-				logger.exception("Broken data from client %s", client)
+		for i in range(0, len(windows), STORE_BATCH):
+			t.execute("INSERT INTO bandwidth (client, timestamp, win_len, in_max, out_max) VALUES " + ', '.join(windows[i:i + STORE_BATCH]))
+		# The histograms are summed up for the whole hour, the DB adds the new data to what is already there
+		for i in range(0, len(stats), STORE_BATCH):
+			t.execute(STATS_INSERT + ', '.join(stats[i:i + STORE_BATCH]) + STATS_CONFLICT)
+	logger.debug('Stored %s windows and %s histograms', len(windows), len(stats))
 
 
 class BandwidthPlugin(plugin.Plugin):
@@ -186,7 +204,7 @@ class BandwidthPlugin(plugin.Plugin):
 		self.__interval = int(config['interval'])
 		self.__aggregate_delay = int(config['aggregate_delay'])
 		self.__downloader = timers.timer(self.__init_download, self.__interval, False)
-		self.__data = {}
+		self.__data = Snapshot()
 		self.__last = self.__current = int(time.time())
 
 	def __init_download(self):
@@ -198,7 +216,7 @@ class BandwidthPlugin(plugin.Plugin):
 		self.__last = self.__current
 		self.__current = t
 		self.broadcast(struct.pack('!Q', t))
-		self.__data = {}
+		self.__data = Snapshot()
 		reactor.callLater(self.__aggregate_delay, self.__process)
 
 	def __process(self):
@@ -209,7 +227,7 @@ class BandwidthPlugin(plugin.Plugin):
 		# safe -- we pass all the needed data to it as parameters and get rid of our
 		# copy, passing the ownership to the task.
 		reactor.callInThread(store_bandwidth, self.__data, database.now())
-		self.__data = {}
+		self.__data = Snapshot()
 
 	def name(self):
 		return 'Bandwidth'
@@ -225,39 +243,22 @@ class BandwidthPlugin(plugin.Plugin):
 
 		logger.debug("Bandwidth data from client %s: %s", client, data)
 
-		# Add client's record
-		if not client in self.__data:
-			self.__data[client] = ClientData(self.version(client));
-
 		# Extract timestamp from message and skip it
 		timestamp = data[0]
 		if timestamp < self.__last:
 			logger.info("Data of bandwidth snapshot on %s too old, ignoring (%s vs. %s)", client, timestamp, self.__last)
 			return
-		self.__data[client].timestamp_dbg = timestamp
+		slot = self.__data.slot(client)
 
+		# Get data from message
 		win_cnt = data[1]
 		buckets_cnt_pos = 2 + PROTO_ITEMS_PER_WINDOW * win_cnt
-		data_windows = data[2:buckets_cnt_pos]
-		buckets_cnt = data[buckets_cnt_pos]
-		data_buckets = data[(buckets_cnt_pos+1):]
-
-		# Get data from message
-		for i in range(0, win_cnt):
-			self.__data[client].add_window(
-				data_windows[i*PROTO_ITEMS_PER_WINDOW],
-				data_windows[i*PROTO_ITEMS_PER_WINDOW+1],
-				data_windows[i*PROTO_ITEMS_PER_WINDOW+2]
-			)
+		for i in xrange(2, buckets_cnt_pos, PROTO_ITEMS_PER_WINDOW):
+			self.__data.add_window(slot, data[i], data[i + 1], data[i + 2])
 
-		for i in range(0, buckets_cnt):
-			self.__data[client].add_bucket(
-				data_buckets[i*PROTO_ITEMS_PER_BUCKET],
-				data_buckets[i*PROTO_ITEMS_PER_BUCKET+1],
-				data_buckets[i*PROTO_ITEMS_PER_BUCKET+2],
-				data_buckets[i*PROTO_ITEMS_PER_BUCKET+3],
-				data_buckets[i*PROTO_ITEMS_PER_BUCKET+4]
-			)
+		if not self.__data.set_buckets(slot, data, buckets_cnt_pos + 1, data[buckets_cnt_pos]):
+			# Some clients send invalid data (bucket with index 0). While we need to solve that, we at least don't want to kill data for all the clients in such a case.
+			logger.warn("Broken bucket data from client %s", client)
 
 		# Log client's activity
 		activity.log_activity(client, "bandwidth")
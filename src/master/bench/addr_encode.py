@@ -0,0 +1,88 @@
+#!/usr/bin/python2
+#
+#    Ucollect - small utility for real-time analysis of network data
+#    Copyright (C) 2016 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Compare the encoding of a diff answer address by address (as it used to be)
+# with diff_addr_store.encode_addresses. No DB is needed:
+#
+#   ./bench/addr_encode.py collect-master.conf [ADDRESS_COUNT]
+
+import sys
+import os
+import time
+import random
+import struct
+import socket
+import logging
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+count = int(sys.argv[2]) if len(sys.argv) > 2 else 500000
+del sys.argv[2:] # master_config wants just the config file
+
+import log_extra
+import diff_addr_store
+
+logger = logging.getLogger(name='bench')
+
+def random_address():
+	kind = random.randint(0, 3)
+	if kind == 0:
+		return socket.inet_ntop(socket.AF_INET, struct.pack('!I', random.getrandbits(32)))
+	elif kind == 1:
+		return socket.inet_ntop(socket.AF_INET, struct.pack('!I', random.getrandbits(32))) + ':' + str(random.randint(1, 65535))
+	elif kind == 2:
+		return socket.inet_ntop(socket.AF_INET6, os.urandom(16))
+	else:
+		return '[' + socket.inet_ntop(socket.AF_INET6, os.urandom(16)) + ']:' + str(random.randint(1, 65535))
+
+def one_by_one(addresses, full):
+	result = ''
+	for (address, add) in addresses:
+		if not add and full:
+			continue
+		addr = try_convert(address)
+		result += struct.pack('!B', len(addr) + add) + addr
+	return result
+
+def try_convert(address):
+	# The original addr_convert, trying all the possibilities
+	variants = [(address, '')]
+	try:
+		(ip, port) = address.rsplit(':', 1)
+		ip = ip.strip('[]')
+		port = struct.pack('!H', int(port))
+		variants.append((ip, port))
+	except:
+		pass
+	for (a, p) in variants:
+		for family in [socket.AF_INET, socket.AF_INET6]:
+			try:
+				return socket.inet_pton(family, a) + p
+			except Exception as e:
+				logger.trace("Addr %s, family %s, error %s", a, family, e)
+	raise e
+
+addresses = map(lambda i: (random_address(), random.random() > 0.1), xrange(0, count))
+start = time.time()
+expected = one_by_one(addresses, False)
+print "one by one: %s addresses in %.3f s" % (count, time.time() - start)
+for run in ('cold', 'cached'):
+	start = time.time()
+	result = diff_addr_store.encode_addresses(addresses, False, logger)
+	print "encode_addresses (%s): %s addresses in %.3f s" % (run, count, time.time() - start)
+	assert result == expected
@@ -0,0 +1,57 @@
+#!/usr/bin/python2
+#
+#    Ucollect - small utility for real-time analysis of network data
+#    Copyright (C) 2016 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Measure the memory and speed of an in-memory address set. No DB is needed:
+#
+#   ./bench/addr_set.py collect-master.conf [ADDRESS_COUNT]
+
+import sys
+import os
+import time
+import random
+import struct
+import resource
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+del sys.argv[2:] # master_config wants just the config file
+
+from diff_addr_store import AddressSet
+
+def rss():
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Already binary, as they come out of addr_convert. 100 versions, 1 in 10 is a removal.
+changes = map(lambda i: (struct.pack('!I', random.getrandbits(32)), 1 + i * 100 / count, random.random() > 0.1), xrange(0, count))
+before = rss()
+start = time.time()
+address_set = AddressSet(1, 100, changes)
+print "load: %s addresses in %.3f s" % (count, time.time() - start)
+del changes
+print "memory: %.1f MB of data (%.1f bytes per address), peak RSS grew by %.1f MB" % (address_set.size() / 1048576.0, address_set.size() / float(count), (rss() - before) / 1048576.0)
+
+updates = map(lambda i: (struct.pack('!I', random.getrandbits(32)), 101, random.random() > 0.1), xrange(0, 1000))
+start = time.time()
+address_set.update(101, updates)
+print "update: 1000 changes in %.3f s" % (time.time() - start)
+
+for (from_version, full) in ((100, False), (90, False), (0, True)):
+	start = time.time()
+	size = len(address_set.diff(from_version, full))
+	print "diff from %s%s: %s bytes in %.3f s" % (from_version, ' (full)' if full else '', size, time.time() - start)
@@ -0,0 +1,82 @@
+#!/usr/bin/python2
+#
+#    Ucollect - small utility for real-time analysis of network data
+#    Copyright (C) 2016 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Compare storing a bandwidth snapshot client by client (as it used to be)
+# with the bulk upsert of bandwidth_plugin.store_bandwidth. It writes real
+# rows into the bandwidth and bandwidth_stats tables of the configured
+# database, so run it against a testing DB only. It uses up to CLIENT_COUNT
+# clients from the clients table:
+#
+#   ./bench/bandwidth_store.py collect-master.conf [CLIENT_COUNT]
+
+import sys
+import os
+import time
+import random
+import datetime
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+del sys.argv[2:] # master_config wants just the config file
+
+import log_extra
+import database
+import client_cache
+import bandwidth_plugin
+
+def snapshot(clients, win_len):
+	data = bandwidth_plugin.Snapshot()
+	for client in clients:
+		slot = data.slot(client)
+		data.add_window(slot, win_len, random.randint(0, 10**9), random.randint(0, 10**9))
+		buckets = []
+		for bucket in random.sample(bandwidth_plugin.BUCKET_MAP.keys(), 10):
+			buckets.extend((bucket, random.randint(0, 900), random.randint(0, 10**9), random.randint(0, 900), random.randint(0, 10**9)))
+		data.set_buckets(slot, buckets, 0, 10)
+	return data
+
+def one_by_one(data, now):
+	# The original store_bandwidth, with 3 statements for each client
+	with database.transaction() as t:
+		for (slot, client) in enumerate(data.clients):
+			client_id = client_cache.get(t, client)
+			(length, in_max, out_max) = data.window(slot) # One window for each client here
+			t.execute("INSERT INTO bandwidth (client, timestamp, win_len, in_max, out_max) VALUES (%s, %s, %s, %s, %s)", (client_id, now, length, in_max, out_max))
+			t.execute("SELECT in_time, in_bytes, out_time, out_bytes FROM bandwidth_stats WHERE client = %s AND timestamp = date_trunc('hour', %s)", (client_id, now))
+			result = t.fetchone()
+			new = data.histograms(slot)
+			if result:
+				merged = map(lambda (old, added): map(lambda (a, b): a + b, zip(old, added)), zip(result, new))
+				t.execute("UPDATE bandwidth_stats SET in_time = %s, in_bytes = %s, out_time = %s, out_bytes = %s WHERE client = %s AND timestamp = date_trunc('hour', %s)", tuple(merged) + (client_id, now))
+			else:
+				t.execute("INSERT INTO bandwidth_stats (client, timestamp, in_time, in_bytes, out_time, out_bytes) VALUES (%s, date_trunc('hour', %s), %s, %s, %s, %s)", (client_id, now) + new)
+
+with database.transaction() as t:
+	t.execute("SELECT name FROM clients LIMIT %s", (count,))
+	clients = map(lambda (name,): name, t.fetchall())
+	for client in clients:
+		client_cache.prefetch(t, client)
+
+now = database.now()
+# Different window lengths, so the runs don't collide on the bandwidth primary key
+for (name, store, win_len) in (('one by one', one_by_one, 1000001), ('upsert', bandwidth_plugin.store_bandwidth, 1000002), ('upsert again', bandwidth_plugin.store_bandwidth, 1000003)):
+	data = snapshot(clients, win_len)
+	start = time.time()
+	store(data, now)
+	print "%s: %s clients in %.3f s" % (name, len(clients), time.time() - start)
@@ -0,0 +1,100 @@
+#!/usr/bin/python2
+#
+#    Ucollect - small utility for real-time analysis of network data
+#    Copyright (C) 2016 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Measure how long a broadcast blocks the reactor with many connected clients.
+# No network is involved, the clients write into fake transports:
+#
+#   ./bench/broadcast.py collect-master.conf [CLIENT_COUNT]
+
+import sys
+import os
+import time
+import struct
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+count = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+del sys.argv[2:] # master_config wants just the config file
+
+import log_extra
+import plugin
+
+class Transport:
+	def __init__(self):
+		self.written = 0
+
+	def write(self, data):
+		self.written += len(data)
+
+class Client:
+	"""
+	Just enough of client.ClientConn for the broadcasts.
+	"""
+	def __init__(self, cid, version):
+		self.__cid = cid
+		self.__version = version
+		self.transport = Transport()
+		self.session_id = None
+		self.last_pong = time.time()
+
+	def cid(self):
+		return self.__cid
+
+	def has_plugin(self, name):
+		return name == 'Flow'
+
+	def plugin_version(self, name):
+		return self.__version if name == 'Flow' else None
+
+	def sendString(self, string):
+		# Like twisted.protocols.basic.Int32StringReceiver
+		self.transport.write(struct.pack('!I', len(string)) + string)
+
+	def send_frame(self, frame):
+		self.transport.write(frame)
+
+class Flow(plugin.Plugin):
+	def name(self):
+		return 'Flow'
+
+plugins = plugin.Plugins()
+flow = Flow(plugins)
+clients = []
+for i in range(0, count):
+	client = Client('%016X' % i, 1 + i % 3)
+	plugins.register_client(client)
+	plugins.activate_client('Flow', client)
+	clients.append(client)
+
+message = 'C' + os.urandom(4096)
+
+def per_client(message, version_check):
+	"""
+	The broadcast as it used to be, checking and framing for each client.
+	"""
+	message = 'R' + plugin.format_string('Flow') + message
+	for c in clients:
+		if c.has_plugin('Flow'):
+			if version_check is None or version_check(c.plugin_version('Flow')):
+				c.sendString(message)
+
+for (name, broadcast) in (('per-client', per_client), ('indexed', flow.broadcast)):
+	start = time.time()
+	broadcast(message, lambda version: version >= 2)
+	duration = time.time() - start
+	print "%s: %s clients in %.3f s" % (name, count, duration)
@@ -0,0 +1,85 @@
+#!/usr/bin/python2
+#
+#    Ucollect - small utility for real-time analysis of network data
+#    Copyright (C) 2016 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Compare storing a count snapshot with executemany and a re-SELECT of the
+# snapshots (as it used to be) with the INSERT ... RETURNING and COPY of
+# count_plugin.store_counts. It writes real rows into the count_snapshots,
+# counts and capture_stats tables of the configured database, so run it
+# against a testing DB only. It uses up to CLIENT_COUNT clients from the
+# clients table:
+#
+#   ./bench/count_store.py collect-master.conf [CLIENT_COUNT]
+
+import sys
+import os
+import time
+import random
+import datetime
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+del sys.argv[2:] # master_config wants just the config file
+
+import log_extra
+import database
+import count_plugin
+
+def snapshot(clients, types):
+	data = {}
+	stats = {}
+	for client in clients:
+		data[client] = tuple(random.randint(0, 10**9) for i in range(0, 2 * types))
+		stats[client] = tuple(random.randint(0, 10**6) for i in range(0, 6))
+	return (data, stats)
+
+def executemany(data, stats, now, interval):
+	# The original store_counts, with a statement for each row
+	with database.transaction() as t:
+		t.execute('SELECT name, id FROM count_types ORDER BY ord')
+		name_data = t.fetchall()
+		name_order = map(lambda x: x[0], name_data)
+		names = dict(name_data)
+		t.execute('SELECT name, id FROM clients WHERE name IN (' + (','.join(['%s'] * len(data))) + ')', data.keys())
+		clients = dict(t.fetchall())
+		t.executemany('INSERT INTO count_snapshots (timestamp, client) VALUES(%s, %s)', map(lambda client: (now, client), clients.values()))
+		t.execute('SELECT client, id FROM count_snapshots WHERE timestamp = %s', (now,))
+		snapshots = dict(t.fetchall())
+		counts = []
+		captures = []
+		for client in data.keys():
+			snapshot = snapshots[clients[client]]
+			l = min(len(data[client]) / 2, len(name_order))
+			counts.extend(map(lambda name, index: (snapshot, names[name], data[client][index * 2], data[client][index * 2 + 1]), name_order[:l], range(0, l)))
+			captures.extend(map(lambda i: (snapshot, i, stats[client][3 * i], stats[client][3 * i + 1], stats[client][3 * i + 2]), range(0, len(stats[client]) / 3)))
+		t.executemany('INSERT INTO counts(snapshot, type, count, size) VALUES(%s, %s, %s, %s)', counts)
+		t.executemany('INSERT INTO capture_stats(snapshot, interface, captured, dropped, dropped_driver) VALUES(%s, %s, %s, %s, %s)', captures)
+
+with database.transaction() as t:
+	t.execute("SELECT name FROM clients LIMIT %s", (count,))
+	clients = map(lambda (name,): name, t.fetchall())
+	t.execute("SELECT COUNT(*) FROM count_types")
+	(types,) = t.fetchone()
+
+now = database.now()
+# Different timestamps, so the runs don't collide on the count_snapshots unique key
+for (name, store, offset) in (('executemany', executemany, 1), ('copy', count_plugin.store_counts, 2), ('copy again', count_plugin.store_counts, 3)):
+	(data, stats) = snapshot(clients, types)
+	start = time.time()
+	store(data, stats, now + datetime.timedelta(microseconds=offset), 60)
+	print "%s: %s clients in %.3f s" % (name, len(clients), time.time() - start)
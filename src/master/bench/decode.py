@@ -0,0 +1,67 @@
+#!/usr/bin/python2
+#
+#    Ucollect - small utility for real-time analysis of network data
+#    Copyright (C) 2016 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Micro-benchmark of decoding a big flow message. It compares the former
+# slice-and-unpack loop with the memoryview based decoders module.
+#
+#   ./bench/decode.py [FLOW_COUNT]
+
+import sys
+import os
+import time
+import struct
+import socket
+import random
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import decoders
+
+def synthetic_flows(count):
+	result = []
+	for i in range(0, count):
+		v6 = random.randint(0, 1)
+		result.append(struct.pack('!BIIQQHHQQQQ', v6 | 4, 10, 12, 1000, 2000, random.randint(1, 65535), 80, 1, 2, 3, 4))
+		result.append(os.urandom(32 if v6 else 8))
+	return ''.join(result)
+
+def slicing(message):
+	result = []
+	while message:
+		(flow, message) = (message[:61], message[61:])
+		fields = struct.unpack('!BIIQQHHQQQQ', flow)
+		if fields[0] & 1:
+			(size, tp) = (16, socket.AF_INET6)
+		else:
+			(size, tp) = (4, socket.AF_INET)
+		(aloc, arem, message) = (message[:size], message[size:2 * size], message[2 * size:])
+		result.append(fields + tuple(map(lambda addr: socket.inet_ntop(tp, addr), (aloc, arem))))
+	return result
+
+def views(message):
+	return list(decoders.flows(message))
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+message = synthetic_flows(count)
+results = {}
+for (name, decoder) in (('slicing', slicing), ('memoryview', views)):
+	start = time.time()
+	results[name] = decoder(message)
+	print "%s: %s flows decoded in %.3f s" % (name, count, time.time() - start)
+assert results['slicing'] == results['memoryview']
@@ -0,0 +1,112 @@
+#!/usr/bin/python2
+#
+#    Ucollect - small utility for real-time analysis of network data
+#    Copyright (C) 2016 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Measure how late the reactor is (that's how late the pongs would be)
+# while the flow plugin decodes a heavy stream of flows. The flows are
+# decoded by plugin.decode_rows, once in the threads and once in the
+# decoder processes, and pickled as for the spool, but not stored
+# anywhere. The decoder processes need a free CPU each to help, run it
+# on a machine with enough of them. A probe is scheduled
+# every 10 ms and the delay over that is the lag. Each variant runs in its
+# own process:
+#
+#   ./bench/decode_latency.py collect-master.conf [DECODE_WORKERS] [FLOWS_PER_SECOND] [SECONDS]
+
+import sys
+import os
+import time
+import struct
+import random
+import datetime
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+workers = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+rate = int(sys.argv[3]) if len(sys.argv) > 3 else 100000
+seconds = float(sys.argv[4]) if len(sys.argv) > 4 else 10
+del sys.argv[2:] # master_config wants just the config file
+
+import log_extra
+import cPickle
+import plugin
+import spool
+import flow_plugin
+from twisted.internet import reactor
+
+message_size = 10000 # flows
+probe_interval = 0.01
+
+def synthetic_flows(count, calib_time):
+	"""
+	Build the payload of a 'D' message (without the opcode) with count IPv4 flows.
+	"""
+	result = [struct.pack('!IQ', 1, calib_time)]
+	for i in range(0, count):
+		t = calib_time - random.randint(1, 3600000)
+		result.append(struct.pack('!BIIQQHHQQQQ', 4 | 8, 10, 12, 1000, 2000, random.randint(1, 65535), 80, t, t, t + 10, t + 10))
+		result.append(struct.pack('!4s4s', os.urandom(4), os.urandom(4)))
+	return ''.join(result)
+
+def percentile(values, p):
+	return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def run(workers):
+	message = synthetic_flows(message_size, 10 * 86400000)
+	now = datetime.datetime.utcnow() # Not database.now(), no need for the DB
+	decoded = [0]
+	def store(kind, client, rows):
+		cPickle.dumps((kind, client, rows), cPickle.HIGHEST_PROTOCOL) # As the spool does
+		decoded[0] += len(rows)
+	def store_packed(payload):
+		decoded[0] += message_size
+	(spool.store, spool.store_packed) = (store, store_packed)
+	reactor.suggestThreadPoolSize(3) # As the master does
+	plugin.start_decoders(workers)
+	lags = []
+	start = time.time()
+	def probe(expected):
+		t = time.time()
+		lags.append(t - expected)
+		if t - start < seconds:
+			reactor.callLater(probe_interval, probe, t + probe_interval)
+		else:
+			reactor.stop()
+	def load(sent):
+		# Keep up with the rate, even if the reactor is late
+		while sent * message_size < (time.time() - start) * rate:
+			flow_plugin.queue_flows('client', message, 1, now)
+			sent += 1
+		reactor.callLater(0.05, load, sent)
+	reactor.callLater(probe_interval, probe, start + probe_interval)
+	reactor.callLater(0, load, 0)
+	reactor.run()
+	duration = time.time() - start
+	plugin.stop_decoders()
+	plugin.pool.stop()
+	lags.sort()
+	print "%s decode workers: %.0f flows/s decoded, lag p50 %.1f ms, p99 %.1f ms, max %.1f ms" % (workers, decoded[0] / duration, percentile(lags, 50) * 1000, percentile(lags, 99) * 1000, lags[-1] * 1000)
+
+print "Offering %s flows/s for %s s" % (rate, seconds)
+for count in (0, workers):
+	sys.stdout.flush()
+	pid = os.fork()
+	if pid == 0:
+		run(count)
+		sys.stdout.flush()
+		os._exit(0)
+	os.waitpid(pid, 0)
@@ -0,0 +1,63 @@
+#!/usr/bin/python2
+#
+#    Ucollect - small utility for real-time analysis of network data
+#    Copyright (C) 2016 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Compare the rows/sec of the two flow ingestion paths of the flow plugin.
+# It writes real rows into the biflows table of the configured database,
+# so run it against a testing DB only:
+#
+#   ./bench/flow_ingest.py collect-master.conf CLIENT_NAME [FLOW_COUNT]
+#
+# The client must exist in the clients table.
+
+import sys
+import os
+import time
+import struct
+import random
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+client = sys.argv[2]
+count = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+del sys.argv[2:] # master_config wants just the config file
+
+import database
+import flow_plugin
+import decoders
+import spool
+
+def synthetic_flows(count, calib_time):
+	"""
+	Build the payload of a 'D' message (without the opcode) with count IPv4 flows.
+	"""
+	result = [struct.pack('!IQ', 1, calib_time)]
+	for i in range(0, count):
+		t = calib_time - random.randint(1, 3600000)
+		result.append(struct.pack('!BIIQQHHQQQQ', 4 | 8, 10, 12, 1000, 2000, random.randint(1, 65535), 80, t, t, t + 10, t + 10))
+		result.append(struct.pack('!4s4s', os.urandom(4), os.urandom(4)))
+	return ''.join(result)
+
+calib_time = 10 * 86400000
+message = synthetic_flows(count, calib_time)
+for (ingest, handler) in (('insert', flow_plugin.insert_flows), ('copy', flow_plugin.copy_flows)):
+	# No spool is started, so the data go directly to the DB
+	spool.register('flow', handler)
+	start = time.time()
+	spool.store('flow', client, flow_plugin.decode_flows(client, message, decoders.flow_header.size, calib_time, database.now()))
+	duration = time.time() - start
+	print "%s: %s flows in %.3f s, %.0f rows/s" % (ingest, count, duration, count / duration)
@@ -0,0 +1,83 @@
+#!/usr/bin/python2
+#
+#    Ucollect - small utility for real-time analysis of network data
+#    Copyright (C) 2016 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Measure how many routed ('R') messages per second get from a received
+# frame to a plugin. The copying way (as ClientConn.stringReceived used to
+# do it) is compared with passing the frame and the offset of the data.
+# The plugin only peeks at the start of the message, like the flow plugin
+# does before passing it to a thread:
+#
+#   ./bench/route.py collect-master.conf [SMALL_COUNT] [LARGE_COUNT]
+
+import sys
+import os
+import time
+import logging
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+small_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+large_count = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+del sys.argv[2:] # master_config wants just the config file
+
+import log_extra
+import plugin
+import protocol
+import decoders
+
+logger = logging.getLogger(name='route')
+logger.setLevel(logging.INFO)
+
+class Flow(plugin.Plugin):
+	def name(self):
+		return 'Flow'
+
+	def message_from_client(self, message, client):
+		if message[0] == 'D':
+			decoders.flow_header.unpack_from(message, 1)
+
+	def message_from_client_buffer(self, buf, offset, client):
+		if buf[offset] == 'D':
+			decoders.flow_header.unpack_from(buf, offset + 1)
+
+plugins = plugin.Plugins()
+flow = Flow(plugins)
+route_table = {'Flow': flow}
+
+def copying(string):
+	(msg, params) = (string[0], string[1:])
+	logger.trace("Received from %s: %s", 'client', repr(string))
+	if msg == 'R':
+		(name, data) = protocol.extract_string(params)
+		route_table[name].message_from_client(data, 'client')
+
+def in_place(string):
+	msg = string[0]
+	logger.trace("Received from %s: %r", 'client', string)
+	if msg == 'R':
+		(name, offset) = protocol.extract_string_at(string, 1)
+		plugins.route_to_plugin(name, string, 'client', offset)
+
+header = 'R' + protocol.format_string('Flow') + 'D' + decoders.flow_header.pack(1, 0)
+for (size, count, message) in (('small', small_count, header + 'x' * 8), ('large', large_count, header + os.urandom(1024 * 1024))):
+	for (name, route) in (('copying', copying), ('in place', in_place)):
+		start = time.time()
+		for i in xrange(0, count):
+			route(message)
+		duration = time.time() - start
+		print "%s %s: %s messages of %s bytes in %.3f s, %.0f messages/s" % (size, name, count, len(message), duration, count / duration)
@@ -0,0 +1,126 @@
+#!/usr/bin/python2
+#
+#    Ucollect - small utility for real-time analysis of network data
+#    Copyright (C) 2016 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Measure the spool throughput and check it survives a crash and a DB outage.
+# It doesn't touch the DB, the spool is replayed into a fake transaction in
+# a temporary directory:
+#
+#   ./bench/spool_replay.py collect-master.conf [RECORD_COUNT]
+
+import sys
+import os
+import time
+import shutil
+import tempfile
+import psycopg2
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+del sys.argv[2:] # master_config wants just the config file
+
+import spool
+
+class Transaction:
+	"""
+	Collects the replayed records instead of storing them. It fails with
+	OperationalError while outages is positive, to simulate the DB being down.
+	"""
+	def __init__(self):
+		self.delivered = []
+		self.outages = 0
+
+	def __call__(self):
+		return self
+
+	def __enter__(self):
+		if self.outages > 0:
+			self.outages -= 1
+			raise psycopg2.OperationalError('Simulated DB outage')
+		self.pending = []
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		if exc_type is None:
+			self.delivered.extend(self.pending)
+		return False
+
+	def handler(self, transaction, client, rows):
+		transaction.pending.append((client, rows[0][0]))
+
+def drain_all(s):
+	while True:
+		replayed = s.drain()
+		if replayed == 0:
+			return
+
+directory = tempfile.mkdtemp(prefix='spool-bench-')
+try:
+	rows = [(0, 1, 'x' * 40, 80, 443)] * 20
+	# Throughput. Small segments, to include the rotation.
+	t = Transaction()
+	s = spool.Spool(directory, 4 * 1024 * 1024, 100, t, {'bench': t.handler})
+	start = time.time()
+	for i in range(0, count):
+		s.store('bench', 'client', [(i,)] + rows)
+	stored = time.time() - start
+	start = time.time()
+	drain_all(s)
+	replayed = time.time() - start
+	s.stop()
+	print "store: %s records in %.3f s, %.0f records/s" % (count, stored, count / stored)
+	print "replay: %s records in %.3f s, %.0f records/s" % (count, replayed, count / replayed)
+	assert len(t.delivered) == count
+
+	# Crash in the middle of the replay and in the middle of writing a record
+	t = Transaction()
+	s = spool.Spool(directory, 64 * 1024, 10, t, {'bench': t.handler})
+	for i in range(0, 1000):
+		s.store('bench', 'client', [(i,)])
+	for i in range(0, 37):
+		s.drain()
+	# Find the end of the data in the last segment and put a half-written record there
+	segments = sorted(filter(lambda name: name.endswith('.seg'), os.listdir(directory)))
+	with open(os.path.join(directory, segments[-1]), 'r+b') as f:
+		data = f.read()
+		offset = 0
+		while True:
+			(length, crc) = spool.header.unpack_from(data, offset)
+			if not length:
+				break
+			offset += spool.header.size + length
+		f.seek(offset)
+		f.write(spool.header.pack(80, 42) + 'torn')
+	del s # No stop(), the process "crashed"
+	# Start again, with the DB down for a while
+	t.outages = 5
+	s = spool.Spool(directory, 64 * 1024, 10, t, {'bench': t.handler})
+	failed = 0
+	while True:
+		replayed = s.drain()
+		if replayed is None:
+			failed += 1
+		elif replayed == 0:
+			break
+	s.stop()
+	delivered = set(map(lambda (client, i): i, t.delivered))
+	assert failed == 5
+	assert delivered == set(range(0, 1000)), "Lost %s records" % (1000 - len(delivered))
+	print "recovery: all 1000 records delivered, %s of them twice" % (len(t.delivered) - 1000)
+finally:
+	shutil.rmtree(directory)
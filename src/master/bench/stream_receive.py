@@ -0,0 +1,138 @@
+#!/usr/bin/python2
+#
+#    Ucollect - small utility for real-time analysis of network data
+#    Copyright (C) 2016 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Measure the peak memory of receiving a large flow message. The frame is
+# fed in pieces, as from the network, to the Int32StringReceiver (as it
+# used to be), to protocol.Framer receiving it whole and to the Framer
+# streaming it into decoders.Batches. The flows are decoded into a list
+# of tuples (as flow_plugin.decode_flows does), but not stored anywhere. Each variant
+# runs in its own process, so the peaks don't mix:
+#
+#   ./bench/stream_receive.py collect-master.conf [MEGABYTES] [CHUNK_SIZE]
+
+import sys
+import os
+import time
+import struct
+import resource
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+megabytes = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+chunk_size = int(sys.argv[3]) if len(sys.argv) > 3 else 65536
+del sys.argv[2:] # master_config wants just the config file
+
+import twisted.protocols.basic
+import plugin
+import protocol
+import decoders
+
+# A block of IPv4 and IPv6 flows, repeated to fill the message
+block = ''
+for i in range(0, 10000):
+	v6 = i % 4 == 0
+	block += decoders.flow_record.pack(1 if v6 else 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10) + os.urandom(32 if v6 else 8)
+body_len = decoders.flow_header.size + len(block) * (megabytes * 1024 * 1024 / len(block))
+header = 'R' + protocol.format_string('Flow') + 'D'
+frame_len = len(header) + body_len
+
+def chunks():
+	"""
+	The frame in pieces of chunk_size bytes, generated on the fly.
+	"""
+	data = struct.pack('!L', frame_len) + header + decoders.flow_header.pack(1, 0)
+	while len(data) < chunk_size:
+		data += block
+	left = 4 + frame_len
+	while left > 0:
+		while len(data) < chunk_size and len(data) < left:
+			data += block
+		piece = data[:min(chunk_size, left)]
+		data = data[len(piece):]
+		left -= len(piece)
+		yield piece
+
+decoded = [0]
+
+def decode(message, offset=0):
+	values = list(decoders.flows(message, offset))
+	decoded[0] += len(values)
+
+class Flow(plugin.Plugin):
+	def __init__(self, plugins, stream):
+		plugin.Plugin.__init__(self, plugins)
+		self.__stream = stream
+
+	def name(self):
+		return 'Flow'
+
+	def message_from_client(self, message, client):
+		decode(message[1:], decoders.flow_header.size)
+
+	def message_stream(self, kind, length, client):
+		if not self.__stream:
+			return None
+		state = {'header': True}
+		def batch(data):
+			if state['header']:
+				state['header'] = False
+				decode(data, decoders.flow_header.size)
+			else:
+				decode(data)
+		# The first batch starts with the header, skip it
+		return decoders.Batches(lambda buf: decoders.flows_end(buf, decoders.flow_header.size if state['header'] else 0), batch, lambda left: None)
+
+class Receiver(twisted.protocols.basic.Int32StringReceiver):
+	MAX_LENGTH = 1024 ** 3
+
+	def __init__(self, plugins):
+		self.__plugins = plugins
+
+	def stringReceived(self, string):
+		(plugin_name, data) = protocol.extract_string(string[1:])
+		self.__plugins.route_to_plugin(plugin_name, data, 'client')
+
+def run(name):
+	plugins = plugin.Plugins()
+	Flow(plugins, name == 'streamed')
+	if name == 'int32stringreceiver':
+		feed = Receiver(plugins).dataReceived
+	else:
+		def received(frame):
+			(plugin_name, data) = protocol.extract_string(frame[1:])
+			plugins.route_to_plugin(plugin_name, data, 'client')
+		def start(plugin_name, kind, length):
+			return plugins.stream_to_plugin(plugin_name, kind, length, 'client')
+		feed = protocol.Framer(received, start, None, 1024 ** 3, 1024 * 1024).feed
+	base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	start = time.time()
+	for piece in chunks():
+		feed(piece)
+	duration = time.time() - start
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+	print "%s: %s flows in %.3f s, peak memory +%.0f MB" % (name, decoded[0], duration, peak / 1024.0)
+
+print "Frame of %.0f MB in pieces of %s bytes" % (frame_len / 1048576.0, chunk_size)
+for name in ('int32stringreceiver', 'buffered', 'streamed'):
+	sys.stdout.flush()
+	pid = os.fork()
+	if pid == 0:
+		run(name)
+		sys.stdout.flush()
+		os._exit(0)
+	os.waitpid(pid, 0)
@@ -22,7 +22,8 @@ import twisted.internet.protocol
 import twisted.protocols.basic
 import random
 import struct
-from protocol import extract_string, format_string
+from protocol import extract_string, extract_string_at, format_string, Framer
+from master_config import getint
 import logging
 import activity
 import auth
@@ -30,17 +31,23 @@ import time
 import plugin_versions
 import database
 import timers
+import client_cache
+import latency
 
 logger = logging.getLogger(name='client')
 sysrand = random.SystemRandom()
 challenge_len = 128 # 128 bits of random should be enough for log-in to protect against replay attacks
+stream_threshold = getint('stream_threshold', 1024 * 1024)
 
-with database.transaction() as t:
-	# As we just started, there's no plugin active anywhere.
-	# Mark anything active as no longer active in the history and
-	# flush the active ones.
-	t.execute("INSERT INTO plugin_history (client, name, timestamp, active) SELECT client, name, CURRENT_TIMESTAMP AT TIME ZONE 'UTC', false FROM active_plugins")
-	t.execute("DELETE FROM active_plugins")
+def reset_active_plugins():
+	"""
+	As we just started, there's no plugin active anywhere. Mark anything
+	active as no longer active in the history and flush the active ones.
+	Call once when the master starts (not in each of the shard workers).
+	"""
+	with database.transaction() as t:
+		t.execute("INSERT INTO plugin_history (client, name, timestamp, active) SELECT client, name, CURRENT_TIMESTAMP AT TIME ZONE 'UTC', false FROM active_plugins")
+		t.execute("DELETE FROM active_plugins")
 
 class ClientConn(twisted.protocols.basic.Int32StringReceiver):
 	MAX_LENGTH = 1024 ** 3 # A gigabyte should be enough
@@ -54,6 +61,7 @@ class ClientConn(twisted.protocols.basic.Int32StringReceiver):
 		self.__plugins = plugins
 		self.__addr = addr
 		self.__pings_outstanding = 0
+		self.__ping_sent = None # When the oldest unanswered ping was sent
 		self.__logged_in = False
 		self.__authenticated = False
 		self.__cid = None
@@ -70,6 +78,7 @@ class ClientConn(twisted.protocols.basic.Int32StringReceiver):
 		self.__plugin_versions = {}
 		self.last_pong = time.time()
 		self.session_id = None
+		self.__framer = Framer(self.stringReceived, self.__stream_start, self.lengthLimitExceeded, self.MAX_LENGTH, stream_threshold)
 
 	def has_plugin(self, plugin_name):
 		return plugin_name in self.__available_plugins
@@ -77,6 +86,26 @@ class ClientConn(twisted.protocols.basic.Int32StringReceiver):
 	def plugin_version(self, plugin_name):
 		return self.__available_plugins.get(plugin_name)
 
+	def send_frame(self, frame):
+		"""
+		Send an already length-prefixed message (see protocol.format_string).
+		Used to send the same message to many clients without framing it
+		for each of them.
+		"""
+		self.transport.write(frame)
+
+	def dataReceived(self, data):
+		# We do the framing ourselves, see protocol.Framer
+		self.__framer.feed(data)
+
+	def __stream_start(self, plugin, kind, length):
+		if not self.__logged_in or self.__wait_auth:
+			return None
+		stream = self.__plugins.stream_to_plugin(plugin, kind, length, self.cid())
+		if stream is not None:
+			logger.debug("Streaming %s bytes from %s to %s", length, self.cid(), plugin)
+		return stream
+
 	def __ping(self):
 		"""
 		Send a ping every now and then, to see the client is
@@ -85,6 +114,8 @@ class ClientConn(twisted.protocols.basic.Int32StringReceiver):
 		"""
 		if self.__pings_outstanding >= 3:
 			self.transport.abortConnection()
+		if not self.__pings_outstanding:
+			self.__ping_sent = time.time()
 		self.__pings_outstanding += 1
 		self.sendString('P')
 
@@ -98,6 +129,7 @@ class ClientConn(twisted.protocols.basic.Int32StringReceiver):
 		reactor.callLater(60, self.__check_logged)
 
 	def connectionLost(self, reason):
+		self.__framer.abort()
 		if not self.__connected:
 			return
 		self.__connected = False
@@ -108,8 +140,11 @@ class ClientConn(twisted.protocols.basic.Int32StringReceiver):
 			now = database.now()
 			def log_plugins(transaction):
 				logger.debug("Dropping plugin list of %s", self.cid())
-				transaction.execute("INSERT INTO plugin_history (client, name, timestamp, active) SELECT ap.client, ap.name, %s, false FROM active_plugins AS ap JOIN clients ON ap.client = clients.id WHERE clients.name = %s", (now, self.cid()))
-				transaction.execute('DELETE FROM active_plugins WHERE client IN (SELECT id FROM clients WHERE name = %s)', (self.cid(),))
+				client_id = client_cache.get(transaction, self.cid())
+				if client_id is None:
+					return True
+				transaction.execute("INSERT INTO plugin_history (client, name, timestamp, active) SELECT client, name, %s, false FROM active_plugins WHERE client = %s", (now, client_id))
+				transaction.execute('DELETE FROM active_plugins WHERE client = %s', (client_id,))
 				return True
 			activity.push(log_plugins)
 			activity.log_activity(self.cid(), "logout")
@@ -125,8 +160,15 @@ class ClientConn(twisted.protocols.basic.Int32StringReceiver):
 		if self.__wait_auth:
 			self.__auth_buffer.append(string)
 			return
-		(msg, params) = (string[0], string[1:])
-		logger.trace("Received from %s: %s", self.cid(), repr(string))
+		msg = string[0]
+		logger.trace("Received from %s: %r", self.cid(), string)
+		if msg == 'R' and self.__logged_in: # Route data to a plugin
+			# It is the bulk of the traffic, pass the whole frame with the offset of the data, without copying it
+			(plugin, offset) = extract_string_at(string, 1)
+			self.__plugins.route_to_plugin(plugin, string, self.cid(), offset)
+			# TODO: Handle the possibility the plugin doesn't exist somehow (#2705)
+			return
+		params = string[1:]
 		if not self.__logged_in:
 			def login_failure(msg):
 				logger.warn('Login failure from %s: %s', self.cid(), msg)
@@ -182,6 +224,8 @@ class ClientConn(twisted.protocols.basic.Int32StringReceiver):
 							# Please tell me when there're changes to the allowed plugins
 							plugin_versions.add_client(self)
 						self.__logged_in = True
+						cid = self.cid()
+						activity.push(lambda transaction: client_cache.prefetch(transaction, cid))
 						self.__pinger = timers.timer(self.__ping, 45 if self.cid() in self.__fastpings else 120, False)
 						activity.log_activity(self.cid(), "login")
 						logger.info('Client %s logged in', self.cid())
@@ -201,10 +245,9 @@ class ClientConn(twisted.protocols.basic.Int32StringReceiver):
 		elif msg == 'p': # Pong. Reset the watchdog count
 			self.__pings_outstanding = 0
 			self.last_pong = time.time()
-		elif msg == 'R': # Route data to a plugin
-			(plugin, data) = extract_string(params)
-			self.__plugins.route_to_plugin(plugin, data, self.cid())
-			# TODO: Handle the possibility the plugin doesn't exist somehow (#2705)
+			if self.__ping_sent is not None:
+				latency.pong(self.cid(), self.last_pong - self.__ping_sent)
+				self.__ping_sent = None
 		elif msg == 'V': # New list of versions of the client
 			if self.__proto_version == 0:
 				self.__available_plugins = {}
@@ -213,6 +256,7 @@ class ClientConn(twisted.protocols.basic.Int32StringReceiver):
 					(version,) = struct.unpack('!H', params[:2])
 					self.__available_plugins[name] = version
 					params = params[2:]
+				self.__plugins.reindex_client(self)
 			else:
 				self.__handle_versions(params)
 		else:
@@ -242,10 +286,13 @@ class ClientConn(twisted.protocols.basic.Int32StringReceiver):
 		def log_versions(transaction):
 			logger.debug("Replacing plugin list of %s", self.cid())
 			# The current state (override anything previous)
-			transaction.execute('DELETE FROM active_plugins WHERE client IN (SELECT id FROM clients WHERE name = %s)', (self.cid(),))
-			transaction.executemany("INSERT INTO active_plugins (client, name, updated, version, hash, libname, active) SELECT clients.id, %s, %s, %s, %s, %s, %s FROM clients WHERE clients.name = %s", map(lambda plug: (plug['name'], now, plug['version'], plug['hash'].encode('hex'), plug['lib'], plug['activity'], self.cid()), versions.values()))
+			client_id = client_cache.get(transaction, self.cid())
+			if client_id is None:
+				return True
+			transaction.execute('DELETE FROM active_plugins WHERE client = %s', (client_id,))
+			transaction.executemany("INSERT INTO active_plugins (client, name, updated, version, hash, libname, active) VALUES (%s, %s, %s, %s, %s, %s, %s)", map(lambda plug: (client_id, plug['name'], now, plug['version'], plug['hash'].encode('hex'), plug['lib'], plug['activity']), versions.values()))
 			# The history, just append (yes, there may be duplicates, but who cares)
-			transaction.executemany("INSERT INTO plugin_history (client, name, timestamp, version, hash, active) SELECT clients.id, %s, %s, %s, %s, %s FROM clients WHERE clients.name = %s", map(lambda plug: (plug['name'], now, plug['version'], plug['hash'].encode('hex'), plug['activity'], self.cid()), versions.values()))
+			transaction.executemany("INSERT INTO plugin_history (client, name, timestamp, version, hash, active) VALUES (%s, %s, %s, %s, %s, %s)", map(lambda plug: (client_id, plug['name'], now, plug['version'], plug['hash'].encode('hex'), plug['activity']), versions.values()))
 			return True
 		activity.push(log_versions)
 
@@ -0,0 +1,111 @@
+#
+#    Ucollect - small utility for real-time analysis of network data
+#    Copyright (C) 2016 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Process-wide cache mapping client names to their IDs in the clients table.
+
+The storage functions insert the IDs directly instead of letting the DB
+resolve the name of the client on every single insert. The cache may be
+used from any thread. It is filled when a client logs in and on a miss.
+
+A client may be deleted or renamed in the DB. The entries expire after a
+while and with the DB notifications, the changed clients are dropped
+right away.
+"""
+
+import threading
+import logging
+import time
+import timers
+import notify
+
+logger = logging.getLogger(name='client_cache')
+
+__lock = threading.Lock()
+__cache = {} # name -> (id, expiration time)
+__hits = 0
+__misses = 0
+__ttl = 300
+__stats_logger = None
+
+def get(transaction, name):
+	"""
+	Return the ID of the client with the given name, or None if there's
+	no such client. On a cache miss the ID is looked up through the
+	given transaction (a cursor of database.transaction()).
+	"""
+	global __hits
+	global __misses
+	with __lock:
+		entry = __cache.get(name)
+		if entry is not None and entry[1] > time.time():
+			__hits += 1
+			return entry[0]
+		__misses += 1
+	transaction.execute("SELECT id FROM clients WHERE name = %s", (name,))
+	row = transaction.fetchone()
+	if not row:
+		logger.warn("Client %s not found in the DB", name)
+		return None
+	(result,) = row
+	with __lock:
+		__cache[name] = (result, time.time() + __ttl)
+	return result
+
+def prefetch(transaction, name):
+	"""
+	Make sure the ID of the client is in the cache. Suitable to be passed
+	(wrapped in a lambda) to activity.push.
+	"""
+	get(transaction, name)
+	return True
+
+def stats():
+	"""
+	Return the (hits, misses, size) triplet of the cache.
+	"""
+	with __lock:
+		return (__hits, __misses, len(__cache))
+
+def __log_stats():
+	(hits, misses, size) = stats()
+	logger.info("Client ID cache: %s hits, %s misses, %s clients", hits, misses, size)
+
+def __notified(name):
+	"""
+	The client of the name was changed or deleted in the DB. All of them,
+	if the name is not known.
+	"""
+	with __lock:
+		if name:
+			__cache.pop(name, None)
+		else:
+			__cache.clear()
+
+def start():
+	"""
+	Start logging the statistics and watching for the changes of the
+	clients. Call before notify.start().
+	"""
+	global __ttl
+	global __stats_logger
+	if notify.enabled():
+		notify.subscribe('clients', __notified)
+		__ttl = notify.fallback_interval(__ttl)
+	__stats_logger = timers.timer(__log_stats, 900, False)
@@ -18,6 +18,12 @@
 #    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import master_config
+import shard
+# Fork the shard workers (if configured) first, before there's any reactor,
+# thread or DB connection to share with them.
+shard.fork('./collect-master.sock')
+
 from twisted.internet import reactor, protocol
 from twisted.internet.endpoints import UNIXServerEndpoint
 from twisted.internet.error import ReactorNotRunning
@@ -25,13 +31,19 @@ from subprocess import Popen
 import log_extra
 import logging
 import logging.handlers
-from client import ClientFactory
-from plugin import Plugins, pool
-import master_config
+from client import ClientFactory, reset_active_plugins
+from plugin import Plugins, pool, start_decoders, stop_decoders
+import shard_control
 import activity
+import spool
+import client_cache
+import notify
+import latency
 import importlib
 import os
 
+worker = shard.worker_index()
+
 # If we have too many background threads, the GIL slows down the
 # main thread and cleants start dropping because we are not able
 # to keep up with pings.
@@ -42,22 +54,46 @@ if severity == 'TRACE':
 else:
 	severity = getattr(logging, severity)
 log_file = master_config.get('log_file')
+if log_file != '-' and worker is not None:
+	log_file += '.worker-' + str(worker) # Each one rotates its own log
 logging.basicConfig(level=severity, format=master_config.get('log_format'))
 if log_file != '-':
 	handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=int(master_config.get('log_file_size')), backupCount=int(master_config.get('log_file_count')))
 	handler.setFormatter(logging.Formatter(fmt=master_config.get('log_format')))
 	logging.getLogger().addHandler(handler)
 
+# Fork the decoders before we connect to the DB or start any thread
+start_decoders(master_config.getint('decode_workers', 0))
+pool.start()
+
+if worker is None:
+	reset_active_plugins()
+	plugins = Plugins()
+else:
+	plugins = shard_control.WorkerPlugins()
 loaded_plugins = {}
-plugins = Plugins()
 for (plugin, config) in master_config.plugins().items():
+	if not shard.hosts(plugin):
+		continue
 	(modulename, classname) = plugin.rsplit('.', 1)
 	module = importlib.import_module(modulename)
 	constructor = getattr(module, classname)
 	loaded_plugins[plugin] = constructor(plugins, config)
 	logging.info('Loaded plugin %s from %s', loaded_plugins[plugin].name(), plugin)
-# Some configuration, to load the port from?
-endpoint = UNIXServerEndpoint(reactor, './collect-master.sock')
+client_cache.start()
+factory = ClientFactory(plugins, frozenset(master_config.get('fastpings').split()))
+coordinator = None
+if shard.coordinator():
+	# The workers store the data. We start listening for the DB
+	# notifications once they tell us what they are interested in.
+	coordinator = shard_control.Coordinator(plugins)
+else:
+	# All the spool handlers are registered by the plugins now
+	spool.start(None if worker is None else 'worker-' + str(worker))
+	notify.start()
+	if worker is not None:
+		# It starts accepting clients once the coordinator is ready
+		shard_control.Coordinated(plugins, factory)
 
 socat = None
 
@@ -85,17 +121,27 @@ class Socat(protocol.ProcessProtocol):
 #args = ['./soxy/soxy', master_config.get('cert'), master_config.get('key'), str(master_config.getint('port')), os.getcwd() + '/collect-master.sock']
 #logging.debug('Starting proxy with: %s', args)
 #reactor.spawnProcess(Socat(), './soxy/soxy', args=args, env=os.environ)
-args = ['./soxy/soxy', master_config.get('cert'), master_config.get('key'), master_config.get('ca'), str(master_config.getint('port_compression')), os.getcwd() + '/collect-master.sock', 'compress']
-logging.debug('Starting proxy with: %s', args)
-reactor.spawnProcess(Socat(), './soxy/soxy', args=args, env=os.environ)
+if worker is None:
+	args = ['./soxy/soxy', master_config.get('cert'), master_config.get('key'), master_config.get('ca'), str(master_config.getint('port_compression')), os.getcwd() + '/collect-master.sock', 'compress']
+	logging.debug('Starting proxy with: %s', args)
+	reactor.spawnProcess(Socat(), './soxy/soxy', args=args, env=os.environ)
 
-endpoint.listen(ClientFactory(plugins, frozenset(master_config.get('fastpings').split())))
+if not shard.sharded():
+	# Some configuration, to load the port from?
+	endpoint = UNIXServerEndpoint(reactor, './collect-master.sock')
+	endpoint.listen(factory)
+latency.start()
 logging.info('Init done')
 
 reactor.run()
 
 logging.info('Finishing up')
+if coordinator:
+	coordinator.stop()
 pool.stop()
+stop_decoders()
+spool.stop()
+notify.stop()
 if socat:
 	soc = socat
 	socat = None
@@ -28,41 +28,96 @@ import timers
 
 logger = logging.getLogger(name='count')
 
-def store_counts(data, stats, now):
+def truncate(data, limit):
+	if data > 2**limit-1:
+		logger.warn("Number %s overflow, truncating to %s", data, 2**limit-1)
+		return 2**limit-1
+	else:
+		return data
+
+def count_rows(data, snapshots, name_order, names):
+	"""
+	Generate the COPY lines for the counts table, client by client.
+	"""
+	for (client, values) in data.iteritems():
+		snapshot = snapshots.get(client)
+		if snapshot is None:
+			continue
+		for index in xrange(0, min(len(values) / 2, len(name_order))):
+			yield '%s\t%s\t%s\t%s\n' % (snapshot, names[name_order[index]], truncate(values[index * 2], 63), truncate(values[index * 2 + 1], 63))
+
+def capture_rows(stats, snapshots):
+	"""
+	Generate the COPY lines for the capture_stats table, client by client.
+	"""
+	for (client, values) in stats.iteritems():
+		snapshot = snapshots.get(client)
+		if snapshot is None:
+			continue
+		for i in xrange(0, len(values) / 3):
+			yield '%s\t%s\t%s\t%s\t%s\n' % (snapshot, i, truncate(values[3 * i], 31), truncate(values[3 * i + 1], 31), truncate(values[3 * i + 2], 31))
+
+class LineStream:
+	"""
+	A read-only file of the generated lines, for copy_from. The lines
+	are generated as COPY reads them, so they are never all in memory.
+	"""
+	def __init__(self, lines):
+		self.__lines = iter(lines)
+		self.__pending = ''
+
+	def read(self, size=-1):
+		parts = [self.__pending]
+		length = len(self.__pending)
+		while size < 0 or length < size:
+			line = next(self.__lines, None)
+			if line is None:
+				break
+			parts.append(line)
+			length += len(line)
+		data = ''.join(parts)
+		if size < 0 or length <= size:
+			self.__pending = ''
+			return data
+		self.__pending = data[size:]
+		return data[:size]
+
+	def readline(self, size=-1):
+		if '\n' not in self.__pending:
+			self.__pending += next(self.__lines, '')
+		(line, separator, self.__pending) = self.__pending.partition('\n')
+		return line + separator
+
+def copy_rows(transaction, rows, table, columns):
+	transaction.copy_from(LineStream(rows), table, columns=columns)
+
+def store_counts(data, stats, now, interval):
+	"""
+	Store one snapshot of all the clients. The clients are resolved by a
+	single query, the snapshots are created by a single INSERT ... RETURNING
+	and the counts and capture stats are streamed in by COPY.
+	"""
 	logger.info('Storing count snapshot')
+	start = time.time()
 	with database.transaction() as t:
 		t.execute('SELECT name, id FROM count_types ORDER BY ord')
 		name_data = t.fetchall()
 		name_order = map(lambda x: x[0], name_data)
 		names = dict(name_data)
-		# It seems MySQL complains with insert ... select in some cases.
-		# So we do some insert-select-insert magic here. That is probably
-		# slower, but no idea how to help that. And it should work.
-		t.execute('SELECT name, id FROM clients WHERE name IN (' + (','.join(['%s'] * len(data))) + ')', data.keys())
-		clients = dict(t.fetchall())
-		# Create a snapshot for each client
-		t.executemany('INSERT INTO count_snapshots (timestamp, client) VALUES(%s, %s)', map(lambda client: (now, client), clients.values()))
-		t.execute('SELECT client, id FROM count_snapshots WHERE timestamp = %s', (now,))
-		snapshots = dict(t.fetchall())
+		t.execute('SELECT name, id FROM clients WHERE name = ANY(%s)', (data.keys(),))
+		clients = t.fetchall()
+		# Create a snapshot for each client, getting the IDs back in the same statement
+		t.execute('INSERT INTO count_snapshots (timestamp, client) SELECT %s, unnest(%s::INT[]) RETURNING client, id', (now, map(lambda (name, client_id): client_id, clients)))
+		ids = dict(t.fetchall())
+		snapshots = dict(map(lambda (name, client_id): (name, ids[client_id]), clients))
 		# Push all the data in
-		def truncate(data, limit):
-			if data > 2**limit-1:
-				logger.warn("Number %s overflow, truncating to %s", data, 2**limit-1)
-				return 2**limit-1
-			else:
-				return data
-		def clientdata(client):
-			snapshot = snapshots[clients[client]]
-			l = min(len(data[client]) / 2, len(name_order))
-			return map(lambda name, index: (snapshot, names[name], truncate(data[client][index * 2], 63), truncate(data[client][index * 2 + 1], 63)), name_order[:l], range(0, l))
-		def clientcaptures(client):
-			snapshot = snapshots[clients[client]]
-			return map(lambda i: (snapshot, i, truncate(stats[client][3 * i], 31), truncate(stats[client][3 * i + 1], 31), truncate(stats[client][3 * i + 2], 31)), range(0, len(stats[client]) / 3))
-		def join_clients(c1, c2):
-			c1.extend(c2)
-			return c1
-		t.executemany('INSERT INTO counts(snapshot, type, count, size) VALUES(%s, %s, %s, %s)', reduce(join_clients, map(clientdata, data.keys())))
-		t.executemany('INSERT INTO capture_stats(snapshot, interface, captured, dropped, dropped_driver) VALUES(%s, %s, %s, %s, %s)', reduce(join_clients, map(clientcaptures, stats.keys())))
+		copy_rows(t, count_rows(data, snapshots, name_order, names), 'counts', ('snapshot', 'type', 'count', 'size'))
+		copy_rows(t, capture_rows(stats, snapshots), 'capture_stats', ('snapshot', 'interface', 'captured', 'dropped', 'dropped_driver'))
+	duration = time.time() - start
+	if duration > interval:
+		logger.warn('Storing count snapshot of %s clients took %.3f s, longer than the interval of %s s', len(snapshots), duration, interval)
+	else:
+		logger.info('Stored count snapshot of %s clients in %.3f s', len(snapshots), duration)
 
 class CountPlugin(plugin.Plugin):
 	"""
@@ -100,7 +155,7 @@ class CountPlugin(plugin.Plugin):
 		# move it to a separate thread, so we don't block the communication. This is
 		# safe -- we pass all the needed data to it as parameters and get rid of our
 		# copy, passing the ownership to the task.
-		reactor.callInThread(store_counts, self.__data, self.__stats, database.now())
+		reactor.callInThread(store_counts, self.__data, self.__stats, database.now(), self.__interval)
 		self.__data = {}
 		self.__stats = {}
 
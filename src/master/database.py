@@ -22,25 +22,131 @@ import logging
 import threading
 import traceback
 import time
-from master_config import get
+import datetime
+from master_config import get, getint
+import timers
 
 logger = logging.getLogger(name='database')
 
+def __connect(keep_trying=None):
+	"""
+	Create a new connection to the DB. Block until it succeeds, or until
+	keep_trying() (if given) returns False. Then return None.
+	"""
+	logger.debug("Initializing connection to DB")
+	while True:
+		try:
+			return psycopg2.connect(database=get('db'), user=get('dbuser'), password=get('dbpasswd'), host=get('dbhost'))
+		except Exception as e:
+			logger.error("Failed to create DB connection (blocking until it works): %s", e)
+			time.sleep(1)
+			if keep_trying is not None and not keep_trying():
+				return None
+
+class __Pool:
+	"""
+	A bounded pool of DB connections. A connection is checked out for
+	the whole (outermost) transaction and returned afterwards. If all
+	the connections are in use, the caller waits for one to be returned.
+
+	The connections are not checked before each use. A connection that
+	failed is thrown away and one that was idle for a long time is
+	checked with a trivial query before it is handed out.
+	"""
+	def __init__(self, size, idle_check, connect):
+		self.__size = size
+		self.__idle_check = idle_check
+		self.__connect = connect
+		self.__condition = threading.Condition(threading.Lock())
+		self.__idle = [] # (connection, time of return) pairs
+		self.__count = 0
+		self.checkouts = 0
+		self.waits = 0
+		self.wait_time = 0
+
+	def checkout(self, wait=True):
+		"""
+		Get a connection. If all are in use, wait for one, or raise an
+		exception if wait is false.
+		"""
+		with self.__condition:
+			self.checkouts += 1
+			if not self.__idle and self.__count >= self.__size:
+				if not wait:
+					raise Exception('All the DB connections are in use')
+				self.waits += 1
+				start = time.time()
+				while not self.__idle and self.__count >= self.__size:
+					self.__condition.wait()
+				self.wait_time += time.time() - start
+			if self.__idle:
+				(connection, returned) = self.__idle.pop()
+			else:
+				self.__count += 1
+				(connection, returned) = (None, None)
+		if connection is None:
+			return self.__connect()
+		if returned + self.__idle_check < time.time():
+			try:
+				cursor = connection.cursor()
+				cursor.execute("SELECT 1")
+				cursor.fetchone()
+				connection.rollback()
+			except (psycopg2.OperationalError, psycopg2.InterfaceError):
+				logger.error("Broken idle DB connection, recreating")
+				self.__close(connection)
+				return self.__connect()
+		return connection
+
+	def checkin(self, connection, broken):
+		if broken:
+			self.__close(connection)
+			with self.__condition:
+				self.__count -= 1
+				self.__condition.notify()
+		else:
+			with self.__condition:
+				self.__idle.append((connection, time.time()))
+				self.__condition.notify()
+
+	def __close(self, connection):
+		try:
+			connection.close()
+		except Exception:
+			pass # It is broken anyway
+
+	def stats(self):
+		with self.__condition:
+			return (self.__count, len(self.__idle), self.checkouts, self.waits, self.wait_time)
+
 class __CursorContext:
 	"""
-	A context for single transaction on a given cursor. See transaction().
+	A context for single transaction. It checks out a connection from the
+	pool when the outermost context is entered and returns it when it is
+	left. See transaction().
 	"""
-	def __init__(self, connection):
-		self.__connection = connection
+	def __init__(self, pool, local, nested=False):
+		self.__pool = pool
+		self.__local = local
+		self.__nested = nested
 		self.__depth = 0
-		self.reuse()
-
-	def reuse(self):
-		self._cursor = self.__connection.cursor()
+		self.__connection = None
+		self._cursor = None
 
 	def __enter__(self):
 		if not self.__depth:
 			logger.debug('Entering transaction %s', self)
+			# A nested transaction waiting for a connection while holding
+			# another one could deadlock the pool
+			self.__connection = self.__pool.checkout(not self.__nested)
+			try:
+				self._cursor = self.__connection.cursor()
+			except Exception:
+				self.__pool.checkin(self.__connection, True)
+				self.__connection = None
+				raise
+			if self.__local is not None:
+				self.__local.context = self
 		self.__depth += 1
 		return self._cursor
 
@@ -48,17 +154,38 @@ class __CursorContext:
 		self.__depth -= 1
 		if self.__depth:
 			return # Didn't exit all the contexts yet
-		if exc_type:
-			logger.error('Rollback of transaction %s:%s/%s/%s', self, exc_type, exc_val, traceback.format_tb(exc_tb))
-			self.__connection.rollback()
-		else:
-			logger.debug('Commit of transaction %s', self)
-			self.__connection.commit()
-		self._cursor = None
+		if self.__local is not None:
+			del self.__local.context
+		broken = exc_type is not None and issubclass(exc_type, (psycopg2.OperationalError, psycopg2.InterfaceError))
+		try:
+			if exc_type:
+				logger.error('Rollback of transaction %s:%s/%s/%s', self, exc_type, exc_val, traceback.format_tb(exc_tb))
+				self.__connection.rollback()
+			else:
+				logger.debug('Commit of transaction %s', self)
+				self.__connection.commit()
+		except (psycopg2.OperationalError, psycopg2.InterfaceError):
+			broken = True
+			raise
+		finally:
+			self._cursor = None
+			self.__pool.checkin(self.__connection, broken)
+			self.__connection = None
+
+__pool = __Pool(getint('db_pool_size', 8), getint('db_idle_check', 60), __connect)
+
+def dedicated_connection(keep_trying=None):
+	"""
+	Open a new connection to the DB, outside of the pool. It is for special
+	uses (like LISTEN), the caller is responsible for closing it. Blocks
+	until it succeeds or until keep_trying() (if given) returns False, in
+	which case it returns None.
+	"""
+	return __connect(keep_trying)
 
 __cache = threading.local()
 
-def transaction_raw(reuse=True):
+def transaction(reuse=True):
 	"""
 	A single transaction. It is automatically commited on success and
 	rolled back on exception. Use as following:
@@ -67,57 +194,69 @@ def transaction_raw(reuse=True):
 		transaction.execute(...)
 		transaction.execute(...)
 
-	If reuse is true, the cursor inside may have been used before and
-	may be used again later.
+	If reuse is true and the thread is already inside a transaction,
+	the inner one becomes part of the outer one (and uses the same
+	connection). Otherwise, a connection is taken from the pool. An
+	independent transaction inside another one holds two connections;
+	if there's no free one, it fails instead of waiting (with all the
+	threads doing this, the pool would deadlock).
 	"""
-	global __cache
-	if 'connection' not in __cache.__dict__:
-		logger.debug("Initializing connection to DB")
-		retry = True
-		while retry:
-			try:
-				__cache.connection = psycopg2.connect(database=get('db'), user=get('dbuser'), password=get('dbpasswd'), host=get('dbhost'))
-				retry = False
-			except Exception as e:
-				logger.error("Failed to create DB connection (blocking until it works): %s", e)
-				time.sleep(1)
 	if reuse:
-		if 'context' not in __cache.__dict__:
-			__cache.context = __CursorContext(__cache.connection)
-			logger.debug("Initializing cursor")
-		else:
-			__cache.context.reuse()
-		return __cache.context
+		if 'context' in __cache.__dict__:
+			return __cache.context
+		return __CursorContext(__pool, __cache)
 	else:
-		return __CursorContext(__cache.connection)
+		return __CursorContext(__pool, None, 'context' in __cache.__dict__)
 
-def transaction(reuse=True):
-	if reuse:
-		try: # if the cursor works
-			result = transaction_raw(True)
-			result._cursor.execute("SELECT 1")
-			(one,) = result._cursor.fetchone()
-			return result
-		except (psycopg2.OperationalError, psycopg2.InterfaceError):
-			# It is broken. Drop the old cursor and connection and create a new one.
-			logger.error("Broken DB connection, recreating")
-			global __cache
-			del __cache.__dict__['connection']
-			del __cache.__dict__['context']
-			return transaction_raw(True)
-	else:
-		return transaction_raw(False)
+def __log_stats():
+	(count, idle, checkouts, waits, wait_time) = __pool.stats()
+	logger.info("DB pool: %s connections (%s idle), %s checkouts, %s waits, %.3f s waited", count, idle, checkouts, waits, wait_time)
 
-__time_update = 0
-__time_db = 0
+stats_logger = timers.timer(__log_stats, 300, False)
+
+__clock_lock = threading.Lock()
+__clock_offset = None
+__clock_thread = None
+__clock_interval = getint('clock_sync_interval', 60)
+
+def __measure_clock():
+	"""
+	Measure the difference between the DB clock and the local one. The
+	local time is taken in the middle of the query, to compensate for the
+	round trip. Only the query is timed, not waiting for a connection.
+	"""
+	global __clock_offset
+	with transaction() as t:
+		before = datetime.datetime.utcnow()
+		t.execute("SELECT clock_timestamp() AT TIME ZONE 'UTC'")
+		(db_time,) = t.fetchone()
+		after = datetime.datetime.utcnow()
+	__clock_offset = db_time - (before + (after - before) / 2)
+	logger.debug("DB clock offset %s", __clock_offset)
+
+def __keep_clock():
+	"""
+	Run in a separate thread. Measure the clock offset every now and then.
+	"""
+	while True:
+		time.sleep(__clock_interval)
+		try:
+			__measure_clock()
+		except Exception as e:
+			logger.error("Failed to measure the DB clock offset, keeping the old one: %s", e)
 
 def now():
-	global __time_update
-	global __time_db
-	t = time.time()
-	if __time_update + 2 < t:
-		__time_update = t
-		with transaction() as t:
-			t.execute("SELECT CURRENT_TIMESTAMP AT TIME ZONE 'UTC'");
-			(__time_db,) = t.fetchone()
-	return __time_db
+	"""
+	The current time (UTC) as seen by the DB. It is computed locally from
+	the offset against the DB clock, which is measured in a background
+	thread. Only the very first call blocks on the DB.
+	"""
+	global __clock_thread
+	if __clock_offset is None:
+		with __clock_lock:
+			if __clock_offset is None:
+				__measure_clock()
+				__clock_thread = threading.Thread(target=__keep_clock, name='clock')
+				__clock_thread.daemon = True
+				__clock_thread.start()
+	return datetime.datetime.utcnow() + __clock_offset
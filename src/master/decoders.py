@@ -0,0 +1,203 @@
+#
+#    Ucollect - small utility for real-time analysis of network data
+#    Copyright (C) 2016 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Decoders of the bulk binary records sent by the clients (flows, refused
+connections, fake server logs). They walk a single memoryview of the
+message with offsets, so the message is not copied over and over again
+as it is consumed, and they use precompiled structures.
+
+Each decoder is a generator yielding one decoded tuple per record. The
+*_end functions find where the last complete record ends, so a message
+arriving in pieces can be decoded a batch of whole records at a time
+(see Batches).
+"""
+
+import struct
+import socket
+
+flow_header = struct.Struct('!IQ')
+flow_record = struct.Struct('!BIIQQHHQQQQ')
+refused_header = struct.Struct('!Q')
+refused_record = struct.Struct('!QcBHH')
+fake_record_v1 = struct.Struct('!IBBBc')
+fake_record = struct.Struct('!IBBBcH')
+string_header = struct.Struct('!L')
+byte = struct.Struct('!B')
+
+fake_families = [(4, socket.AF_INET), (16, socket.AF_INET6)]
+
+def flows(message, offset=0):
+	"""
+	Decode the flows in the message, starting at the given offset (after
+	the header, see flow_header). Yields tuples of
+	(flags, cin, cout, sin, sout, ploc, prem, tbin, tbout, tein, teout, aloc, arem),
+	the addresses being already converted to text.
+	"""
+	view = memoryview(message)
+	end = len(view)
+	rec_size = flow_record.size
+	unpack = flow_record.unpack_from
+	ntop = socket.inet_ntop
+	while offset < end:
+		fields = unpack(view, offset)
+		offset += rec_size
+		if fields[0] & 1:
+			(size, tp) = (16, socket.AF_INET6)
+		else:
+			(size, tp) = (4, socket.AF_INET)
+		aloc = ntop(tp, view[offset:offset + size].tobytes())
+		arem = ntop(tp, view[offset + size:offset + 2 * size].tobytes())
+		offset += 2 * size
+		yield fields + (aloc, arem)
+
+def flows_end(buf, offset=0):
+	"""
+	The offset just after the last complete flow record in buf.
+	"""
+	end = len(buf)
+	rec_size = flow_record.size
+	while offset + rec_size <= end:
+		(flags,) = byte.unpack_from(buf, offset)
+		size = rec_size + (32 if flags & 1 else 8)
+		if offset + size > end:
+			break
+		offset += size
+	return offset
+
+def refused(message, offset=0):
+	"""
+	Decode the refused connections in the message. The first thing at the
+	offset is the base time. Yields tuples of
+	(basetime, time, reason, family, loc_port, rem_port, address).
+	"""
+	view = memoryview(message)
+	end = len(view)
+	(basetime,) = refused_header.unpack_from(view, offset)
+	offset += refused_header.size
+	rec_size = refused_record.size
+	unpack = refused_record.unpack_from
+	while offset < end:
+		(time, reason, family, loc_port, rem_port) = unpack(view, offset)
+		offset += rec_size
+		if family == 4:
+			(addr_len, tp) = (4, socket.AF_INET)
+		else:
+			(addr_len, tp) = (16, socket.AF_INET6)
+		address = socket.inet_ntop(tp, view[offset:offset + addr_len].tobytes())
+		offset += addr_len
+		yield (basetime, time, reason, family, loc_port, rem_port, address)
+
+def fake_logs(message, version, offset=0):
+	"""
+	Decode the log events of the fake servers. Yields tuples of
+	(age, type_idx, code, rem_port, rem_address, loc_address, infos), where
+	infos is a list of (kind, content) pairs. The rem_port and loc_address
+	are None with the old protocol version.
+	"""
+	view = memoryview(message)
+	end = len(view)
+	record = fake_record_v1 if version <= 1 else fake_record
+	rec_size = record.size
+	unpack = record.unpack_from
+	while offset < end:
+		fields = unpack(view, offset)
+		offset += rec_size
+		if version <= 1:
+			(age, type_idx, family_idx, info_count, code) = fields
+			rem_port = None
+		else:
+			(age, type_idx, family_idx, info_count, code, rem_port) = fields
+		(addr_len, tp) = fake_families[family_idx]
+		rem_address = socket.inet_ntop(tp, view[offset:offset + addr_len].tobytes())
+		offset += addr_len
+		if version <= 1:
+			loc_address = None
+		else:
+			loc_address = socket.inet_ntop(tp, view[offset:offset + addr_len].tobytes())
+			offset += addr_len
+		infos = []
+		for i in range(0, info_count):
+			(kind,) = byte.unpack_from(view, offset)
+			(slen,) = string_header.unpack_from(view, offset + 1)
+			offset += 1 + string_header.size
+			infos.append((kind, view[offset:offset + slen].tobytes()))
+			offset += slen
+		yield (age, type_idx, code, rem_port, rem_address, loc_address, infos)
+
+def fake_logs_end(buf, version, offset=0):
+	"""
+	The offset just after the last complete fake server log event in buf.
+	"""
+	end = len(buf)
+	record = fake_record_v1 if version <= 1 else fake_record
+	rec_size = record.size
+	addr_count = 1 if version <= 1 else 2
+	info_header = 1 + string_header.size
+	while offset + rec_size <= end:
+		fields = record.unpack_from(buf, offset)
+		(family_idx, info_count) = fields[2:4]
+		position = offset + rec_size + addr_count * fake_families[family_idx][0]
+		for i in range(0, info_count):
+			if position + info_header > end:
+				return offset
+			(slen,) = string_header.unpack_from(buf, position + 1)
+			position += info_header + slen
+		if position > end:
+			break
+		offset = position
+	return offset
+
+class Batches:
+	"""
+	Collects the records of a message that arrives in pieces and passes
+	them to the callback in batches of whole records, each batch being at
+	least batch_size bytes long (except for the last one). The end function
+	is one of the *_end ones above. If the message ends in the middle of
+	a record, the truncated callback gets the number of bytes left over.
+
+	It is the consumer expected by protocol.Framer.
+	"""
+	def __init__(self, end, callback, truncated, batch_size=1024 * 1024):
+		self.__end = end
+		self.__callback = callback
+		self.__truncated = truncated
+		self.__batch_size = batch_size
+		self.__buffer = bytearray()
+
+	def __flush(self):
+		end = self.__end(self.__buffer)
+		if end:
+			batch = str(self.__buffer[:end])
+			del self.__buffer[:end]
+			self.__callback(batch)
+
+	def feed(self, data):
+		self.__buffer.extend(data)
+		if len(self.__buffer) >= self.__batch_size:
+			self.__flush()
+
+	def finish(self):
+		self.__flush()
+		if self.__buffer:
+			self.__truncated(len(self.__buffer))
+			self.__buffer = bytearray()
+
+	def abort(self):
+		self.__buffer = bytearray()
@@ -18,12 +18,75 @@
 #
 
 import database
+import psycopg2
 import socket
 import struct
 import timers
+import notify
+import collections
+import bisect
+import threading
+import zlib
+from array import array
+from twisted.internet import threads, defer
 from protocol import extract_string
+from master_config import getint
+
+port_struct = struct.Struct('!H')
+length_struct = struct.Struct('!B')
+
+__conversions = {}
+__conversions_max = 200000
+
+def __guess_convert(address):
+	"""
+	Convert the address, guessing its format from the colons in it, so
+	only one conversion needs to be tried. Raises if the guess is wrong.
+	"""
+	if address.startswith('['):
+		(ip, port) = address[1:].split(']:')
+		return socket.inet_pton(socket.AF_INET6, ip) + port_struct.pack(int(port))
+	colons = address.count(':')
+	if not colons:
+		return socket.inet_pton(socket.AF_INET, address)
+	if colons == 1:
+		(ip, port) = address.split(':')
+		return socket.inet_pton(socket.AF_INET, ip) + port_struct.pack(int(port))
+	return socket.inet_pton(socket.AF_INET6, address)
 
 def addr_convert(address, logger):
+	"""
+	Convert the string IP address to binary representation.
+	The results are cached, as the same addresses are converted
+	again and again.
+	"""
+	result = __conversions.get(address)
+	if result is None:
+		try:
+			result = __guess_convert(address)
+		except Exception:
+			result = __try_convert(address, logger)
+		if len(__conversions) >= __conversions_max:
+			__conversions.clear()
+		__conversions[address] = result
+	return result
+
+def encode_addresses(addresses, full, logger):
+	"""
+	Encode the (address, add) pairs into the body of a diff message.
+	The removed addresses are skipped on full update.
+	"""
+	pack = length_struct.pack
+	result = []
+	for (address, add) in addresses:
+		if not add and full:
+			continue # Don't mention deleted addresses on full update
+		addr = addr_convert(address, logger)
+		result.append(pack(len(addr) + add))
+		result.append(addr)
+	return ''.join(result)
+
+def __try_convert(address, logger):
 	"""
 	Convert the string IP address to binary representation.
 	Just try the possibilities one by one, using the first
@@ -46,6 +109,126 @@ def addr_convert(address, logger):
 				excp = e
 	raise e
 
+class AddressSet:
+	"""
+	In-memory copy of one epoch of an address set, good enough to answer
+	diffs to its current version without asking the DB.
+
+	Only the last change of each address is kept. The changes are stored
+	in a log, ordered by their version, so a diff from some version is
+	just the tail of the log. The log is kept in parallel arrays, with the
+	binary addresses packed one after another in a single buffer. An index
+	sorted by the address allows finding the previous change of an address
+	when it changes again (and such changes are marked superseded).
+
+	The diffs are computed in other threads than the updates, so they are
+	protected by a lock.
+	"""
+	ADD = 1
+	SUPERSEDED = 2
+
+	def __init__(self, epoch, version, changes):
+		"""
+		Create the set from a list of (address, version, add) triplets, one
+		for each address, sorted by the version. The addresses are binary
+		(see addr_convert).
+		"""
+		self.epoch = epoch
+		self.version = version
+		addresses = map(lambda change: change[0], changes)
+		self.__data = bytearray(''.join(addresses))
+		self.__offsets = array('I', [0])
+		offset = 0
+		for address in addresses:
+			offset += len(address)
+			self.__offsets.append(offset)
+		self.__versions = array('I', map(lambda change: change[1], changes))
+		self.__flags = bytearray(map(lambda change: self.ADD if change[2] else 0, changes))
+		self.__superseded = 0
+		self.__lock = threading.Lock()
+		self.__order = array('I', sorted(xrange(0, len(addresses)), key=addresses.__getitem__))
+
+	def __append(self, address, version, add):
+		self.__data += address
+		self.__offsets.append(len(self.__data))
+		self.__versions.append(version)
+		self.__flags.append(self.ADD if add else 0)
+
+	def __address(self, index):
+		return self.__data[self.__offsets[index]:self.__offsets[index + 1]]
+
+	def __sort(self):
+		self.__order = array('I', sorted(xrange(0, len(self.__versions)), key=self.__address))
+
+	def __getitem__(self, position):
+		# So bisect can search the index by the addresses
+		return self.__address(self.__order[position])
+
+	def __len__(self):
+		return len(self.__order)
+
+	def update(self, version, changes):
+		"""
+		Apply changes between the current version and the new one. The
+		changes are in the same format as in the constructor.
+		"""
+		with self.__lock:
+			self.__update(version, changes)
+
+	def __update(self, version, changes):
+		for (address, change_version, add) in changes:
+			address = bytearray(address)
+			position = bisect.bisect_left(self, address)
+			index = len(self.__versions)
+			if position < len(self.__order) and self[position] == address:
+				self.__flags[self.__order[position]] |= self.SUPERSEDED
+				self.__superseded += 1
+				self.__order[position] = index
+			else:
+				self.__order.insert(position, index)
+			self.__append(address, change_version, add)
+		self.version = version
+		if self.__superseded > len(self.__versions) / 2:
+			self.__compact()
+
+	def __compact(self):
+		(data, offsets, versions, flags) = (self.__data, self.__offsets, self.__versions, self.__flags)
+		(self.__data, self.__offsets, self.__versions, self.__flags) = (bytearray(), array('I', [0]), array('I'), bytearray())
+		for i in xrange(0, len(versions)):
+			if not flags[i] & self.SUPERSEDED:
+				self.__append(data[offsets[i]:offsets[i + 1]], versions[i], flags[i] & self.ADD)
+		self.__superseded = 0
+		self.__sort()
+
+	def diff(self, from_version, to_version, full):
+		"""
+		Return the encoded addresses changed since from_version (excluding),
+		up to to_version. The removed ones are left out if full. Return None
+		if to_version is not the current version.
+		"""
+		with self.__lock:
+			if to_version != self.version:
+				return None
+			return self.__diff(from_version, full)
+
+	def __diff(self, from_version, full):
+		(data, offsets, flags) = (self.__data, self.__offsets, self.__flags)
+		result = bytearray()
+		for i in xrange(bisect.bisect_right(self.__versions, from_version), len(self.__versions)):
+			flag = flags[i]
+			if flag & self.SUPERSEDED or (full and not flag & self.ADD):
+				continue
+			address = data[offsets[i]:offsets[i + 1]]
+			result.append(len(address) + (flag & self.ADD))
+			result += address
+		return str(result)
+
+	def size(self):
+		"""
+		Number of bytes used by the data (not counting the constant overhead).
+		"""
+		return len(self.__data) + len(self.__flags) + sum(map(lambda a: a.itemsize * len(a), [self.__offsets, self.__versions, self.__order]))
+
 class DiffAddrStore:
 	"""
 	A mixin to allow plugins easily integrate updating of diff address stores.
@@ -61,14 +244,41 @@ class DiffAddrStore:
 	You may use _provide_diff to send a diff between two versions to
 	a client when it asks. It parses the request from client. It expets
 	there is a send method available (provided by plugin.Plugin base class).
+	The diffs are computed in a thread. If more clients ask for the same diff
+	before it is ready, it is computed only once and sent to all of them.
+
+	If compress_version is set, clients with at least this version of the
+	plugin get the full updates compressed, as a 'Z' message. It contains
+	the length of the 'D' message and the 'D' message compressed by zlib.
+	The compressed full updates are made right away for each new version
+	and cached, so each is compressed only once.
 
-	Internally, it checks the DB for new data every minute. It caches the
-	config and also requested diffs.
+	Internally, it checks the DB for new data every minute (or when notified
+	about a change, see the notify module), in a thread. The
+	versions of the sets are read from the addr_set_versions table, kept up
+	to date by triggers, so the check doesn't scan the addresses. It caches the
+	config and also requested diffs. The diffs are cached for each set
+	separately, with LRU eviction (see diff_cache_entries and diff_cache_size
+	in the config). As the versions of a set only grow, a cached diff stays
+	valid until the epoch of the set changes. When a new version appears,
+	the diff from the previous one is computed right away, since most of
+	the clients are going to ask for it.
+
+	Unless diff_in_memory is turned off, it also keeps a copy of the current
+	epoch of each set in memory (see AddressSet), updated with each new
+	version. Diffs to the current version are computed from it, the DB is
+	asked only for the older versions.
 	"""
-	def __init__(self, logger, plugname, table, column):
+	def __init__(self, logger, plugname, table, column, compress_version=0):
 		self.__logger = logger
 		self.__plugname = plugname
-		# Get the max epoch for each set. Then get the maximum version for each such set & epoch
+		self.__compress_version = compress_version
+		self.__table = table
+		self.__summary = True # Try the addr_set_versions table
+		self.__polling = False
+		self.__recheck = False
+		# Get the max epoch for each set. Then get the maximum version for each such set & epoch.
+		# Used only if the DB doesn't have the addr_set_versions table.
 		self.__version_query = '''
 			SELECT addresses.name, addresses.epoch, MAX(raw_addresses.version)
 		FROM
@@ -96,60 +306,270 @@ class DiffAddrStore:
 			%TABLE%.%COLUMN% = %s AND epoch = %s
 		ORDER BY
 			address'''.replace("%TABLE%", table).replace("%COLUMN%", column)
+		# The last change of each address between two versions, for the in-memory sets
+		self.__changes_query = '''
+			SELECT %TABLE%.address, %TABLE%.version, add
+		FROM
+			(SELECT
+				address, MAX(version) AS version
+			FROM
+				%TABLE%
+			WHERE
+				%COLUMN% = %s AND epoch = %s AND version > %s AND version <= %s
+			GROUP BY
+				address) AS lasts
+		JOIN
+			%TABLE%
+		ON
+			%TABLE%.address = lasts.address AND %TABLE%.version = lasts.version
+		WHERE
+			%TABLE%.%COLUMN% = %s AND epoch = %s
+		ORDER BY
+			%TABLE%.version, address'''.replace("%TABLE%", table).replace("%COLUMN%", column)
+		self.__in_memory = getint('diff_in_memory', 1)
+		self.__sets = {} # Set name -> AddressSet
+		self.__memory_answers = 0
+		self.__pending = {} # (name, key) -> Deferreds waiting for a diff being computed
+		self.__coalesced = 0
 		self._conf = {}
 		self._addresses = {}
-		self.__cache = {} # Reset whenever the DB contains something new.
-		self.__conf_checker = timers.timer(self.__check_conf, 60, True)
+		self.__cache = {} # Set name -> OrderedDict of diffs, the least recently used first
+		self.__cache_sizes = {} # Set name -> bytes in the cache
+		self.__cache_entries = getint('diff_cache_entries', 256)
+		self.__cache_size = getint('diff_cache_size', 16 * 1024 * 1024)
+		self.__prefixes = set() # The prefixes clients asked with since the last config change
+		self.__hits = 0
+		self.__misses = 0
+		self.__queries = 0
+		self.__reported = None
+		notify.subscribe('config', self.__config_notified)
+		notify.subscribe('addr_set_versions', self.__versions_notified)
+		self.__conf_checker = timers.timer(self.__check_conf, notify.fallback_interval(60), True)
+
+	def __config_notified(self, plugin):
+		if plugin is None or plugin == self.__plugname:
+			self.__check_conf()
+
+	def __versions_notified(self, table):
+		if table is None or table == self.__table:
+			self.__check_conf()
 
 	def __check_conf(self):
+		if self.__polling:
+			self.__logger.debug("Previous check of %s configs still running", self.__plugname)
+			self.__recheck = True
+			return
+		self.__polling = True
+		def finished():
+			self.__polling = False
+			if self.__recheck: # Something changed during the check
+				self.__recheck = False
+				self.__check_conf()
+		def done((config, addresses, sets)):
+			self.__apply_conf(config, addresses, sets)
+			finished()
+		def failed(failure):
+			self.__logger.error("Failed to check %s configs: %s", self.__plugname, failure.getTraceback())
+			finished()
+		threads.deferToThread(self.__poll).addCallbacks(done, failed)
+
+	def __poll(self):
+		"""
+		Read the config and versions of the address sets from the DB and bring
+		the in-memory sets up to date. Runs in a thread, the results are applied
+		in the reactor thread by __apply_conf.
+		"""
 		self.__logger.trace("Checking %s configs", self.__plugname)
 		with database.transaction() as t:
 			t.execute("SELECT name, value FROM config WHERE plugin = '" + self.__plugname + "'")
 			config = dict(t.fetchall())
+		addresses = self.__fetch_versions()
+		sets = {}
+		for a in addresses:
+			orig = self._addresses.get(a)
+			if orig == addresses[a]:
+				if a in self.__sets:
+					sets[a] = self.__sets[a]
+			elif orig is None or orig[0] != addresses[a][0] or orig[1] > addresses[a][1]:
+				sets[a] = self.__load_set(a, addresses[a][0], addresses[a][1])
+			elif a in self.__sets:
+				sets[a] = self.__update_set(a, self.__sets[a], addresses[a][1])
+			else: # Not loaded before, try again
+				sets[a] = self.__load_set(a, addresses[a][0], addresses[a][1])
+		return (config, addresses, dict(filter(lambda (name, address_set): address_set is not None, sets.items())))
+
+	def __fetch_versions(self):
+		"""
+		Get the current epoch and version of each set. Use the summary table
+		maintained by triggers, if the DB has it.
+		"""
+		if self.__summary:
+			try:
+				with database.transaction() as t:
+					t.execute("SELECT name, epoch, version FROM addr_set_versions WHERE address_table = %s", (self.__table,))
+					return dict(map(lambda (name, epoch, version): (name, (epoch, version)), t.fetchall()))
+			except psycopg2.ProgrammingError as e:
+				self.__logger.warn("No addr_set_versions table in the DB (%s), computing the versions from %s", e, self.__table)
+				self.__summary = False
+		with database.transaction() as t:
 			t.execute(self.__version_query)
-			addresses = {}
-			for (name, epoch, version) in t.fetchall():
-				addresses[name] = (epoch, version)
+			return dict(map(lambda (name, epoch, version): (name, (epoch, version)), t.fetchall()))
+
+	def __apply_conf(self, config, addresses, sets):
 		addresses_orig = self._addresses
 		self._addresses = addresses
+		self.__sets = sets
 		if self._conf != config:
 			self.__logger.info("Config changed, broadcasting")
 			self._conf = config
 			self.__cache = {}
+			self.__cache_sizes = {}
+			self.__prefixes = set()
 			self._broadcast_config()
 		if addresses_orig != addresses:
-			self.__cache = {}
+			for a in set(addresses_orig.keys()) - set(addresses.keys()):
+				self.__invalidate(a)
 			for a in addresses:
-				if addresses_orig.get(a) != addresses[a]:
+				orig = addresses_orig.get(a)
+				if orig != addresses[a]:
+					if orig is None or orig[0] != addresses[a][0] or orig[1] > addresses[a][1]:
+						# A new epoch (or something strange), the old diffs are of no use
+						self.__invalidate(a)
+					else:
+						for prefix in self.__prefixes:
+							self.__diff_update(a, False, orig[0], orig[1], addresses[a][1], prefix).addErrback(self.__diff_failed, a)
+					if self.__compress_version:
+						for prefix in self.__prefixes:
+							self.__diff_update(a, True, addresses[a][0], 0, addresses[a][1], prefix, True).addErrback(self.__diff_failed, a)
 					self.__logger.debug("Broadcasting new version of %s", a)
 					self._broadcast_version(a, addresses[a][0], addresses[a][1])
+		stats = (self.__hits, self.__misses, self.__coalesced, self.__queries)
+		if stats != self.__reported:
+			self.__reported = stats
+			requests = self.__hits + self.__misses + self.__coalesced
+			self.__logger.info("Diff cache of %s: %s hits and %s coalesced of %s requests (%.1f%%), %s DB queries, %s computed in memory, %s entries with %s bytes", self.__plugname, self.__hits, self.__coalesced, requests, 100.0 * (self.__hits + self.__coalesced) / requests if requests else 0, self.__queries, self.__memory_answers, sum(map(len, self.__cache.values())), sum(self.__cache_sizes.values()))
 
-	def __diff_update(self, name, full, epoch, from_version, to_version, prefix):
-		key = (name, full, epoch, from_version, to_version)
-		if key in self.__cache: # Someone already asked for this, just reuse the result instead of asking the DB
-			return self.__cache[key]
+	def __fetch_changes(self, name, epoch, from_version, to_version):
 		with database.transaction() as t:
-			t.execute(self.__diff_query, (name, epoch, from_version, to_version, name, epoch))
-			addresses = t.fetchall()
+			t.execute(self.__changes_query, (name, epoch, from_version, to_version, name, epoch))
+			return map(lambda (address, version, add): (addr_convert(address, self.__logger), version, add), t.fetchall())
+
+	def __load_set(self, name, epoch, version):
+		"""
+		Load the whole set into memory (see AddressSet). Return None if
+		it is not possible.
+		"""
+		if not self.__in_memory:
+			return None
+		try:
+			address_set = AddressSet(epoch, version, self.__fetch_changes(name, epoch, 0, version))
+			self.__logger.info("Loaded %s@%s version %s into memory, %s bytes", name, epoch, version, address_set.size())
+			return address_set
+		except Exception:
+			self.__logger.exception("Failed to load %s into memory, diffs will be computed by the DB", name)
+			return None
+
+	def __update_set(self, name, address_set, version):
+		"""
+		Update the in-memory set to the given version. Return it, or None
+		if it failed.
+		"""
+		try:
+			address_set.update(version, self.__fetch_changes(name, address_set.epoch, address_set.version, version))
+			self.__logger.debug("Updated %s in memory to version %s, %s bytes", name, version, address_set.size())
+			return address_set
+		except Exception:
+			self.__logger.exception("Failed to update %s in memory, diffs will be computed by the DB", name)
+			return None
+
+	def __invalidate(self, name):
+		if name in self.__cache:
+			self.__logger.debug("Dropping %s cached diffs of %s", len(self.__cache[name]), name)
+			del self.__cache[name]
+			del self.__cache_sizes[name]
+
+	def __cache_store(self, name, key, result):
+		cache = self.__cache.setdefault(name, collections.OrderedDict())
+		size = self.__cache_sizes.get(name, 0) + len(result)
+		cache[key] = result
+		while len(cache) > 1 and (len(cache) > self.__cache_entries or size > self.__cache_size):
+			(_, evicted) = cache.popitem(last=False)
+			size -= len(evicted)
+		self.__cache_sizes[name] = size
+
+	def __diff_update(self, name, full, epoch, from_version, to_version, prefix, compressed=False):
+		"""
+		Get the diff message. Returns a deferred, fired with the message.
+		"""
+		key = (full, epoch, from_version, to_version, prefix, compressed)
+		cache = self.__cache.get(name)
+		if cache is not None and key in cache: # Someone already asked for this, just reuse the result instead of asking the DB
+			self.__hits += 1
+			result = cache.pop(key)
+			cache[key] = result # Mark as recently used
+			return defer.succeed(result)
+		result = defer.Deferred()
+		waiting = self.__pending.get((name, key))
+		if waiting is not None: # Someone already asked for this and it is being computed, wait for it
+			self.__coalesced += 1
+			waiting.append(result)
+			return result
+		self.__misses += 1
+		waiting = [result]
+		self.__pending[(name, key)] = waiting
+		def computed((message, in_memory)):
+			del self.__pending[(name, key)]
+			if in_memory:
+				self.__memory_answers += 1
+			else:
+				self.__queries += 1
+			if self._addresses.get(name, (None,))[0] == epoch: # Don't cache diffs of a gone epoch
+				self.__cache_store(name, key, message)
+			for d in waiting:
+				d.callback(message)
+		def failed(failure):
+			del self.__pending[(name, key)]
+			for d in waiting:
+				d.errback(failure)
+		threads.deferToThread(self.__compute_diff, name, full, epoch, from_version, to_version, prefix, compressed).addCallbacks(computed, failed)
+		return result
+
+	def __compute_diff(self, name, full, epoch, from_version, to_version, prefix, compressed):
+		"""
+		Compute the diff message, possibly compressed. Runs in a thread.
+		Returns the message and if it was computed in memory.
+		"""
+		(message, in_memory) = self.__compute_plain_diff(name, full, epoch, from_version, to_version, prefix)
+		if compressed:
+			compressed_message = 'Z' + struct.pack('!I', len(message)) + zlib.compress(message, 9)
+			self.__logger.debug("Compressed full update of %s@%s version %s from %s to %s bytes", name, epoch, to_version, len(message), len(compressed_message))
+			message = compressed_message
+		return (message, in_memory)
+
+	def __compute_plain_diff(self, name, full, epoch, from_version, to_version, prefix):
 		params = [len(name), name, full, epoch]
 		if not full:
 			params.append(from_version)
 		params.append(to_version)
 		result = 'D' + prefix + struct.pack('!I' + str(len(name)) + 's?II' + ('' if full else 'I'), *params)
-		for (address, add) in addresses:
-			if not add and full:
-				continue # Don't mention deleted addresses on full update
-			addr = addr_convert(address, self.__logger)
-			self.__logger.trace("Addr: %s/%s", repr(addr), len(addr))
-			result += struct.pack('!B', len(addr) + add) + addr
-		self.__cache[key] = result
-		return result
+		address_set = self.__sets.get(name)
+		if address_set is not None and address_set.epoch == epoch:
+			diff = address_set.diff(from_version, to_version, full)
+			if diff is not None:
+				return (result + diff, True)
+		with database.transaction() as t:
+			t.execute(self.__diff_query, (name, epoch, from_version, to_version, name, epoch))
+			addresses = t.fetchall()
+		return (result + encode_addresses(addresses, full, self.__logger), False)
+
+	def __diff_failed(self, failure, name):
+		self.__logger.error("Failed to compute diff of %s: %s", name, failure.getTraceback())
 
 	def _provide_diff(self, message, client, prefix=''):
 		"""
 		Decode a message from client, asking for a diff between two versions
 		of the same diff address store (or asking for a full update).
-		The answer is directly sent.
+		The answer is sent once it is ready.
 		"""
 		(full,) = struct.unpack('!?', message[:1])
 		(name, message) = extract_string(message[1:])
@@ -161,4 +581,11 @@ class DiffAddrStore:
 		else:
 			(epoch, from_version, to_version) = numbers
 		self.__logger.debug('Sending diff for %s@%s from %s to %s to client %s', name, epoch, from_version, to_version, client)
-		self.send(self.__diff_update(name, full, epoch, from_version, to_version, prefix), client)
+		self.__prefixes.add(prefix)
+		compressed = bool(full and self.__compress_version and (self.version(client) or 0) >= self.__compress_version)
+		def send(message):
+			try:
+				self.send(message, client)
+			except KeyError:
+				self.__logger.debug('Client %s disconnected before its diff was ready', client)
+		self.__diff_update(name, full, epoch, from_version, to_version, prefix, compressed).addCallbacks(send, self.__diff_failed, errbackArgs=(name,))
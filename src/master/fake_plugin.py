@@ -17,86 +17,92 @@
 #    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
-from twisted.internet import reactor
 import logging
 import struct
 import plugin
 import activity
-import socket
-import protocol
+import decoders
+import client_cache
+import spool
 import database
 import psycopg2
 
 logger = logging.getLogger(name='fake')
 
 types = ['connect', 'disconnect', 'lost', 'extra', 'timeout', 'login']
-families = [{
-	'len': 4,
-	'opt': socket.AF_INET
-}, {
-	'len': 16,
-	'opt': socket.AF_INET6
-}]
 
-def store_logs(message, client, now, version):
+def queue_logs(message, client, now, version, offset=0):
+	"""
+	Decode and store the log events in the background (see plugin.decode_rows).
+	"""
+	plugin.decode_rows('fake', client, decode_logs, (message, now, version, offset))
+
+def decode_logs(message, now, version, offset=0):
 	values = []
-	count = 0
-	while message:
-		if version <= 1:
-			(age, type_idx, family_idx, info_count, code) = struct.unpack('!IBBBc', message[:8])
-			rem_port = None
-			message = message[8:]
-		else:
-			(age, type_idx, family_idx, info_count, code, rem_port) = struct.unpack('!IBBBcH', message[:10])
-			message = message[10:]
+	for (age, type_idx, code, rem_port, rem_address, loc_address, infos) in decoders.fake_logs(message, version, offset):
 		(name, passwd, reason, method, host, uri) = (None, None, None, None, None, None)
 		tp = types[type_idx]
-		family = families[family_idx]
-		rem_address = socket.inet_ntop(family['opt'], message[:family['len']])
-		message = message[family['len']:]
-		if version <= 1:
-			loc_address = None
-		else:
-			loc_address = socket.inet_ntop(family['opt'], message[:family['len']])
-			message = message[family['len']:]
-		for i in range(0, info_count):
-			(kind_i,) = struct.unpack('!B', message[0])
-			(content, message) = protocol.extract_string(message[1:])
-			# Twisted gives us the message as a string. The name, password,
-			# method, uri and host columns are bytea in postgres.
-			# This needs to be resolved by a conversion wrapper
-			# (because python seems to use escaping, not bound
-			# params)
+		for (kind_i, content) in infos:
 			if kind_i == 0:
-				name = psycopg2.Binary(content)
+				name = content
 			elif kind_i == 1:
-				passwd = psycopg2.Binary(content)
+				passwd = content
 			elif kind_i == 2:
 				reason = content
 			elif kind_i == 3:
-				method = psycopg2.Binary(content)
+				method = content
 			elif kind_i == 4:
-				uri = psycopg2.Binary(content)
+				uri = content
 			elif kind_i == 5:
-				host = psycopg2.Binary(content)
-		values.append((now, age, tp, rem_address, loc_address, rem_port, name, passwd, reason, method, host, uri, client, code))
-		count += 1
-	with database.transaction() as t:
-		t.executemany("INSERT INTO fake_logs (client, timestamp, event, remote, local, remote_port, server, name, password, reason, method, host, uri) SELECT clients.id, %s - %s * INTERVAL '1 millisecond', %s, %s, %s, %s, fake_server_names.type, %s, %s, %s, %s, %s, %s FROM clients CROSS JOIN fake_server_names WHERE clients.name = %s AND fake_server_names.code = %s", values)
-	logger.debug("Stored %s fake server log events for client %s", count, client)
+				host = content
+		values.append((now, age, tp, rem_address, loc_address, rem_port, name, passwd, reason, method, host, uri, code))
+	return values
+
+def binary(value):
+	if value is None:
+		return None
+	return psycopg2.Binary(value)
+
+def insert_logs(transaction, client, values):
+	client_id = client_cache.get(transaction, client)
+	if client_id is None:
+		return
+	# Twisted gives us the message as a string. The name, password,
+	# method, uri and host columns are bytea in postgres.
+	# This needs to be resolved by a conversion wrapper
+	# (because python seems to use escaping, not bound
+	# params)
+	values = map(lambda (now, age, tp, rem_address, loc_address, rem_port, name, passwd, reason, method, host, uri, code): (client_id, now, age, tp, rem_address, loc_address, rem_port, binary(name), binary(passwd), reason, binary(method), binary(host), binary(uri), code), values)
+	transaction.executemany("INSERT INTO fake_logs (client, timestamp, event, remote, local, remote_port, server, name, password, reason, method, host, uri) SELECT %s, %s - %s * INTERVAL '1 millisecond', %s, %s, %s, %s, fake_server_names.type, %s, %s, %s, %s, %s, %s FROM fake_server_names WHERE fake_server_names.code = %s", values)
+	logger.debug("Stored %s fake server log events for client %s", len(values), client)
 
 class FakePlugin(plugin.Plugin):
 	def __init__(self, plugins, config):
 		plugin.Plugin.__init__(self, plugins)
 		self.__config = config
+		spool.register('fake', insert_logs)
 
 	def name(self):
 		return 'Fake'
 
+	def message_from_client_buffer(self, buf, offset, client):
+		if buf[offset] == 'L':
+			activity.log_activity(client, 'fake')
+			queue_logs(buf, client, database.now(), self.version(client), offset + 1)
+		else:
+			self.message_from_client(buf[offset:], client)
+
+	def message_stream(self, kind, length, client):
+		if kind != 'L':
+			return None
+		activity.log_activity(client, 'fake')
+		(now, version) = (database.now(), self.version(client))
+		return decoders.Batches(lambda buf: decoders.fake_logs_end(buf, version), lambda batch: queue_logs(batch, client, now, version), lambda left: logger.warn('Truncated fake server log event (%s bytes) from client %s', left, client))
+
 	def message_from_client(self, message, client):
 		if message[0] == 'L':
 			activity.log_activity(client, 'fake')
-			reactor.callInThread(store_logs, message[1:], client, database.now(), self.version(client))
+			queue_logs(message, client, database.now(), self.version(client), 1)
 		elif message[0] == 'C':
 			config = struct.pack('!IIIII', *map(lambda name: int(self.__config[name]), ['version', 'max_age', 'max_size', 'max_attempts', 'throttle_holdback']))
 			self.send('C' + config, client)
@@ -17,7 +17,6 @@
 #    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
-from twisted.internet import reactor
 import plugin
 import struct
 import logging
@@ -26,7 +25,12 @@ import database
 import socket
 import re
 import diff_addr_store
+import decoders
+import client_cache
+import spool
 import timers
+import datetime
+import cStringIO
 
 logger = logging.getLogger(name='flow')
 token_re = re.compile('\(?\s*(.*?)\s*([,\(\)])(.*)')
@@ -175,31 +179,41 @@ filter_index = {
 	'R': FilterRange
 }
 
-def store_flows(client, message, expect_conf_id, now):
-	(header, message) = (message[:12], message[12:])
-	(conf_id, calib_time) = struct.unpack('!IQ', header)
+def check_flow_header(client, header, expect_conf_id, offset=0):
+	(conf_id, calib_time) = decoders.flow_header.unpack_from(header, offset)
 	if conf_id != expect_conf_id:
 		logger.warn('Flows of different config (%s vs. %s) received from client %s', conf_id, expect_conf_id, client)
-	if not message:
+	return calib_time
+
+def check_flows(client, message, expect_conf_id, offset=0):
+	"""
+	Check the header of a message with flows. Return the calibration time
+	from it, or None if there are no flows.
+	"""
+	calib_time = check_flow_header(client, message, expect_conf_id, offset)
+	if len(message) <= offset + decoders.flow_header.size:
 		logger.warn('Empty list of flows from %s', client)
-		return
+		return None
+	return calib_time
+
+def queue_flows(client, message, expect_conf_id, now, offset=0):
+	"""
+	Decode and store the flows in the message in the background (see
+	plugin.decode_rows).
+	"""
+	calib_time = check_flows(client, message, expect_conf_id, offset)
+	if calib_time is not None:
+		queue_flow_records(client, message, offset + decoders.flow_header.size, calib_time, now)
+
+def queue_flow_records(client, message, offset, calib_time, now):
+	plugin.decode_rows('flow', client, decode_flows, (client, message, offset, calib_time, now))
+
+def decode_flows(client, message, offset, calib_time, now):
 	values = []
-	count = 0
-	while message:
-		(flow, message) = (message[:61], message[61:])
-		(flags, cin, cout, sin, sout, ploc, prem, tbin, tbout, tein, teout) = struct.unpack('!BIIQQHHQQQQ', flow)
-		v6 = flags & 1
+	for (flags, cin, cout, sin, sout, ploc, prem, tbin, tbout, tein, teout, aloc, arem) in decoders.flows(message, offset):
 		udp = flags & 2
 		in_started = not not (flags & 4)
 		out_started = not not (flags & 8)
-		if v6:
-			size = 16
-			tp = socket.AF_INET6
-		else:
-			size = 4
-			tp = socket.AF_INET
-		(aloc, arem, message) = (message[:size], message[size:2 * size], message[2 * size:])
-		(aloc, arem) = map (lambda addr: socket.inet_ntop(tp, addr), (aloc, arem))
 		if udp:
 			proto = 'U'
 		else:
@@ -211,11 +225,77 @@ def store_flows(client, message, expect_conf_id, now):
 				logger.error("Time difference out of range for client %s: %s/%s", client, calib_time - v, v)
 				ok = False
 		if ok:
-			values.append((aloc, arem, ploc, prem, proto, now, calib_time - tbin if tbin > 0 else None, now, calib_time - tbout if tbout > 0 else None, now, calib_time - tein if tein > 0 else None, now, calib_time - teout if teout > 0 else None, cin, cout, sin, sout, in_started, out_started, client))
-			count += 1
-	with database.transaction() as t:
-		t.executemany("INSERT INTO biflows (client, ip_local, ip_remote, port_local, port_remote, proto, start_in, start_out, stop_in, stop_out, count_in, count_out, size_in, size_out, seen_start_in, seen_start_out) SELECT clients.id, %s, %s, %s, %s, %s, %s - %s * INTERVAL '1 millisecond', %s - %s * INTERVAL '1 millisecond', %s - %s * INTERVAL '1 millisecond', %s - %s * INTERVAL '1 millisecond', %s, %s, %s, %s, %s, %s FROM clients WHERE clients.name = %s", values)
-	logger.debug("Stored %s flows for %s", count, client)
+			values.append((aloc, arem, ploc, prem, proto, now, calib_time - tbin if tbin > 0 else None, now, calib_time - tbout if tbout > 0 else None, now, calib_time - tein if tein > 0 else None, now, calib_time - teout if teout > 0 else None, cin, cout, sin, sout, in_started, out_started))
+	return values
+
+def insert_flows(transaction, client, values):
+	"""
+	Store the flows, one insert for each.
+	"""
+	client_id = client_cache.get(transaction, client)
+	if client_id is None:
+		return
+	transaction.executemany("INSERT INTO biflows (client, ip_local, ip_remote, port_local, port_remote, proto, start_in, start_out, stop_in, stop_out, count_in, count_out, size_in, size_out, seen_start_in, seen_start_out) VALUES (%s, %s, %s, %s, %s, %s, %s - %s * INTERVAL '1 millisecond', %s - %s * INTERVAL '1 millisecond', %s - %s * INTERVAL '1 millisecond', %s - %s * INTERVAL '1 millisecond', %s, %s, %s, %s, %s, %s)", map(lambda v: (client_id,) + v, values))
+	logger.debug("Stored %s flows for %s", len(values), client)
+
+def copy_time(now, delta):
+	if delta is None:
+		return '\\N'
+	return str(now - datetime.timedelta(milliseconds=delta))
+
+def copy_flows(transaction, client, values):
+	"""
+	Store the flows through COPY FROM STDIN. The client is looked up only
+	once for the whole batch and the rows are streamed into biflows from
+	an in-memory staging buffer instead of being inserted one by one.
+	"""
+	client_id = client_cache.get(transaction, client)
+	if client_id is None:
+		return
+	client_id = str(client_id)
+	buf = cStringIO.StringIO()
+	for (aloc, arem, ploc, prem, proto, now, tbin, _, tbout, _, tein, _, teout, cin, cout, sin, sout, in_started, out_started) in values:
+		buf.write('\t'.join((client_id, aloc, arem, str(ploc), str(prem), proto, copy_time(now, tbin), copy_time(now, tbout), copy_time(now, tein), copy_time(now, teout), str(cin), str(cout), str(sin), str(sout), 't' if in_started else 'f', 't' if out_started else 'f')))
+		buf.write('\n')
+	buf.seek(0)
+	transaction.copy_from(buf, 'biflows', columns=('client', 'ip_local', 'ip_remote', 'port_local', 'port_remote', 'proto', 'start_in', 'start_out', 'stop_in', 'stop_out', 'count_in', 'count_out', 'size_in', 'size_out', 'seen_start_in', 'seen_start_out'))
+
+class FlowStream:
+	"""
+	Receives a large message with flows as it arrives (see
+	Plugin.message_stream). The flows are decoded and stored in batches
+	in the background, so the whole message is never held in memory.
+	"""
+	def __init__(self, client, expect_conf_id, now):
+		self.__client = client
+		self.__expect_conf_id = expect_conf_id
+		self.__now = now
+		self.__header = ''
+		self.__batches = None
+
+	def feed(self, data):
+		if self.__batches is None:
+			missing = decoders.flow_header.size - len(self.__header)
+			self.__header += data[:missing]
+			if len(self.__header) < decoders.flow_header.size:
+				return
+			data = data[missing:]
+			calib_time = check_flow_header(self.__client, self.__header, self.__expect_conf_id)
+			(client, now) = (self.__client, self.__now)
+			self.__batches = decoders.Batches(decoders.flows_end, lambda batch: queue_flow_records(client, batch, 0, calib_time, now), lambda left: logger.warn('Truncated flow record (%s bytes) from %s', left, client))
+		if data:
+			self.__batches.feed(data)
+
+	def finish(self):
+		if self.__batches is None:
+			logger.warn('Empty list of flows from %s', self.__client)
+		else:
+			self.__batches.finish()
+
+	def abort(self):
+		logger.warn('Connection to %s lost in the middle of flows', self.__client)
+		if self.__batches is not None:
+			self.__batches.abort()
 
 class FlowPlugin(plugin.Plugin, diff_addr_store.DiffAddrStore):
 	"""
@@ -224,8 +304,13 @@ class FlowPlugin(plugin.Plugin, diff_addr_store.DiffAddrStore):
 	def __init__(self, plugins, config):
 		plugin.Plugin.__init__(self, plugins)
 		self.__top_filter_cache = {}
-		diff_addr_store.DiffAddrStore.__init__(self, logger, "flow", "flow_filters", "filter")
+		diff_addr_store.DiffAddrStore.__init__(self, logger, "flow", "flow_filters", "filter", int(config.get('compress_version', 0)))
 		self.__delayed_config = {}
+		# How to push the flows into the DB. Either 'insert' (row by row) or 'copy' (bulk COPY FROM STDIN).
+		self.__ingest = config.get('ingest', 'insert')
+		if self.__ingest not in ('insert', 'copy'):
+			raise Exception('Unknown flow ingest mode ' + self.__ingest)
+		spool.register('flow', copy_flows if self.__ingest == 'copy' else insert_flows)
 		self.__delayed_conf_timer = timers.timer(self.__delayed_config_send, 120)
 
 	# A workaround. Currently, clients sometime need to recreate their local
@@ -254,13 +339,13 @@ class FlowPlugin(plugin.Plugin, diff_addr_store.DiffAddrStore):
 
 	def _broadcast_config(self):
 		self.__top_filter_cache = {}
-		self.broadcast(self.__build_config(''), lambda version: version < 2)
-		self.broadcast(self.__build_config('-diff'), lambda version: version >= 2)
+		self.broadcast(self.__build_config(''), lambda version: version < 2, paced=True)
+		self.broadcast(self.__build_config('-diff'), lambda version: version >= 2, paced=True)
 		for a in self._addresses:
 			self._broadcast_version(a, self._addresses[a][0], self._addresses[a][1])
 
 	def _broadcast_version(self, name, epoch, version):
-		self.broadcast(self.__build_filter_version(name, epoch, version), lambda version: version >= 2)
+		self.broadcast(self.__build_filter_version(name, epoch, version), lambda version: version >= 2, paced=True)
 
 	def __build_filter_version(self, name, epoch, version):
 		return 'U' + struct.pack('!I' + str(len(name)) + 'sII', len(name), name, epoch, version)
@@ -297,10 +382,26 @@ class FlowPlugin(plugin.Plugin, diff_addr_store.DiffAddrStore):
 		elif message[0] == 'D':
 			logger.debug('Flows from %s', client)
 			activity.log_activity(client, 'flow')
-			reactor.callInThread(store_flows, client, message[1:], int(self._conf['version']), database.now())
+			queue_flows(client, message, int(self._conf['version']), database.now(), 1)
 		elif message[0] == 'U':
 			self._provide_diff(message[1:], client)
 
+	def message_from_client_buffer(self, buf, offset, client):
+		if buf[offset] == 'D':
+			# Decode the flows right from the received frame
+			logger.debug('Flows from %s', client)
+			activity.log_activity(client, 'flow')
+			queue_flows(client, buf, int(self._conf['version']), database.now(), offset + 1)
+		else:
+			self.message_from_client(buf[offset:], client)
+
+	def message_stream(self, kind, length, client):
+		if kind != 'D':
+			return None
+		logger.debug('Streaming flows from %s', client)
+		activity.log_activity(client, 'flow')
+		return FlowStream(client, int(self._conf['version']), database.now())
+
 	def name(self):
 		return 'Flow'
 
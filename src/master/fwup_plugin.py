@@ -21,6 +21,7 @@ import plugin
 import logging
 import database
 import diff_addr_store
+import notify
 import struct
 from protocol import extract_string
 
@@ -33,7 +34,13 @@ class FWUpPlugin(plugin.Plugin, diff_addr_store.DiffAddrStore):
 	def __init__(self, plugins, config):
 		plugin.Plugin.__init__(self, plugins)
 		self.__sets = {}
-		diff_addr_store.DiffAddrStore.__init__(self, logger, "fwup", "fwup_addresses", "set")
+		diff_addr_store.DiffAddrStore.__init__(self, logger, "fwup", "fwup_addresses", "set", int(config.get('compress_version', 0)))
+		notify.subscribe('fwup_sets', self.__sets_notified)
+
+	def __sets_notified(self, payload):
+		if self._conf: # Not before the first config is loaded
+			logger.info("The fwup sets changed, broadcasting config")
+			self._broadcast_config()
 
 	def __build_config(self):
 		def convert(name):
@@ -46,13 +53,13 @@ class FWUpPlugin(plugin.Plugin, diff_addr_store.DiffAddrStore):
 			t.execute("SELECT name, type, maxsize, hashsize FROM fwup_sets")
 			self.__sets = dict(map(lambda (name, tp, maxsize, hashsize): (name, (tp, maxsize, hashsize)), t.fetchall()))
 		self.__config_message = self.__build_config()
-		self.broadcast(self.__config_message)
+		self.broadcast(self.__config_message, paced=True)
 
 	def __build_version_info(self, name, epoch, version):
 		return 'V' + struct.pack('!II' + str(len(name)) + 'sII', int(self._conf.get('version', 0)), len(name), name, epoch, version)
 
 	def _broadcast_version(self, name, epoch, version):
-		self.broadcast(self.__build_version_info(name, epoch, version))
+		self.broadcast(self.__build_version_info(name, epoch, version), paced=True)
 
 	def message_from_client(self, message, client):
 		if message[0] == 'C':
@@ -0,0 +1,130 @@
+#
+#    Ucollect - small utility for real-time analysis of network data
+#    Copyright (C) 2016 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Measuring how fast the master reacts. Two things are measured:
+- The round trip times of the pings sent to the clients (reported by
+  the clients through pong()).
+- How late the reactor runs. A probe is scheduled every now and then and
+  the delay between the planned and the real time it is called is the lag.
+  The clients see it as a delay in everything, including the pings.
+
+Every latency_interval seconds, the percentiles of both are logged,
+together with the histograms of the clients with the worst round trips.
+With latency_store they are stored in the master_latency table too, with
+a row (and a histogram) for each of the clients.
+"""
+
+from twisted.internet import reactor
+from master_config import get, getint
+import bisect
+import logging
+import time
+import database
+import timers
+import shard
+
+logger = logging.getLogger(name='latency')
+
+# Upper bounds of the histogram buckets, in seconds. There's one more for the rest.
+buckets = (0.01, 0.05, 0.1, 0.5, 1, 5)
+worst_count = 5
+
+__rtts = {} # cid -> list of the round trip times since the last summary
+__lags = []
+__probe_interval = None # None when not measuring
+__timer = None
+
+def pong(cid, rtt):
+	"""
+	The client answered a ping after rtt seconds.
+	"""
+	if __probe_interval is not None:
+		__rtts.setdefault(cid, []).append(rtt)
+
+def __probe(expected):
+	now = time.time()
+	__lags.append(max(0, now - expected))
+	reactor.callLater(__probe_interval, __probe, now + __probe_interval)
+
+def summary(values):
+	"""
+	Percentiles (p50, p95, p99, max) and the histogram of the values.
+	None if there are no values.
+	"""
+	if not values:
+		return None
+	values = sorted(values)
+	def percentile(p):
+		return values[min(len(values) - 1, len(values) * p / 100)]
+	histogram = [0] * (len(buckets) + 1)
+	for value in values:
+		histogram[bisect.bisect_left(buckets, value)] += 1
+	return (percentile(50), percentile(95), percentile(99), values[-1], histogram)
+
+def __ms(value):
+	return value * 1000
+
+def __row(now, worker, kind, summary, client=None, worst=None):
+	(p50, p95, p99, top, histogram) = summary
+	return (now, worker, kind, sum(histogram), __ms(p50), __ms(p95), __ms(p99), __ms(top), histogram, client, worst)
+
+def __store(rows):
+	with database.transaction() as t:
+		t.executemany("INSERT INTO master_latency (timestamp, worker, kind, samples, p50, p95, p99, max, histogram, client, worst_clients) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", rows)
+
+def __summarize():
+	global __rtts
+	global __lags
+	(rtts, lags) = (__rtts, __lags)
+	(__rtts, __lags) = ({}, [])
+	rows = []
+	now = database.now()
+	worker = shard.worker_index()
+	ping = summary([rtt for values in rtts.values() for rtt in values])
+	if ping:
+		clients = dict((cid, summary(values)) for (cid, values) in rtts.items())
+		worst = sorted(clients.keys(), key=lambda cid: clients[cid][3], reverse=True)[:worst_count]
+		(p50, p95, p99, top, histogram) = ping
+		logger.info("Ping RTT of %s clients: p50 %.1f ms, p95 %.1f ms, p99 %.1f ms, max %.1f ms, histogram %s", len(rtts), __ms(p50), __ms(p95), __ms(p99), __ms(top), histogram)
+		for cid in worst:
+			(p50, p95, p99, top, histogram) = clients[cid]
+			logger.info("Slow client %s: p50 %.1f ms, max %.1f ms, histogram %s", cid, __ms(p50), __ms(top), histogram)
+		rows.append(__row(now, worker, 'P', ping, worst=worst))
+		rows.extend(__row(now, worker, 'C', value, client=cid) for (cid, value) in clients.items())
+	lag = summary(lags)
+	if lag:
+		(p50, p95, p99, top, histogram) = lag
+		logger.info("Reactor lag: p50 %.1f ms, p95 %.1f ms, p99 %.1f ms, max %.1f ms, histogram %s", __ms(p50), __ms(p95), __ms(p99), __ms(top), histogram)
+		rows.append(__row(now, worker, 'L', lag))
+	if rows and getint('latency_store', 0):
+		reactor.callInThread(__store, rows)
+
+def start():
+	"""
+	Start the lag probe and the periodic summaries, if configured.
+	"""
+	global __probe_interval
+	global __timer
+	interval = getint('latency_interval', 300)
+	if interval <= 0:
+		return
+	__probe_interval = float(get('latency_probe_interval', '1'))
+	reactor.callLater(__probe_interval, __probe, time.time() + __probe_interval)
+	__timer = timers.timer(__summarize, interval)
@@ -27,12 +27,16 @@ config_data = ConfigParser.RawConfigParser()
 with open(sys.argv[1]) as f:
 	config_data.readfp(f, sys.argv[1])
 
-def get(name):
+def get(name, default=None):
 	global config_data
+	if default is not None and not config_data.has_option('main', name):
+		return default
 	return config_data.get('main', name)
 
-def getint(name):
+def getint(name, default=None):
 	global config_data
+	if default is not None and not config_data.has_option('main', name):
+		return default
 	return config_data.getint('main', name)
 
 def plugins():
@@ -0,0 +1,246 @@
+#
+#    Ucollect - small utility for real-time analysis of network data
+#    Copyright (C) 2016 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Notifications about changes in the DB, by the postgres LISTEN/NOTIFY.
+
+The triggers in the DB send notifications when the config, the known
+plugins or the address sets change. A thread listens for them on a
+dedicated connection and calls the subscribed callbacks (in the reactor
+thread), so the changes propagate right away. The periodic checks are
+still done, but less often (see fallback_interval()).
+
+It is turned on by the db_notify option. In a sharded master, only the
+coordinator listens and it relays the notifications to the workers. If
+they are not turned on, the coordinator polls the tables for the workers
+instead (see Poller), so they don't all do the periodic checks.
+"""
+
+from twisted.internet import reactor
+import psycopg2
+import psycopg2.extensions
+import select
+import threading
+import logging
+import time
+import database
+import timers
+import shard
+from master_config import getint
+from twisted.internet import threads
+
+logger = logging.getLogger(name='notify')
+
+__subscribers = {}
+__thread = None
+__running = False
+
+# The queries to poll with instead of the notifications, per channel. The first
+# column is the payload of the notification, the rest changes with the data.
+poll_queries = {
+	'config': "SELECT plugin, name, value FROM config ORDER BY plugin, name",
+	'addr_set_versions': "SELECT address_table, name, epoch, version FROM addr_set_versions ORDER BY address_table, name",
+	'known_plugins': "SELECT '', name, version, hash, status FROM known_plugins ORDER BY name, version, hash",
+	'fwup_sets': "SELECT '', name, type, maxsize, hashsize FROM fwup_sets ORDER BY name"
+}
+
+def enabled():
+	"""
+	If the notifications are configured. The periodic checks may be done
+	less often then.
+	"""
+	return bool(getint('db_notify', 0))
+
+def relayed():
+	"""
+	If this process doesn't listen itself and gets the changes from someone
+	else through deliver() (a worker of a sharded master gets them from
+	the coordinator, either notified or polled).
+	"""
+	return shard.worker_index() is not None
+
+def delivered():
+	"""
+	If the changes are delivered to the subscribers, one way or another.
+	"""
+	return enabled() or relayed()
+
+def fallback_interval(interval):
+	"""
+	How often to do a periodic check that would be done every interval
+	seconds without the notifications.
+	"""
+	if delivered():
+		return max(interval, getint('db_notify_fallback', 900))
+	return interval
+
+def subscribe(channel, callback):
+	"""
+	Call the callback with the payload of each notification on the channel.
+	If the connection to the DB was lost (and some notifications might
+	have been missed), it is called with None once listening again.
+	Subscribe before start().
+	"""
+	__subscribers.setdefault(channel, []).append(callback)
+
+def channels():
+	"""
+	The channels something subscribed to.
+	"""
+	return __subscribers.keys()
+
+def deliver(channel, payload):
+	"""
+	Pass a relayed notification to the subscribers.
+	"""
+	__dispatch(channel, payload)
+
+def __dispatch(channel, payload):
+	for callback in __subscribers.get(channel, []):
+		try:
+			callback(payload)
+		except Exception:
+			logger.exception("Error handling notification on %s", channel)
+
+def __listen():
+	connection = None
+	reconnected = False
+	while __running:
+		try:
+			if connection is None:
+				connection = database.dedicated_connection(lambda: __running)
+				if connection is None:
+					break # Stopped while waiting for the DB
+				connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+				cursor = connection.cursor()
+				for channel in __subscribers:
+					cursor.execute('LISTEN ' + channel)
+				logger.info("Listening for DB notifications on %s", ', '.join(__subscribers.keys()))
+				if reconnected:
+					# We listen again, but something might have changed while we didn't
+					reconnected = False
+					for channel in __subscribers:
+						reactor.callFromThread(__dispatch, channel, None)
+			if select.select([connection], [], [], 5) == ([], [], []):
+				continue
+			connection.poll()
+			events = set()
+			while connection.notifies:
+				notification = connection.notifies.pop(0)
+				events.add((notification.channel, notification.payload))
+			for (channel, payload) in events:
+				logger.debug("Notification on %s: %s", channel, payload)
+				reactor.callFromThread(__dispatch, channel, payload)
+		except Exception as e:
+			logger.error("Lost the DB notifications connection, reconnecting: %s", e)
+			if connection is not None:
+				try:
+					connection.close()
+				except Exception:
+					pass
+			connection = None
+			reconnected = True
+			time.sleep(1)
+	if connection is not None:
+		connection.close()
+	logger.info("Stopped listening for DB notifications")
+
+def start():
+	"""
+	Start listening, if configured. Call after everything subscribed.
+	"""
+	global __thread
+	global __running
+	if not enabled() or not __subscribers or relayed():
+		return
+	__running = True
+	__thread = threading.Thread(target=__listen, name='notify')
+	__thread.daemon = True
+	__thread.start()
+
+def stop():
+	global __running
+	__running = False
+	if __thread:
+		# It notices within a few seconds, unless it is stuck in the DB
+		__thread.join(10)
+
+class Poller:
+	"""
+	Polls the tables of the channels (see poll_queries) every interval
+	seconds and calls the callback with the channel and the payload of the
+	notification that would be sent for each change. It stands in for the
+	notifications when they are not turned on. A channel without a query
+	(or with one that fails) gets None on each poll, meaning a full check.
+	"""
+	def __init__(self, channels, callback, interval):
+		self.__channels = channels
+		self.__callback = callback
+		self.__state = None
+		self.__polling = False
+		self.__timer = timers.timer(self.__poll, interval, True)
+
+	def __poll(self):
+		if self.__polling:
+			return # The last one is still running, the DB is slow
+		self.__polling = True
+		def done(state):
+			self.__polling = False
+			self.__compare(state)
+		def failed(failure):
+			self.__polling = False
+			logger.error("Failed to poll for changes: %s", failure.getTraceback())
+		threads.deferToThread(self.__read).addCallbacks(done, failed)
+
+	def __read(self):
+		"""
+		Read the state of each channel, as payload -> rows. Runs in a thread.
+		"""
+		result = {}
+		for channel in self.__channels:
+			if channel not in poll_queries:
+				result[channel] = None
+				continue
+			try:
+				with database.transaction() as t:
+					t.execute(poll_queries[channel])
+					state = {}
+					for row in t.fetchall():
+						state.setdefault(row[0], []).append(tuple(row[1:]))
+					result[channel] = state
+			except psycopg2.ProgrammingError as e:
+				logger.warn("Can't poll %s, asking for a full check: %s", channel, e)
+				result[channel] = None
+		return result
+
+	def __compare(self, state):
+		(old, self.__state) = (self.__state, state)
+		if old is None:
+			return # Everyone checks on their own when starting
+		for channel in self.__channels:
+			if state[channel] is None or old[channel] is None:
+				self.__callback(channel, None)
+				continue
+			for payload in set(state[channel].keys()) | set(old[channel].keys()):
+				if state[channel].get(payload) != old[channel].get(payload):
+					logger.debug("Polled change on %s: %s", channel, payload)
+					self.__callback(channel, payload)
+
+	def stop(self):
+		self.__timer.stop()
@@ -19,14 +19,146 @@
 
 from protocol import format_string
 from twisted.python.threadpool import ThreadPool
+from twisted.internet import reactor
+from master_config import getint
+import multiprocessing
+import collections
+import traceback
+import threading
 import logging
+import signal
+import timers
+import spool
 import time
 
 logger = logging.getLogger(name='plugin')
 
 pool = ThreadPool()
 pool.adjustPoolsize(1)
-pool.start()
+# Started by the master, after start_decoders() forked the decoder processes
+
+__decoders = None
+__decoder_log = None
+
+class DecoderLog(logging.Handler):
+	"""
+	Collects the log records in a decoder process, so they can be sent to
+	the master together with the result. The processes don't write the
+	log files themselves, they'd rotate them over each other.
+	"""
+	def __init__(self):
+		logging.Handler.__init__(self)
+		self.records = []
+
+	def emit(self, record):
+		# Only plain data can be pickled
+		record.msg = record.getMessage()
+		record.args = None
+		if record.exc_info:
+			record.exc_text = logging.Formatter().formatException(record.exc_info)
+			record.exc_info = None
+		self.records.append(record)
+
+	def take(self):
+		(records, self.records) = (self.records, [])
+		return records
+
+def __decoder_init():
+	global __decoder_log
+	# Interrupting the master is its business, the decoders are stopped by it
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	root = logging.getLogger()
+	for handler in list(root.handlers):
+		root.removeHandler(handler)
+	__decoder_log = DecoderLog()
+	root.addHandler(__decoder_log)
+
+def start_decoders(workers):
+	"""
+	Start the pool of processes decoding the messages (see decode), if
+	workers is positive.
+
+	The processes are forked, so call it early, before there are any
+	connections to the DB and before any threads start (including the pool).
+	"""
+	global __decoders
+	if workers > 0:
+		if threading.active_count() > 1:
+			logger.warn('Forking the decoder processes with %s threads running', threading.active_count() - 1)
+		__decoders = multiprocessing.Pool(workers, __decoder_init)
+		logger.info('Started %s decoder processes', workers)
+
+def stop_decoders():
+	global __decoders
+	if __decoders is not None:
+		__decoders.terminate()
+		__decoders.join()
+		__decoders = None
+
+def __decode_guarded(decoder, args):
+	try:
+		result = (True, decoder(*args))
+	except Exception:
+		result = (False, traceback.format_exc())
+	return result + (__decoder_log.take(),)
+
+def __decoded(decoder, store, (ok, result, records)):
+	for record in records:
+		logging.getLogger(record.name).handle(record)
+	if ok:
+		reactor.callInThread(store, result)
+	else:
+		logger.error('Decoding by %s failed: %s', decoder.__name__, result)
+
+def __decode_store(decoder, args, store):
+	store(decoder(*args))
+
+def decode(decoder, args, store):
+	"""
+	Call decoder(*args) and pass the result to store in the thread pool of
+	the reactor.
+
+	If the decoder processes are running, the decoder is called in one of
+	them instead of the thread. Then the decoding does not compete for the
+	GIL with the reactor. The decoder must be a module-level function and
+	both the args and the result get pickled, so they should be plain data
+	(strings, numbers, tuples and lists of these). Usually, the decoder
+	turns a message into rows and the store puts them into the spool or
+	the DB.
+
+	What the decoder logs in a process reaches the master log only with
+	the result, after the whole message is decoded (and it is lost if the
+	process dies). Don't rely on the log to see what a decoder does while
+	it runs.
+	"""
+	if __decoders is None:
+		reactor.callInThread(__decode_store, decoder, args, store)
+	else:
+		# The callback runs in a thread of the pool, pass it to the reactor
+		__decoders.apply_async(__decode_guarded, (decoder, args), callback=lambda result: reactor.callFromThread(__decoded, decoder, store, result))
+
+def __decode_packed(kind, client, decoder, args):
+	rows = decoder(*args)
+	return (len(rows), spool.pack(kind, client, rows))
+
+def __store_packed(kind, client, (count, payload)):
+	spool.store_packed(payload)
+	logger.debug('Decoded %s rows of %s for %s', count, kind, client)
+
+def __store_rows(kind, client, rows):
+	spool.store(kind, client, rows)
+	logger.debug('Decoded %s rows of %s for %s', len(rows), kind, client)
+
+def decode_rows(kind, client, decoder, args):
+	"""
+	Decode rows of the given kind with decode() and pass them to
+	spool.store(). In the decoder processes, the rows are pickled for the
+	spool there too, so they don't need to be unpickled here.
+	"""
+	if __decoders is None:
+		decode(decoder, args, lambda rows: __store_rows(kind, client, rows))
+	else:
+		decode(__decode_packed, (kind, client, decoder, args), lambda result: __store_packed(kind, client, result))
 
 class Plugin:
 	"""
@@ -38,6 +170,9 @@ class Plugin:
 	    counterpart.
 	- message_from_client(message): Called when the client sends some data,
 	    usually as a response to some request.
+
+	Plugins receiving large messages may override message_from_client_buffer
+	to read them without copying them out of the received frame.
 	"""
 	def __init__(self, plugins):
 		"""
@@ -71,13 +206,34 @@ class Plugin:
 		"""
 		pass
 
-	def broadcast(self, message, version_check=None):
+	def message_from_client_buffer(self, buf, offset, client):
+		"""
+		Called with a message from the client, which starts at the offset
+		of the buffer (the whole received frame). The default passes
+		a copy of the message to message_from_client.
+		"""
+		self.message_from_client(buf[offset:], client)
+
+	def message_stream(self, kind, length, client):
+		"""
+		Called instead of message_from_client for a large message,
+		before it is received. The kind is the first byte of the
+		message, length the size of the rest. Return a consumer
+		(see protocol.Framer and decoders.Batches) to get the rest
+		as it arrives, or None to get the whole message in
+		message_from_client as usual.
+		"""
+		return None
+
+	def broadcast(self, message, version_check=None, paced=False):
 		"""
 		Broadcast a message from this plugin to all the connected
-		clients.
+		clients. If paced, the message is spread over time (see
+		Plugins.broadcast), use it for messages the clients react
+		to by asking for something.
 		"""
 		logger.trace('Broadcasting message to all clients: %s', repr(message))
-		self.__plugins.broadcast(self.__routed_message(message), self.name(), version_check)
+		self.__plugins.broadcast(self.__routed_message(message), self.name(), version_check, paced)
 
 	def send(self, message, to):
 		"""
@@ -98,6 +254,34 @@ class Plugin:
 	def plugins(self):
 		return self.__plugins
 
+class PacedBroadcast:
+	"""
+	A broadcast being sent at a limited rate (see Plugins.broadcast).
+	"""
+	def __init__(self, frame, plugin, version_check, recipients):
+		self.frame = frame
+		self.plugin = plugin
+		self.version_check = version_check
+		self.versions = {} # Results of the version check, version -> bool
+		self.recipients = recipients
+		self.position = 0 # How many of the recipients were handled already
+		self.started = time.time()
+		self.gone = 0 # Recipients that disconnected or changed the version before their turn
+
+	def wants(self, client):
+		"""
+		If the client still should get the message. It might have disconnected,
+		reconnected or changed the version of the plugin since it was queued.
+		"""
+		if not client.has_plugin(self.plugin):
+			return False
+		if self.version_check is None:
+			return True
+		version = client.plugin_version(self.plugin)
+		if version not in self.versions:
+			self.versions[version] = self.version_check(version)
+		return self.versions[version]
+
 class Plugins:
 	"""
 	Singleton holding all the active plugins and clients. It
@@ -107,6 +291,17 @@ class Plugins:
 		self.__plugins = {}
 		self.__clients = {}
 		self.__activations = {}
+		# Clients to broadcast to, plugin name -> plugin version -> cid -> client
+		self.__subscribers = {}
+		# The paced broadcasts waiting to be sent
+		self.__paced = collections.deque()
+		self.__paced_pending = 0
+		self.__pace_window = getint('broadcast_window', 0)
+		self.__pace_min_rate = getint('broadcast_min_rate', 1000)
+		self.__pace_rate = 0
+		self.__pace_tokens = 0
+		self.__pace_last = None
+		self.__pacer = None
 
 	def get_clients(self):
 		"""
@@ -114,6 +309,12 @@ class Plugins:
 		"""
 		return self.__clients.keys()
 
+	def get_client(self, cid):
+		"""
+		Get the connected client of the given ID, None if there's no such.
+		"""
+		return self.__clients.get(cid)
+
 	def get_plugins(self):
 		"""
 		Get the list of current plugin names.
@@ -125,8 +326,12 @@ class Plugins:
 		Add a plugin to be used.
 		"""
 		logger.info('New plugin %s', name)
+		# The names come from the network with each message, comparing them
+		# with an interned key is slightly faster.
+		name = intern(name)
 		self.__plugins[name] = plugin
 		self.__activations[name] = set()
+		self.__subscribers[name] = {}
 
 	def unregister_plugin(self, name):
 		"""
@@ -138,6 +343,7 @@ class Plugins:
 			# TODO:
 			logger.warn('Plugin %s still has %s active clients. This situation is not handled yet.', name, len(self.__activations[name]))
 		del self.__activations[name]
+		del self.__subscribers[name]
 
 	def activate_client(self, plugin, client):
 		"""
@@ -147,8 +353,11 @@ class Plugins:
 		logger.debug("Activate plugin %s in client %s", plugin, cid)
 		if cid in self.__activations[plugin]:
 			logger.warn("Plugin %s already active in client %s", plugin, cid)
+			# Make sure broadcasts go to the current connection, not some stray one
+			self.__subscribe(plugin, client)
 			return
 		self.__activations[plugin].add(cid)
+		self.__subscribe(plugin, client)
 		self.__plugins[plugin].client_connected(client)
 
 	def deactivate_client(self, plugin, client):
@@ -161,8 +370,36 @@ class Plugins:
 			logger.warn("Plugin %s isn't active in client %s to deactivate", plugin, cid)
 			return
 		self.__activations[plugin].remove(cid)
+		self.__unsubscribe(plugin, cid)
 		self.__plugins[plugin].client_disconnected(client)
 
+	def __subscribe(self, plugin, client):
+		"""
+		Put the client into the broadcast index of the plugin, under the
+		version of the plugin it has (if any).
+		"""
+		cid = client.cid()
+		self.__unsubscribe(plugin, cid)
+		if client.has_plugin(plugin):
+			self.__subscribers[plugin].setdefault(client.plugin_version(plugin), {})[cid] = client
+
+	def __unsubscribe(self, plugin, cid):
+		versions = self.__subscribers[plugin]
+		for version in versions.keys():
+			versions[version].pop(cid, None)
+			if not versions[version]:
+				del versions[version]
+
+	def reindex_client(self, client):
+		"""
+		The set of plugins (or their versions) the client has changed without
+		activating or deactivating them. Update the broadcast index.
+		"""
+		cid = client.cid()
+		for plugin in self.__activations:
+			if cid in self.__activations[plugin]:
+				self.__subscribe(plugin, client)
+
 	def register_client(self, client):
 		"""
 		When a client connects.
@@ -195,18 +432,91 @@ class Plugins:
 		else:
 			logger.debug('Not removing client ' + cid)
 
-	def broadcast(self, message, from_plugin, version_check=None):
+	def broadcast(self, message, from_plugin, version_check=None, paced=False):
 		"""
 		Send a message to all the connected clients who has the given plugin, optionally with a version check.
+
+		The message is framed only once and the version check is called once
+		for each version of the plugin, not for each client.
+
+		A paced broadcast is not sent at once, but queued and sent at a limited
+		rate (see __pace), so the clients don't all react at the same moment.
+		The paced broadcasts are sent in the order they were made. The version
+		check is done again when a queued client gets its turn. A broadcast
+		that is not paced first sends the rest of the pending paced ones of
+		the same plugin at once, so a client doesn't get the messages of the
+		plugin out of order.
+		"""
+		frame = format_string(message)
+		recipients = []
+		for (version, clients) in self.__subscribers[from_plugin].items():
+			if version_check is None or version_check(version):
+				logger.trace('Broadcasting to %s clients with version %s of plugin %s', len(clients), version, from_plugin)
+				recipients.extend(clients.values())
+			else:
+				logger.trace('Not broadcasting to %s clients, they have wrong version of plugin %s (%s)', len(clients), from_plugin, version)
+		if not paced or not self.__pace_window:
+			self.__flush_paced(from_plugin)
+			for c in recipients:
+				c.send_frame(frame)
+			return
+		if not recipients:
+			return
+		self.__paced.append(PacedBroadcast(frame, from_plugin, version_check, recipients))
+		self.__paced_pending += len(recipients)
+		# Enough to send everything queued during the window
+		self.__pace_rate = max(self.__pace_min_rate, self.__paced_pending / float(self.__pace_window))
+		logger.debug('Queued paced broadcast of plugin %s to %s clients, %s messages pending, sending %.0f/s', from_plugin, len(recipients), self.__paced_pending, self.__pace_rate)
+		if not self.__pacer:
+			self.__pace_tokens = 0
+			self.__pace_last = time.time()
+			self.__pacer = timers.timer(self.__pace, 0.1, True)
+
+	def __pace(self):
+		"""
+		Send some of the paced broadcasts. It is a token bucket, filled
+		at the current rate and holding at most 2 ticks worth of tokens.
+		"""
+		now = time.time()
+		self.__pace_tokens = min(self.__pace_tokens + (now - self.__pace_last) * self.__pace_rate, max(1, self.__pace_rate * 0.2))
+		self.__pace_last = now
+		while self.__paced and self.__pace_tokens >= 1:
+			job = self.__paced[0]
+			end = min(len(job.recipients), job.position + int(self.__pace_tokens))
+			self.__pace_tokens -= end - job.position
+			self.__send_paced(job, end)
+			if end == len(job.recipients):
+				self.__paced.popleft()
+		if not self.__paced:
+			self.__pacer.stop()
+			self.__pacer = None
+
+	def __send_paced(self, job, end):
+		"""
+		Send the paced broadcast to its recipients up to the end.
 		"""
-		for c in self.__clients.values():
-			if c.has_plugin(from_plugin):
-				if version_check is None or version_check(c.plugin_version(from_plugin)):
-					c.sendString(message)
-				else:
-					logger.trace('Not broadcasting to %s, client has wrong version of plugin %s (%s)', c.cid(), from_plugin, c.plugin_version(from_plugin))
+		for c in job.recipients[job.position:end]:
+			# The client might have disconnected or reconnected in the meantime
+			if self.__clients.get(c.cid()) is c and job.wants(c):
+				c.send_frame(job.frame)
 			else:
-				logger.trace('Not broadcasting to %s, client does not have plugin %s', c.cid(), from_plugin)
+				job.gone += 1
+		self.__paced_pending -= end - job.position
+		job.position = end
+		if end == len(job.recipients):
+			logger.info('Paced broadcast of plugin %s to %s clients drained in %.3f seconds (%s clients gone meanwhile)', job.plugin, len(job.recipients), time.time() - job.started, job.gone)
+
+	def __flush_paced(self, plugin):
+		"""
+		Send the rest of the pending paced broadcasts of the plugin right away.
+		"""
+		jobs = filter(lambda job: job.plugin == plugin, self.__paced)
+		if not jobs:
+			return
+		logger.debug('Flushing %s paced broadcasts of plugin %s', len(jobs), plugin)
+		for job in jobs:
+			self.__send_paced(job, len(job.recipients))
+		self.__paced = collections.deque(filter(lambda job: job.plugin != plugin, self.__paced))
 
 	def send(self, message, to, plugin=None):
 		"""
@@ -221,13 +531,25 @@ class Plugins:
 			self.__clients[to].sendString(message)
 			return True
 
-	def route_to_plugin(self, name, message, client):
+	def route_to_plugin(self, name, message, client, offset=0):
 		"""
 		Forward a message to plugin of given name. Pass the name
-		of client too.
+		of client too. The message starts at the offset, so it doesn't
+		have to be copied out of the received frame.
 		"""
 		# TODO: The plugin of that name might not exist (#2705)
-		self.__plugins[name].message_from_client(message, client)
+		self.__plugins[name].message_from_client_buffer(message, offset, client)
+
+	def stream_to_plugin(self, name, kind, length, client):
+		"""
+		Ask the plugin of given name for a consumer of a large message
+		(see Plugin.message_stream). Returns None if it doesn't want to
+		stream it.
+		"""
+		plugin = self.__plugins.get(name)
+		if plugin is None:
+			return None
+		return plugin.message_stream(kind, length, client)
 
 	def plugin_version(self, plugin, client):
 		"""
@@ -17,12 +17,16 @@
 #    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 import collections
+import logging
 import weakref
 import time
 import database
 import timers
+import notify
+
+logger = logging.getLogger(name='plugin_versions')
 
 __cache = collections.defaultdict(set)
 __cache_time = 0
@@ -100,4 +104,25 @@ def __time_check():
 	if __update_cache():
 		__propagate_now()
 
-checker = timers.timer(__time_check, 300, False)
+def __reload():
+	global __cache_time
+	__cache_time = 0
+	return __update_cache()
+
+def __notified(payload):
+	"""
+	The known_plugins table changed, reload right away. The DB is read
+	in a thread, it may be slow to answer.
+	"""
+	def done(changed):
+		if changed:
+			__propagate_now()
+	def failed(failure):
+		logger.error("Failed to reload the allowed plugins: %s", failure.getTraceback())
+	threads.deferToThread(__reload).addCallbacks(done, failed)
+
+notify.subscribe('known_plugins', __notified)
+if notify.delivered():
+	# The changes are notified, the cache doesn't need to expire that often
+	__cache_expiration = notify.fallback_interval(__cache_expiration)
+checker = timers.timer(__time_check, notify.fallback_interval(300), False)
@@ -19,10 +19,134 @@
 
 import struct
 
+frame_header = struct.Struct('!L')
+
 def format_string(string):
-	length = len(string)
-	return struct.pack('!L' + str(length) + 's', length, string)
+	return frame_header.pack(len(string)) + string
 
 def extract_string(buf):
 	(slen,) = struct.unpack('!L', buf[:4])
 	return (buf[4:slen + 4], buf[slen + 4:])
+
+def extract_string_at(buf, offset):
+	"""
+	Like extract_string, but the string starts at the offset of the buffer.
+	Instead of a copy of the rest of the buffer, it returns the offset
+	just after the string.
+	"""
+	(slen,) = frame_header.unpack_from(buf, offset)
+	offset += frame_header.size
+	return (buf[offset:offset + slen], offset + slen)
+
+class Framer:
+	"""
+	Splits the data received from a client into the length-prefixed frames.
+
+	The frames are collected as a list of the received pieces and joined
+	once they are complete, so a large frame is copied only once (the
+	Int32StringReceiver concatenates everything buffered with each new
+	piece). Frames of at least stream_threshold bytes that route a message
+	to a plugin ('R') can be streamed instead. The stream_start is called
+	with the plugin name, the first byte of the message (kind) and the
+	length of the rest. If it returns a consumer, the rest is passed to
+	its feed() as it arrives and its finish() is called at the end of the
+	frame (or abort(), if the connection is lost in the middle). If it
+	returns None, the frame is received whole as usual.
+	"""
+	def __init__(self, frame_received, stream_start, too_long, max_length, stream_threshold):
+		self.__frame_received = frame_received
+		self.__stream_start = stream_start
+		self.__too_long = too_long
+		self.__max_length = max_length
+		self.__stream_threshold = stream_threshold
+		self.__head = ''
+		self.__parts = None
+		self.__stream = None
+		self.__left = 0
+		self.__broken = False
+
+	def __head_size(self):
+		"""
+		How much of the frame start we need before deciding how to receive
+		the frame. It is the length prefix and, for large frames, the
+		routing header plus the kind byte.
+		"""
+		head = self.__head
+		if len(head) < 4:
+			return 4
+		(length,) = frame_header.unpack_from(head)
+		if length < self.__stream_threshold or length > self.__max_length:
+			return 4
+		if len(head) < 9:
+			return min(9, 4 + length)
+		if head[4] != 'R':
+			return len(head)
+		(name_len,) = frame_header.unpack_from(head, 5)
+		if name_len > 255:
+			return len(head)
+		return min(10 + name_len, 4 + length)
+
+	def __start_frame(self):
+		head = self.__head
+		self.__head = ''
+		(length,) = frame_header.unpack_from(head)
+		if length > self.__max_length:
+			self.__broken = True
+			self.__too_long(length)
+			return
+		body = head[4:]
+		left = length - len(body)
+		if len(body) > 5 and body[0] == 'R':
+			(name_len,) = frame_header.unpack_from(body, 1)
+			if len(body) == 6 + name_len:
+				stream = self.__stream_start(body[5:5 + name_len], body[5 + name_len], left)
+				if stream is not None:
+					if left:
+						(self.__stream, self.__left) = (stream, left)
+					else:
+						stream.finish()
+					return
+		if left:
+			(self.__parts, self.__left) = ([body], left)
+		else:
+			self.__frame_received(body)
+
+	def feed(self, data):
+		offset = 0
+		end = len(data)
+		while offset < end and not self.__broken:
+			if self.__stream is not None:
+				size = min(self.__left, end - offset)
+				self.__stream.feed(data if size == end else data[offset:offset + size])
+				offset += size
+				self.__left -= size
+				if not self.__left:
+					stream = self.__stream
+					self.__stream = None
+					stream.finish()
+			elif self.__parts is not None:
+				size = min(self.__left, end - offset)
+				self.__parts.append(data if size == end else data[offset:offset + size])
+				offset += size
+				self.__left -= size
+				if not self.__left:
+					frame = ''.join(self.__parts)
+					self.__parts = None
+					self.__frame_received(frame)
+			else:
+				size = min(self.__head_size() - len(self.__head), end - offset)
+				self.__head += data[offset:offset + size]
+				offset += size
+				if len(self.__head) == self.__head_size():
+					self.__start_frame()
+
+	def abort(self):
+		"""
+		The connection is gone. Abort the stream in progress, if any.
+		"""
+		self.__broken = True
+		self.__parts = None
+		if self.__stream is not None:
+			stream = self.__stream
+			self.__stream = None
+			stream.abort()
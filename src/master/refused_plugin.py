@@ -17,44 +17,56 @@
 #    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
-from twisted.internet import reactor
 import database
 import plugin
 import activity
 import logging
 import struct
-import socket
+import decoders
+import client_cache
+import spool
 
 logger = logging.getLogger(name='refused')
 
-def store_connections(message, client, now):
-	(basetime,) = struct.unpack('!Q', message[:8])
-	message = message[8:]
+def queue_connections(message, client, now, offset=0):
+	"""
+	Decode and store the refused connections in the background (see
+	plugin.decode_rows).
+	"""
+	plugin.decode_rows('refused', client, decode_connections, (message, client, now, offset))
+
+def decode_connections(message, client, now, offset=0):
 	values = []
-	count = 0
-	while message:
-		(time, reason, family, loc_port, rem_port) = struct.unpack('!QcBHH', message[:14])
-		addr_len = 4 if family == 4 else 16
-		address = message[14:14 + addr_len]
-		address = socket.inet_ntop(socket.AF_INET if family == 4 else socket.AF_INET6, address)
-		message = message[14 + addr_len:]
+	for (basetime, time, reason, family, loc_port, rem_port, address) in decoders.refused(message, offset):
 		if basetime - time > 86400000:
 			logger.error("Refused time difference is out of range for client %s: %s", client, basetime - time)
 			continue
-		values.append((now, basetime - time, address, loc_port, rem_port, reason, client))
-		count += 1
-	with database.transaction() as t:
-		t.executemany("INSERT INTO refused (client, timestamp, address, local_port, remote_port, reason) SELECT clients.id, %s - %s * INTERVAL '1 millisecond', %s, %s, %s, %s FROM clients WHERE clients.name = %s", values)
-	logger.debug("Stored %s refused connections for client %s", count, client)
+		values.append((now, basetime - time, address, loc_port, rem_port, reason))
+	return values
+
+def insert_connections(transaction, client, values):
+	client_id = client_cache.get(transaction, client)
+	if client_id is None:
+		return
+	transaction.executemany("INSERT INTO refused (client, timestamp, address, local_port, remote_port, reason) VALUES (%s, %s - %s * INTERVAL '1 millisecond', %s, %s, %s, %s)", map(lambda v: (client_id,) + v, values))
+	logger.debug("Stored %s refused connections for client %s", len(values), client)
 
 class RefusedPlugin(plugin.Plugin):
 	def __init__(self, plugins, config):
 		plugin.Plugin.__init__(self, plugins)
 		self.__config = config
+		spool.register('refused', insert_connections)
 
 	def name(self):
 		return 'Refused'
 
+	def message_from_client_buffer(self, buf, offset, client):
+		if buf[offset] == 'D':
+			activity.log_activity(client, 'refused')
+			queue_connections(buf, client, database.now(), offset + 1)
+		else:
+			self.message_from_client(buf[offset:], client)
+
 	def message_from_client(self, message, client):
 		if message == 'C':
 			logger.debug("Sending config %s to client %s", self.__config['version'], client)
@@ -62,6 +74,6 @@ class RefusedPlugin(plugin.Plugin):
 			self.send('C' + config, client)
 		elif message[0] == 'D':
 			activity.log_activity(client, 'refused')
-			reactor.callInThread(store_connections, message[1:], client, database.now())
+			queue_connections(message, client, database.now(), 1)
 		else:
 			logger.error("Unknown message from client %s: %s", client, message)
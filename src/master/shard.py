@@ -0,0 +1,131 @@
+#
+#    Ucollect - small utility for real-time analysis of network data
+#    Copyright (C) 2016 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Running the master as several processes, to use more than one CPU.
+
+With the shard_workers option set, the master process becomes
+a coordinator. It binds the socket soxy connects to and forks the workers,
+which all accept connections from it (the kernel hands each connection to
+one of them). The workers serve the clients and run the plugins, except for
+the ones listed in shard_coordinator_plugins. These do things for the whole
+fleet (like the spoof batches or the sniff tasks), so they run only once,
+in the coordinator. See shard_control for how the processes talk together.
+
+This module does the forking, so it must not start any threads, open
+connections to the DB or import the reactor. Call fork() before doing any
+of these.
+"""
+
+import os
+import socket
+import signal
+from master_config import get, getint
+
+__workers = {} # index -> pid, in the coordinator
+__index = None # The index of this worker, in the worker
+__listen = None # The socket to accept the client connections from, in the worker
+__control = None # Socket to the coordinator (in the worker) or index -> socket to the workers (in the coordinator)
+
+def worker_count():
+	return getint('shard_workers', 0)
+
+def sharded():
+	"""
+	If the master runs as several processes.
+	"""
+	return worker_count() > 0
+
+def coordinator():
+	return sharded() and __index is None
+
+def worker_index():
+	"""
+	The index of this worker, None in the coordinator or when not sharded.
+	"""
+	return __index
+
+def coordinator_plugins():
+	"""
+	The config sections of the plugins running in the coordinator.
+	"""
+	return frozenset(get('shard_coordinator_plugins', '').split())
+
+def hosts(section):
+	"""
+	If the plugin from the given config section runs in this process.
+	"""
+	if not sharded():
+		return True
+	return (section in coordinator_plugins()) == coordinator()
+
+def listen_socket():
+	return __listen
+
+def control_sockets():
+	return __control
+
+def fork(path):
+	"""
+	Bind the unix socket at path and fork the workers, if configured. Returns
+	in the coordinator and in each of the workers.
+	"""
+	global __index
+	global __listen
+	global __control
+	count = worker_count()
+	if not count:
+		return
+	if os.path.exists(path):
+		os.unlink(path)
+	listen = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	listen.bind(path)
+	listen.listen(128)
+	controls = {}
+	for index in range(0, count):
+		(ours, theirs) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+		pid = os.fork()
+		if pid == 0:
+			ours.close()
+			for other in controls.values():
+				other.close()
+			(__index, __listen, __control) = (index, listen, theirs)
+			return
+		theirs.close()
+		controls[index] = ours
+		__workers[index] = pid
+	# The workers accept the connections, not us
+	listen.close()
+	__control = controls
+
+def terminate():
+	"""
+	Terminate the workers and wait for them to finish (in the coordinator).
+	"""
+	for pid in __workers.values():
+		try:
+			os.kill(pid, signal.SIGTERM)
+		except OSError:
+			pass # Already gone
+	for pid in __workers.values():
+		try:
+			os.waitpid(pid, 0)
+		except OSError:
+			pass
+	__workers.clear()
@@ -0,0 +1,363 @@
+#
+#    Ucollect - small utility for real-time analysis of network data
+#    Copyright (C) 2016 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+The control connections between the coordinator and the workers (see shard).
+
+Each worker tells the coordinator about its clients and the plugins active
+in them. The coordinator keeps a RemoteClient for each of them, so the
+plugins running there see the clients of the whole fleet and anything they
+send to a client is passed to the right worker. The messages from the
+clients to these plugins are passed the other way by a Proxy plugin of the
+same name in the worker.
+
+The coordinator is also the only one listening for the DB notifications,
+it relays them to the workers. So the checks the plugins do on these
+notifications (eg. the DiffAddrStore polling) are driven from one place.
+"""
+
+from twisted.internet import reactor
+from twisted.internet.error import ReactorNotRunning
+import twisted.internet.protocol
+import twisted.protocols.basic
+import cPickle
+import socket
+import logging
+import plugin
+import notify
+import shard
+
+logger = logging.getLogger(name='shard')
+
+# How often the coordinator polls the DB for the workers, without db_notify
+poll_interval = 60
+
+def stop_reactor():
+	try:
+		reactor.stop()
+		return True
+	except ReactorNotRunning:
+		return False
+
+class Control(twisted.protocols.basic.Int32StringReceiver):
+	"""
+	One end of a control connection. The commands are pickled tuples of
+	name and parameters, each is handled by the cmd_<name> method of the
+	handler.
+	"""
+	MAX_LENGTH = 1024 ** 3
+
+	def __init__(self, handler):
+		self.__handler = handler
+
+	def connectionMade(self):
+		self.__handler.connected(self)
+
+	def connectionLost(self, reason):
+		self.__handler.disconnected()
+
+	def command(self, name, *params):
+		self.sendString(cPickle.dumps((name, params), cPickle.HIGHEST_PROTOCOL))
+
+	def stringReceived(self, string):
+		(name, params) = cPickle.loads(string)
+		getattr(self.__handler, 'cmd_' + name)(*params)
+
+class ControlFactory(twisted.internet.protocol.Factory):
+	def __init__(self, handler):
+		self.__handler = handler
+
+	def buildProtocol(self, addr):
+		return Control(self.__handler)
+
+def adopt(sock, handler):
+	reactor.adoptStreamConnection(sock.fileno(), socket.AF_UNIX, ControlFactory(handler))
+	sock.close() # The reactor has its own copy now
+
+class RemoteClient:
+	"""
+	A client connected to one of the workers, as seen by the plugins
+	in the coordinator. It has just enough of client.ClientConn for them.
+	"""
+	def __init__(self, worker, cid, session_id):
+		self.worker = worker
+		self.__cid = cid
+		self.session_id = session_id
+		self.versions = {}
+
+	def cid(self):
+		return self.__cid
+
+	def has_plugin(self, name):
+		return name in self.versions
+
+	def plugin_version(self, name):
+		return self.versions.get(name)
+
+	def sendString(self, message):
+		self.worker.command('send', self.__cid, message)
+
+	def send_frame(self, frame):
+		self.worker.command('frame', self.__cid, frame)
+
+	def connectionLost(self, reason):
+		# Called when another connection of the client takes over
+		self.worker.command('drop', self.__cid)
+
+class Worker:
+	"""
+	The coordinator's end of the control connection to one worker.
+	"""
+	def __init__(self, coordinator, index):
+		self.index = index
+		self.__coordinator = coordinator
+		self.__control = None
+		self.__clients = {}
+
+	def command(self, name, *params):
+		self.__control.command(name, *params)
+
+	def connected(self, control):
+		self.__control = control
+		self.command('start', self.__coordinator.plugins().get_plugins())
+
+	def disconnected(self):
+		for client in self.__clients.values():
+			self.__coordinator.logout(client)
+		self.__clients = {}
+		self.__coordinator.worker_lost(self)
+
+	def cmd_hello(self, channels):
+		self.__coordinator.hello(self, channels)
+
+	def cmd_login(self, cid, session_id):
+		client = RemoteClient(self, cid, session_id)
+		self.__clients[cid] = client
+		self.__coordinator.login(client)
+
+	def cmd_logout(self, cid):
+		client = self.__clients.pop(cid, None)
+		if client is not None:
+			self.__coordinator.logout(client)
+
+	def __current(self, cid):
+		"""
+		The client of that ID, if it is not replaced by another connection
+		(possibly on another worker).
+		"""
+		client = self.__clients.get(cid)
+		if client is not None and self.__coordinator.plugins().get_client(cid) is client:
+			return client
+		return None
+
+	def cmd_activate(self, name, cid, versions):
+		client = self.__current(cid)
+		if client is not None:
+			client.versions = versions
+			self.__coordinator.plugins().activate_client(name, client)
+
+	def cmd_deactivate(self, name, cid):
+		client = self.__current(cid)
+		if client is not None:
+			self.__coordinator.plugins().deactivate_client(name, client)
+
+	def cmd_versions(self, cid, versions):
+		client = self.__current(cid)
+		if client is not None:
+			client.versions = versions
+			self.__coordinator.plugins().reindex_client(client)
+
+	def cmd_message(self, name, cid, message):
+		self.__coordinator.plugins().route_to_plugin(name, message, cid)
+
+class Coordinator:
+	"""
+	Holds the control connections to all the workers and the directory of
+	the clients connected to them.
+	"""
+	def __init__(self, plugins):
+		self.__plugins = plugins
+		self.__workers = {}
+		self.__clients = {}
+		self.__waiting = set(shard.control_sockets().keys())
+		self.__relayed = set()
+		self.__poller = None
+		self.__stopping = False
+		for (index, sock) in shard.control_sockets().items():
+			self.__workers[index] = Worker(self, index)
+			adopt(sock, self.__workers[index])
+
+	def plugins(self):
+		return self.__plugins
+
+	def hello(self, worker, channels):
+		self.__relayed.update(channels)
+		self.__waiting.discard(worker.index)
+		logger.info('Worker %s ready', worker.index)
+		if not self.__waiting:
+			logger.info('All %s workers ready', len(self.__workers))
+			relay = lambda channel, payload: self.publish('notify', channel, payload)
+			if notify.enabled():
+				for channel in self.__relayed:
+					notify.subscribe(channel, lambda payload, channel=channel: relay(channel, payload))
+				notify.start()
+			else:
+				# Poll once for all the workers, they check only when told
+				self.__poller = notify.Poller(list(self.__relayed), relay, poll_interval)
+
+	def publish(self, name, *params):
+		"""
+		Send a command to all the workers.
+		"""
+		for worker in self.__workers.values():
+			worker.command(name, *params)
+
+	def login(self, client):
+		cid = client.cid()
+		old = self.__clients.get(cid)
+		if old is not None:
+			self.__plugins.unregister_client(old)
+			if old.worker is not client.worker:
+				logger.warn('Client %s connected to worker %s, dropping its connection to worker %s', cid, client.worker.index, old.worker.index)
+				old.connectionLost(None)
+		self.__clients[cid] = client
+		self.__plugins.register_client(client)
+
+	def logout(self, client):
+		cid = client.cid()
+		if self.__clients.get(cid) is client:
+			del self.__clients[cid]
+			self.__plugins.unregister_client(client)
+
+	def worker_lost(self, worker):
+		if not self.__stopping and stop_reactor():
+			logger.fatal('Lost worker %s, terminating', worker.index)
+
+	def stop(self):
+		self.__stopping = True
+		if self.__poller:
+			self.__poller.stop()
+		shard.terminate()
+
+class WorkerPlugins(plugin.Plugins):
+	"""
+	The plugin storage of a worker. It tells the coordinator about the
+	clients, their logins and the plugins running in the coordinator
+	(the proxied ones) they have.
+	"""
+	def __init__(self):
+		plugin.Plugins.__init__(self)
+		self.control = None
+		self.proxied = frozenset()
+
+	def __tell(self, name, *params):
+		if self.control is not None:
+			self.control.command(name, *params)
+
+	def __versions(self, client):
+		return dict(map(lambda name: (name, client.plugin_version(name)), filter(client.has_plugin, self.proxied)))
+
+	def register_client(self, client):
+		if not plugin.Plugins.register_client(self, client):
+			return False
+		self.__tell('login', client.cid(), client.session_id)
+		return True
+
+	def unregister_client(self, client):
+		current = self.get_client(client.cid()) is client
+		plugin.Plugins.unregister_client(self, client)
+		if current:
+			self.__tell('logout', client.cid())
+
+	def activate_client(self, name, client):
+		plugin.Plugins.activate_client(self, name, client)
+		if name in self.proxied:
+			self.__tell('activate', name, client.cid(), self.__versions(client))
+
+	def deactivate_client(self, name, client):
+		plugin.Plugins.deactivate_client(self, name, client)
+		if name in self.proxied:
+			self.__tell('deactivate', name, client.cid())
+
+	def reindex_client(self, client):
+		plugin.Plugins.reindex_client(self, client)
+		if self.proxied:
+			self.__tell('versions', client.cid(), self.__versions(client))
+
+class Proxy(plugin.Plugin):
+	"""
+	Stands in a worker for a plugin running in the coordinator. It passes
+	the messages from the clients there.
+	"""
+	def __init__(self, plugins, name):
+		self.__name = name
+		plugin.Plugin.__init__(self, plugins)
+
+	def name(self):
+		return self.__name
+
+	def message_from_client(self, message, client):
+		self.plugins().control.command('message', self.__name, client, message)
+
+class Coordinated:
+	"""
+	The worker's end of the control connection. Once the coordinator tells
+	which plugins run there, it starts accepting the clients with the
+	factory.
+	"""
+	def __init__(self, plugins, factory):
+		self.__plugins = plugins
+		self.__factory = factory
+		adopt(shard.control_sockets(), self)
+
+	def connected(self, control):
+		self.__plugins.control = control
+		control.command('hello', notify.channels())
+
+	def disconnected(self):
+		if stop_reactor():
+			logger.fatal('Lost the coordinator, terminating')
+
+	def cmd_start(self, names):
+		for name in names:
+			Proxy(self.__plugins, name)
+		self.__plugins.proxied = frozenset(names)
+		listen = shard.listen_socket()
+		reactor.adoptStreamPort(listen.fileno(), socket.AF_UNIX, self.__factory)
+		listen.close()
+		logger.info('Worker %s accepting clients, plugins %s run in the coordinator', shard.worker_index(), ', '.join(names))
+
+	def cmd_send(self, cid, message):
+		client = self.__plugins.get_client(cid)
+		if client is not None:
+			client.sendString(message)
+
+	def cmd_frame(self, cid, frame):
+		client = self.__plugins.get_client(cid)
+		if client is not None:
+			client.send_frame(frame)
+
+	def cmd_drop(self, cid):
+		client = self.__plugins.get_client(cid)
+		if client is not None:
+			logger.warn('Dropping connection of %s, it connected to another worker', cid)
+			client.transport.abortConnection()
+
+	def cmd_notify(self, channel, payload):
+		notify.deliver(channel, payload)
@@ -22,45 +22,61 @@ import struct
 import time
 
 import database
+import client_cache
+import plugin
 from task import Task
 from activity import log_activity
 from protocol import extract_string
-from twisted.internet import reactor
 import dateutil.parser
 
 logger = logging.getLogger(name='sniff')
 
-def store_certs(client, payload, hosts, batch_time, now):
+def decode_certs(payload, hosts):
+	"""
+	Decode the answer of the client into a list of (request, proto, cipher,
+	chain) for the hosts with some certificates. The chain is a list of
+	(cert, name, expiry) tuples.
+	"""
+	result = []
+	for (rid, want_details, want_params) in hosts:
+		(count,) = struct.unpack("!B", payload[0])
+		payload = payload[1:]
+		if count > 0:
+			cipher = None
+			proto = None
+			if want_params:
+				(cipher, payload) = extract_string(payload)
+				(proto, payload) = extract_string(payload)
+			chain = []
+			for i in range(0, count):
+				(cert, payload) = extract_string(payload)
+				if want_details:
+					(name, payload) = extract_string(payload)
+					(expiry, payload) = extract_string(payload)
+				else:
+					name = None
+					expiry = None
+				chain.append((cert, name, dateutil.parser.parse(expiry).isoformat() if expiry else None))
+			result.append((rid, proto, cipher, chain))
+	return result
+
+def store_cert_values(client, batch_time, now, certs):
 	with database.transaction() as t:
-		for (rid, want_details, want_params) in hosts:
-			(count,) = struct.unpack("!B", payload[0])
-			payload = payload[1:]
-			if count > 0:
-				cipher = None
-				proto = None
-				if want_params:
-					(cipher, payload) = extract_string(payload)
-					(proto, payload) = extract_string(payload)
-				t.execute("INSERT INTO certs (request, client, batch, timestamp, proto, cipher) SELECT %s, clients.id, %s, %s, %s, %s FROM clients WHERE name = %s RETURNING id", (rid, batch_time, now, proto, cipher, client))
-				(cert_id,) = t.fetchone()
-				for i in range(0, count):
-					(cert, payload) = extract_string(payload)
-					if want_details:
-						(name, payload) = extract_string(payload)
-						(expiry, payload) = extract_string(payload)
-					else:
-						name = None
-						expiry = None
-					t.execute("INSERT INTO cert_chains (cert, ord, is_full, value, name, expiry) VALUES(%s, %s, %s, %s, %s, %s)", (cert_id, i, len(cert) > 40, cert, name, dateutil.parser.parse(expiry).isoformat() if expiry else None))
+		client_id = client_cache.get(t, client)
+		if client_id is None:
+			return
+		for (rid, proto, cipher, chain) in certs:
+			t.execute("INSERT INTO certs (request, client, batch, timestamp, proto, cipher) VALUES (%s, %s, %s, %s, %s, %s) RETURNING id", (rid, client_id, batch_time, now, proto, cipher))
+			(cert_id,) = t.fetchone()
+			for (i, (cert, name, expiry)) in enumerate(chain):
+				t.execute("INSERT INTO cert_chains (cert, ord, is_full, value, name, expiry) VALUES(%s, %s, %s, %s, %s, %s)", (cert_id, i, len(cert) > 40, cert, name, expiry))
 
 class CertTask(Task):
 	def __init__(self, message, hosts):
 		Task.__init__(self)
 		self.__message = message
 		self.__hosts = hosts
-		with database.transaction() as t:
-			t.execute("SELECT CURRENT_TIMESTAMP AT TIME ZONE 'UTC'")
-			(self.__batch_time,) = t.fetchone()
+		self.__batch_time = database.now()
 
 	def name(self):
 		return 'Cert'
@@ -69,7 +85,8 @@ class CertTask(Task):
 		return self.__message
 
 	def success(self, client, payload):
-		reactor.callInThread(store_certs, client, payload, self.__hosts, self.__batch_time, database.now())
+		(batch_time, now) = (self.__batch_time, database.now())
+		plugin.decode(decode_certs, (payload, self.__hosts), lambda certs: store_cert_values(client, batch_time, now, certs))
 		log_activity(client, 'certs')
 
 def encode_host(host, port, starttls, want_cert, want_chain, want_details, want_params):
@@ -95,12 +112,12 @@ class Cert:
 			with database.transaction() as t:
 				t.execute("SELECT id, host, port, starttls, want_cert, want_chain, want_details, want_params FROM cert_requests WHERE active AND lastrun + interval < CURRENT_TIMESTAMP AT TIME ZONE 'UTC' ORDER BY lastrun + interval LIMIT %s", (self.__batchsize,))
 				requests = t.fetchall()
-			for request in requests:
-				(rid, host, port, starttls, want_cert, want_chain, want_details, want_params) = request
-				host_count += 1
-				encoded += encode_host(host, port, starttls, want_cert, want_chain, want_details, want_params)
-				hosts.append((rid, want_details, want_params))
-				t.execute("UPDATE cert_requests SET lastrun = CURRENT_TIMESTAMP AT TIME ZONE 'UTC' WHERE id = %s", (rid,))
+				for request in requests:
+					(rid, host, port, starttls, want_cert, want_chain, want_details, want_params) = request
+					host_count += 1
+					encoded += encode_host(host, port, starttls, want_cert, want_chain, want_details, want_params)
+					hosts.append((rid, want_details, want_params))
+					t.execute("UPDATE cert_requests SET lastrun = CURRENT_TIMESTAMP AT TIME ZONE 'UTC' WHERE id = %s", (rid,))
 			self.__last_task = now
 			if hosts:
 				return [CertTask(struct.pack('!H', host_count) + encoded, hosts)]
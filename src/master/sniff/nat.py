@@ -20,6 +20,7 @@
 from task import Task
 import logging
 import database
+import client_cache
 from activity import log_activity
 from twisted.internet import reactor
 
@@ -35,14 +36,14 @@ def decode(code):
 
 def submit_data(client, payload, batch_time):
 	with database.transaction() as t:
-		t.execute("INSERT INTO nats (batch, client, nat_v4, nat_v6) SELECT %s, clients.id, %s, %s FROM clients WHERE name = %s", (batch_time, decode(payload[0]), decode(payload[1]), client))
+		client_id = client_cache.get(t, client)
+		if client_id is not None:
+			t.execute("INSERT INTO nats (batch, client, nat_v4, nat_v6) VALUES (%s, %s, %s, %s)", (batch_time, client_id, decode(payload[0]), decode(payload[1])))
 
 class NatTask(Task):
 	def __init__(self):
 		Task.__init__(self)
-		with database.transaction() as t:
-			t.execute("SELECT CURRENT_TIMESTAMP AT TIME ZONE 'UTC'")
-			(self.__batch_time,) = t.fetchone()
+		self.__batch_time = database.now()
 
 	def name(self):
 		return 'Nat'
@@ -22,6 +22,7 @@ import time
 
 from task import Task
 import database
+import client_cache
 from activity import log_activity
 import logging
 from twisted.internet import reactor
@@ -50,19 +51,19 @@ def submit_data(client, payload, hosts, batch_time, now):
 			ma = None
 			mi = None
 			avg = None
-		data.append((batch_time, now, rid, ip, recv, mi, ma, avg, client))
+		data.append((batch_time, now, rid, ip, recv, mi, ma, avg))
 	logger.trace('Submitting data: ' + repr(data))
 	with database.transaction() as t:
-		t.executemany("INSERT INTO pings (batch, client, timestamp, request, ip, received, min, max, avg) SELECT %s, clients.id, %s, %s, %s, %s, %s, %s, %s FROM clients WHERE name = %s", data);
+		client_id = client_cache.get(t, client)
+		if client_id is not None:
+			t.executemany("INSERT INTO pings (batch, client, timestamp, request, ip, received, min, max, avg) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)", map(lambda (batch, now, rid, ip, recv, mi, ma, avg): (batch, client_id, now, rid, ip, recv, mi, ma, avg), data))
 
 class PingTask(Task):
 	def __init__(self, message, hosts):
 		Task.__init__(self)
 		self.__message = message
 		self.__hosts = hosts
-		with database.transaction() as t:
-			t.execute("SELECT CURRENT_TIMESTAMP AT TIME ZONE 'UTC'")
-			(self.__batch_time,) = t.fetchone()
+		self.__batch_time = database.now()
 
 	def name(self):
 		return 'Ping'
@@ -17,7 +17,7 @@
 #    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 import twisted.internet.protocol
 import plugin
 import database
@@ -27,6 +27,8 @@ import socket
 import struct
 import random
 import timers
+import notify
+import client_cache
 
 logger = logging.getLogger(name='spoof')
 
@@ -50,7 +52,9 @@ class Token:
 def store_packet(token, spoofed, matches, ip, now):
 	logger.debug("Storing packet with spoof %s from client %s", spoofed, token.client())
 	with database.transaction() as t:
-		t.execute("INSERT INTO spoof (client, batch, spoofed, addr_matches, received, ip) SELECT id, %s, %s, %s, %s, %s FROM clients WHERE name = %s", (token.time(), spoofed, matches, now, ip, token.client()))
+		client_id = client_cache.get(t, token.client())
+		if client_id is not None:
+			t.execute("INSERT INTO spoof (client, batch, spoofed, addr_matches, received, ip) VALUES (%s, %s, %s, %s, %s, %s)", (client_id, token.time(), spoofed, matches, now, ip))
 
 class UDPReceiver(twisted.internet.protocol.DatagramProtocol):
 	def __init__(self, spoof):
@@ -90,21 +94,33 @@ class SpoofPlugin(plugin.Plugin):
 		self.__receiver = UDPReceiver(self)
 		reactor.listenUDP(self.__port, self.__receiver)
 		self.__check_timer = timers.timer(self.__check, 300, False)
+		notify.subscribe('config', self.__config_notified)
 		self.__sent = None
 		self.__batch = None
 		self.__prefix = None
 		self.__now = None
 
-	def __reload_config(self):
+	def __load_config(self):
 		with database.transaction() as t:
 			t.execute("SELECT name, value FROM config WHERE plugin = 'spoof'")
-			config = dict(t.fetchall())
+			return dict(t.fetchall())
+
+	def __reload_config(self):
+		self.__apply_config(self.__load_config())
+
+	def __apply_config(self, config):
 		self.__answer_timeout = int(config['answer_timeout'])
 		self.__dest_addr = config['dest_addr']
 		self.__src_addr = config['src_addr']
 		self.__port = int(config['port'])
 		self.__interval = config['interval']
 
+	def __config_notified(self, plugin):
+		if plugin is None or plugin == 'spoof':
+			logger.debug("Spoof config changed, reloading")
+			# Don't block the reactor on the DB
+			threads.deferToThread(self.__load_config).addCallbacks(self.__apply_config, lambda failure: logger.error("Failed to reload the spoof config: %s", failure.getTraceback()))
+
 	def message_from_client(self, message, client):
 		logger.error("Message from spoof plugin, but none expected: %s, on client %s", message, client)
 
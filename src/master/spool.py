@@ -0,0 +1,332 @@
+#
+#    Ucollect - small utility for real-time analysis of network data
+#    Copyright (C) 2016 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Write-ahead spool of the data to be stored in the DB.
+
+The plugins decode the data they get from clients and store the resulting
+rows here (see store()). The rows are appended to memory-mapped segment
+files on disk and a separate thread replays them into the DB by calling
+the handler registered for their kind. So storing the data doesn't wait
+for the DB and the data is not lost if the DB is not available for a
+while or if the master crashes.
+
+Each record in a segment is a header (length and CRC32 of the payload)
+followed by the pickled (kind, client, rows) triplet. Zero length marks
+the end of the data in the segment. The replay position is stored in a
+separate file after each replayed batch, therefore a record may be
+replayed twice after a crash, but it is never lost.
+
+If no spool_dir is configured, the data are stored directly.
+"""
+
+import os
+import mmap
+import zlib
+import struct
+import cPickle
+import threading
+import logging
+import time
+import psycopg2
+import database
+import timers
+from master_config import get, getint
+
+logger = logging.getLogger(name='spool')
+
+header = struct.Struct('!II')
+
+class Spool:
+	"""
+	The spool itself. Use the module functions in the master, the class
+	is separate mostly to be usable without the configuration.
+	"""
+	def __init__(self, directory, segment_size, batch, transaction, handlers):
+		"""
+		Open the spool in the given directory. The transaction is a function
+		returning a context usable as database.transaction(), the handlers
+		is a dictionary of functions to store data of each kind (see register()).
+		"""
+		self.__directory = directory
+		self.__segment_size = segment_size
+		self.__batch = batch
+		self.__transaction = transaction
+		self.__handlers = handlers
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.__lock = threading.Lock() # Protects the writing side
+		self.__condition = threading.Condition(threading.Lock()) # Wakes up the replay thread
+		segments = self.__segments()
+		(self.__read_seg, self.__read_offset) = self.__load_position(segments)
+		self.__read_map = None
+		self.__read_map_seg = None
+		# Never append to an old segment, there may be a torn record at its end.
+		self.__write_map = None
+		self.__open_write((segments[-1] + 1) if segments else 0, segment_size)
+		self.__thread = None
+		self.__running = False
+		self.stored = 0
+		self.replayed = 0
+
+	def __path(self, segment):
+		return os.path.join(self.__directory, '%016d.seg' % segment)
+
+	def __segments(self):
+		return sorted(map(lambda name: int(name[:-4]), filter(lambda name: name.endswith('.seg'), os.listdir(self.__directory))))
+
+	def __load_position(self, segments):
+		try:
+			with open(os.path.join(self.__directory, 'position')) as f:
+				(segment, offset) = map(int, f.read().split())
+		except (IOError, ValueError):
+			(segment, offset) = (0, 0)
+		if not segments:
+			(segment, offset) = (0, 0)
+		elif segment < segments[0] or segment > segments[-1]:
+			# Already replayed and deleted, continue with the oldest one there is
+			(segment, offset) = (segments[0], 0)
+		return (segment, offset)
+
+	def __store_position(self, segment, offset):
+		path = os.path.join(self.__directory, 'position')
+		with open(path + '.tmp', 'w') as f:
+			f.write('%s %s\n' % (segment, offset))
+		os.rename(path + '.tmp', path)
+
+	def __open_write(self, segment, size):
+		if self.__write_map:
+			self.__write_map.flush()
+			self.__write_map.close()
+		with open(self.__path(segment), 'w+b') as f:
+			f.truncate(size)
+			self.__write_map = mmap.mmap(f.fileno(), size)
+		self.__write_seg = segment
+		self.__write_offset = 0
+		logger.debug("Writing spool segment %s", segment)
+
+	def store(self, kind, client, rows):
+		"""
+		Append the rows of given kind to the spool.
+		"""
+		self.store_packed(pack(kind, client, rows))
+
+	def store_packed(self, payload):
+		"""
+		Append the rows already pickled by pack().
+		"""
+		size = header.size + len(payload)
+		with self.__lock:
+			# Leave space for the terminating empty header
+			if self.__write_offset + size + header.size > len(self.__write_map):
+				self.__open_write(self.__write_seg + 1, max(self.__segment_size, size + header.size))
+			(m, offset) = (self.__write_map, self.__write_offset)
+			# The payload goes first, the header makes it valid
+			m[offset + header.size:offset + size] = payload
+			header.pack_into(m, offset, len(payload), zlib.crc32(payload) & 0xffffffff)
+			self.__write_offset += size
+			self.stored += 1
+		with self.__condition:
+			self.__condition.notify()
+
+	def __map(self, segment):
+		if self.__read_map_seg != segment:
+			if self.__read_map:
+				self.__read_map.close()
+			with open(self.__path(segment), 'rb') as f:
+				self.__read_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			self.__read_map_seg = segment
+		return self.__read_map
+
+	def __read_batch(self):
+		"""
+		Read up to a batch of records, starting at the replay position. Return
+		them and the position after them.
+		"""
+		records = []
+		(segment, offset) = (self.__read_seg, self.__read_offset)
+		while len(records) < self.__batch:
+			# Check the active segment before looking at the data. If it was
+			# already left by the writer, it can't change any more.
+			with self.__lock:
+				active = self.__write_seg
+			m = self.__map(segment)
+			length = 0
+			if offset + header.size <= len(m):
+				(length, crc) = header.unpack_from(m, offset)
+			if length and offset + header.size + length <= len(m):
+				payload = m[offset + header.size:offset + header.size + length]
+				if zlib.crc32(payload) & 0xffffffff == crc:
+					records.append(cPickle.loads(payload))
+					offset += header.size + length
+					continue
+				logger.error("Broken record in spool segment %s at %s, skipping rest of the segment", segment, offset)
+			if segment == active:
+				break # No more data for now
+			segment += 1
+			offset = 0
+		return (records, segment, offset)
+
+	def __replay(self, records):
+		"""
+		Store the records in the DB. Return if it succeeded (or at least if
+		it makes no sense to try again).
+		"""
+		try:
+			with self.__transaction() as t:
+				for (kind, client, rows) in records:
+					self.__handlers[kind](t, client, rows)
+			return True
+		except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+			logger.error("Can't replay the spool now, will try again: %s", e)
+			return False
+		except Exception:
+			logger.warn("Failed to replay a batch from spool, trying the records one by one")
+		# Some record in the batch is broken. Make sure it doesn't block the rest.
+		for (kind, client, rows) in records:
+			try:
+				with self.__transaction() as t:
+					self.__handlers[kind](t, client, rows)
+			except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+				logger.error("Can't replay the spool now, will try again: %s", e)
+				return False
+			except Exception:
+				logger.exception("Dropping spooled %s data of client %s", kind, client)
+		return True
+
+	def __advance(self, segment, offset):
+		self.__store_position(segment, offset)
+		for old in range(self.__read_seg, segment):
+			logger.debug("Removing replayed spool segment %s", old)
+			if self.__read_map_seg == old:
+				self.__read_map.close()
+				(self.__read_map, self.__read_map_seg) = (None, None)
+			try:
+				os.unlink(self.__path(old))
+			except OSError:
+				pass # Already gone
+		(self.__read_seg, self.__read_offset) = (segment, offset)
+
+	def drain(self):
+		"""
+		Replay one batch of records. Return the number of replayed records,
+		None if the replay failed.
+		"""
+		(records, segment, offset) = self.__read_batch()
+		if records and not self.__replay(records):
+			return None
+		if (segment, offset) != (self.__read_seg, self.__read_offset):
+			self.__advance(segment, offset)
+		self.replayed += len(records)
+		return len(records)
+
+	def __keep_draining(self):
+		logger.info('Spool replay thread started')
+		while self.__running:
+			try:
+				count = self.drain()
+			except Exception:
+				logger.exception("Unexpected exception in spool replay thread")
+				count = None
+			if count is None:
+				time.sleep(1)
+			elif count == 0:
+				with self.__condition:
+					self.__condition.wait(1)
+		logger.info('Spool replay thread terminated')
+
+	def start(self):
+		self.__running = True
+		self.__thread = threading.Thread(target=self.__keep_draining, name='spool')
+		self.__thread.start()
+
+	def stop(self):
+		"""
+		Stop the replay thread. The data not replayed yet stay on the disk,
+		for the next run.
+		"""
+		self.__running = False
+		with self.__condition:
+			self.__condition.notify()
+		if self.__thread:
+			self.__thread.join()
+		with self.__lock:
+			self.__write_map.flush()
+
+__handlers = {}
+__spool = None
+
+def register(kind, handler):
+	"""
+	Register a handler to store data of given kind. It is called as
+	handler(transaction, client, rows) with the values passed to store().
+	"""
+	__handlers[kind] = handler
+
+def store(kind, client, rows):
+	"""
+	Store the rows of data of given kind, from the given client. The data
+	are passed to the registered handler, either directly or through the
+	spool. The rows must be picklable.
+	"""
+	if __spool:
+		__spool.store(kind, client, rows)
+	else:
+		with database.transaction() as t:
+			__handlers[kind](t, client, rows)
+
+def pack(kind, client, rows):
+	"""
+	Pickle the rows for store_packed(). This is the costly part of storing
+	into the spool, so it can be done elsewhere (eg. in another process).
+	"""
+	return cPickle.dumps((kind, client, rows), cPickle.HIGHEST_PROTOCOL)
+
+def store_packed(payload):
+	"""
+	Like store(), with the rows pickled by pack().
+	"""
+	if __spool:
+		__spool.store_packed(payload)
+	else:
+		(kind, client, rows) = cPickle.loads(payload)
+		with database.transaction() as t:
+			__handlers[kind](t, client, rows)
+
+def start(subdirectory=None):
+	"""
+	Start the spool, if configured. Call after all the handlers are registered,
+	the spool may contain data from the previous run. Processes sharing the
+	spool_dir (the workers of a sharded master) use a subdirectory each.
+	"""
+	global __spool
+	directory = get('spool_dir', '')
+	if directory:
+		if subdirectory:
+			directory = os.path.join(directory, subdirectory)
+		__spool = Spool(directory, getint('spool_segment_size', 64 * 1024 * 1024), getint('spool_batch', 100), database.transaction, __handlers)
+		__spool.start()
+		timers.timer(__log_stats, 300, False)
+
+def stop():
+	if __spool:
+		__spool.stop()
+
+def __log_stats():
+	logger.info("Spool: %s records stored, %s replayed", __spool.stored, __spool.replayed)